@@ -0,0 +1,5680 @@
+# -*- coding: utf-8 -*-
+# pycodestyle "H:\My Drive\Python\Metashape Chunk Scripts v8_2.py"
+"""
+Created by M.Schaefer
+v8.3 17/05/2024
+v7.8 08/06/2022
+v7.7 26/05/2022
+v7.6 04/02/2022
+v7.5 01/02/2022
+v7.4 25/11/2020
+v7.3 19/03/2020
+v7.2 30/10/2019
+v7.1 28/06/2019
+v7 13/03/2019
+Update to Metashape
+Change log:
+    v8.6
+        blue_flag runs on all chunks, projects every marker into all aligned
+            cameras in one vectorised numpy pass and reports projections
+            added
+        Added reference transform chain (offset, scale, geoid, lever arm,
+            reprojection) applied to all camera references in one pass with
+            dry run statistics and undo. reverse_altitude uses it.
+        Added fit_region to fit the region to robust (percentile trimmed)
+            tie point bounds before dense reconstruction
+        Added plan_depth_qual to pick the depth map downscale per chunk from
+            the ground sample distance and a target DSM/ortho resolution
+        dense_c reuses existing depth maps with matching quality and
+            filtering (completing interrupted sets) and can keep several
+            depth map sets for filtering comparisons
+        Added filter_conf stage to remove or classify low confidence points
+            (optional voxel outlier pass) between dense_c and dem/export
+        Added export manifest (JSON) of all exported files
+        Added LAS level of detail pyramid (point ratios and/or voxel sizes)
+            streamed from the exported LAS in blocks
+        Added configurable export formats: LAS/LAZ point clouds, OBJ/binary
+            PLY/GLB meshes and texture format, size and write time of each
+            export are logged. export_geo no longer exports the LAS/model
+            once per chunk for every chunk.
+        Added export_tiles for resumable XYZ/TMS web map tile pyramids of
+            the orthomosaic, run after export_geo if self.web_tiles is set
+        Added dsm_stats QA stage computing DSM statistics streamed over
+            memory mapped windows of the exported (uncompressed) DSM, run
+            after export_geo if self.dsm_qa is set
+        Added dsm_diff to difference the exported DSM against a reference DSM
+            of an earlier epoch tile by tile (DoD raster and volume change),
+            run after export_geo if self.ref_dsm is set, compressed DSMs
+            are decompressed strip by strip first
+        Added split_chunks to split large chunks into a grid of overlapping
+            tile chunks, later stages then process the tiles
+        Added merge_tiles to mosaic the exported DSM/ortho of tiled chunks
+            window by window with feathered blending and to merge their LAS
+            files streaming, keeping each point from its nearest tile
+        Added incremental option to align: only new (unaligned) cameras are
+            matched against nearby aligned ones and aligned, keypoints are
+            kept for this if self.keep_keypoints is set
+        align picks keypoint and tie point limits per chunk from the image
+            size, camera count and workflow (tune_limits), optionally
+            calibrated with a low accuracy trial match on a sample, and logs
+            the matching time
+        Added SQLite run history (one row per chunk and stage with counts,
+            wall time and peak memory) and an ETA from per-stage cost models
+            fitted to it, printed at the start of run_geo/run_model and
+            after each stage
+        Added rate limited progress callbacks to all build and export calls
+            with smoothed throughput and ETA, published to the console, the
+            log (every 10 %) and a JSON status file
+        Added a resource monitor thread sampling CPU, memory, swap and disk
+            I/O from /proc (Linux) or psutil (Windows, macOS) while
+            run_geo/run_model/sweep run, tagged with the current chunk and
+            call, written as a CSV timeline with per-stage peak/average
+            summaries in the log
+        Added preflight check (size estimate of the products against free
+            disk space, writable export folder and valid export CRS) at the
+            start of run_geo/run_model so runs fail fast, MSPreflightCheck
+            (self.preflight_force only warns about the space estimate)
+        Added tie point snapshots (reconstruction uncertainty, projection
+            accuracy, reprojection error, image count and coordinates) as
+            compressed float32 .npz files at each gradual selection step,
+            written in a background thread
+        Added simulate_grad to replay the gradual selection on a tie point
+            snapshot offline over a grid of parameters (thresholds and
+            remaining points per combination, CSV)
+        Added grad_sel_combined, a single pass gradual selection mode
+            (self.grad_mode = 'combined') with the thresholds of all three
+            criteria from quantiles of one read of the values and one or
+            two optimisations, used by run_geo
+        grad_sel_postgcp stops early when the reprojection RMSE and the
+            camera positions no longer change between optimisations, or at
+            an iteration or time budget, and logs the convergence curve
+        The tie point baseline (points and tracks after alignment) and the
+            gradual selection values used are kept in the chunk metadata,
+            so the selection can run in a later session
+        Added sweep to run several dense/DEM/ortho parameter sets on copies
+            of one alignment with prefixed exports and a timing/size
+            comparison table
+    v8.5
+        Added parameters for seamlines and ghosting to ortho process
+    v8.4
+        Update to major version 2.2
+    v8.3
+        Update to major version 2.1
+    v8.2
+        Linted
+    v8.1
+        Changed default settings:
+            Filtering = Moderate
+        Added report export
+        converted .format to f-string
+        replaced os with pathlib.Path
+    v8.0
+        updated for major version 2.0
+        updated script to reflect name changes in 2.0 API
+    v7.8
+        changed align option for run_model to generic=True
+        added parameter to align for guided matching default True
+        added align option guided_matching=guided is good for vegetation,
+        grass, trees etc., as well as large sensors
+        changed align option for run_model to guided=False
+        Added blue_flag static method to turn white flags blue
+        Added refine seamlines and ghosting =True to ortho process
+        Changed export of JPG input to PNG
+    v7.7
+        Changed default settings:
+            Camera quality = 0.5
+            Filtering = Aggressive
+    v7.6
+        Updated to version number 1.8
+        Added point_confidence=True to buildDenseCloud
+        Added specific workflow and menus for Fjalls, stopping before
+            ortho to disable pictures.
+    v7.5
+        Updated to version number 1.7
+    v7.4
+        Updated ortho to fix errors due to Metashape python changes
+        Updated export_geo to fix errors due to Metashape python changes.
+            export-raster projection is now not the metashape crs,
+            but an orthoprojection with an attribute called crs
+        Added matching accuracy and depth map quality to main class, and a
+            custom menu to set these with checks if the user entered values are
+            options Metashape supports.
+        export: if tiff too large for export try to export as BigTIFF
+             and if that fails log error and continue
+    v7.3
+        Update to 1.6 Python API changes
+        For matching accuracy the correspondence should be the following:
+        Highest = 0
+        High = 1
+        Medium = 2
+        Low = 4
+        Lowest = 8
+
+        For depth maps quality:
+        Ultra = 1
+        High = 2
+        Medium = 4
+        Low = 8
+        Lowest = 16
+    v7.2
+    added option to select mask by tie points to model
+    added option to run model in highest accuracy and quality
+    added resetRegion to end of align process
+    v7.1
+    added reverse altitude script for DJI "below sea level" issue
+    v7
+    changed all references to Metashape
+    tweaked grad selection process
+    made changes to log file - added total time
+To do:
+    The valid ties after alignment (the gradual selection baseline) and the
+    tracks are stored in the chunk metadata (MSProc/total_points,
+    MSProc/tracks) by align and loaded when the script starts, so align and
+    gradual selection can be run in different sessions. Chunks aligned
+    outside the script need ms_doc.set_baseline() before the selection.
+        len(chunk.tie_points.points) - valid ties
+        len(chunk.tie_points.tracks) - all ties
+With gradual selection:
+    After alignment the model is optimised and then a gradual selection is run.
+    After the align process all tie points have errors attached
+    to them. The values used are a matter of debate.
+    Rec Uncert is normally set to 10 and run only once. If
+    the value of 10 selects more than 50% of the tie points the value
+    self-adjusts to less than 50%.
+    Proj acc is set to start at 2 and self adjusts so less
+    than 50% of the tie points left after Rec Uncert are selected.
+    For Reprojection Error the aim is to select up to a set percentage
+    (default 80) of the initial tie points. The value used is self
+    selecting. The selection process is in steps of 10% and optimisation
+    is run after each step.
+    Values used are saved in the log file.
+Without gradual selection:
+    After alignment the model is optimised once.
+3D Model/Geo: Geo basically is anything where the photos have coordinates or
+    if using Ground Control Points(GCP). If you have photos of objects without
+    that info use 3D Model
+Set-up workflow:
+1. Set up your chunk(s)
+    import images
+    name chunks (optional - helps in sorting the output)
+    save a copy of the MS Doc
+Custom workflow:
+2. (Geo) Set reference system for each chunk
+3. Load script
+    chose output folder
+    chose file prefix (this gets added to each output file -
+                       helps if trying different settings)
+4. Under "Change Values" select "Get Current Parameter info" (check console
+                                                              window for output
+                                                              )
+    check image quality threshold
+    check filtering (options: Mild (default), Moderate, Aggressive, none)
+    (Geo) check export CRS (in case you want the output to be different from
+    the CRS of the project)
+No GCP or checking alignment - runs whole process and exports:
+5a. (Geo) Choose "Custom":"Run - Geo" (with or without gradual selection)
+or
+5b. (3D Model) Choose "Custom":"Run - 3D Model" (with or without gradual
+    selection)
+With GCP or scales or if wanting to check alignment:
+    Having the images aligned helps with marker placement. If markers are
+    placed already there is no quality difference as to whether you align on
+    image coords first and then switch to GCP, although some sources claim this
+    is better. If markers exist you can import them and run the whole process
+    to save time (see above).
+5. Choose "Custom":"Align only" (with or without gradual selection)
+6. Set up GCP for each chunk or set scale
+7. Check alignment
+8a. (Geo) Choose "Custom":"Run all after alignment - Geo" (with or
+                                                    without gradual selection)
+or
+8b. (3D Model) Choose "Custom":"Run all after alignment - 3D Model" (with or
+                                                    without gradual selection)
+Files generated depend on method used (3D or Geo) and input photos.
+To run methods individually as well after opening the script, in console type
+    "ms_doc." and then hit "TAB" to see the options.
+"""
+# imports
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime
+from datetime import timedelta
+import ctypes
+import json
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from pathlib import Path
+import numpy as np
+import Metashape
+try:
+    import resource
+except ImportError:
+    # not available on Windows, see process_memory()
+    resource = None
+try:
+    import psutil
+except ImportError:
+    # optional, resource monitor and memory outside Linux
+    psutil = None
+
+
+# custom exceptions
+class MSVersionCheck(Exception):
+    """Exception if MS is not equal to major version
+       supported by this script"""
+
+    def __init__(self, compat, found):
+        self.message = ('Incompatible Metashape version: '
+                        f'{found} != {compat}')
+        super().__init__(self.message)
+
+
+class MSSaveCheck(Exception):
+    """Exception if the MS doc is not saved on disk yet"""
+
+    def __init__(self):
+        self.message = 'Metashape document needs to be saved first'
+        super().__init__(self.message)
+
+
+class MSChunckCheck(Exception):
+    """Exception if no chunks are found in doc to process"""
+
+    def __init__(self):
+        self.message = 'No chunks to process'
+        super().__init__(self.message)
+
+
+class MSPreflightCheck(Exception):
+    """Exception if a workflow would fail for lack of space, an unwritable
+       export folder or an invalid export CRS"""
+
+    def __init__(self, problems):
+        self.message = 'Preflight check failed: ' + '; '.join(problems)
+        super().__init__(self.message)
+
+
+# Checking compatibility
+COMPATIBLE_MAJOR_VERSION = ['2.1', '2.2']
+FOUND_MAJOR_VERSION = '.'.join(Metashape.app.version.split('.')[:2])
+if FOUND_MAJOR_VERSION not in COMPATIBLE_MAJOR_VERSION:
+    raise MSVersionCheck(COMPATIBLE_MAJOR_VERSION, FOUND_MAJOR_VERSION)
+# Check document is saved
+if not Metashape.app.document.path:
+    raise MSSaveCheck()
+# LAS class 7 Low Point (noise) of filter_conf, left out of DEM and LAS
+NOISE_CLASS = 7
+CLEAN_CLASSES = [c for c in range(128) if c != NOISE_CLASS]
+
+
+# helpers
+def to_array(matrix):
+    """
+    Convert a Metashape.Matrix to a numpy array
+
+    Input: matrix - Metashape.Matrix
+    Output: numpy array of the same shape
+    """
+    rows, _ = matrix.size
+    return np.array([list(matrix.row(i)) for i in range(rows)], dtype=float)
+
+
+def process_memory():
+    """
+    Resident memory of the process where /proc is missing
+
+    Output: (current, lifetime peak) in MB, either None if unknown. From
+        psutil if installed, otherwise the Windows API or getrusage (peak
+        only, macOS and other Unix)
+    """
+    current = None
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        current = info.rss / 2 ** 20
+        # the peak only on Windows
+        if getattr(info, 'peak_wset', None):
+            return current, info.peak_wset / 2 ** 20
+    if sys.platform == 'win32':
+        size = ctypes.c_size_t
+
+        class Counters(ctypes.Structure):
+            _fields_ = [('cb', ctypes.c_ulong), ('faults', ctypes.c_ulong),
+                        ('peak', size), ('current', size)] \
+                + [(f'other{i}', size) for i in range(6)]
+        counters = Counters()
+        counters.cb = ctypes.sizeof(counters)
+        kernel = ctypes.windll.kernel32
+        kernel.GetCurrentProcess.restype = ctypes.c_void_p
+        if ctypes.windll.psapi.GetProcessMemoryInfo(
+                ctypes.c_void_p(kernel.GetCurrentProcess()),
+                ctypes.byref(counters), counters.cb):
+            return counters.current / 2 ** 20, counters.peak / 2 ** 20
+        return current, None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return current, peak / 1024 ** (2 if sys.platform == 'darwin' else 1)
+    return current, None
+
+
+def peak_memory(base=None):
+    """
+    Peak resident memory of the process in MB since reset_peak_memory()
+
+    Input: base - value returned by reset_peak_memory()
+    Output: VmHWM of /proc/self/status on Linux. Elsewhere the lifetime
+        peak cannot be reset, so it is only returned if it rose above base
+        during the stage, otherwise None (the stage stayed below an
+        earlier peak, see the resource monitor samples)
+    """
+    try:
+        status = Path('/proc/self/status').read_text()
+    except OSError:
+        peak = process_memory()[1]
+        return peak if peak and base is not None and peak > base else None
+    for line in status.splitlines():
+        if line.startswith('VmHWM:'):
+            return int(line.split()[1]) / 1024
+    return None
+
+
+def reset_peak_memory():
+    """
+    Start a new peak for peak_memory()
+
+    Output: lifetime peak in MB to pass to peak_memory() where the peak
+        cannot be reset (Windows, macOS), None on Linux
+    """
+    try:
+        Path('/proc/self/clear_refs').write_text('5')
+    except OSError:
+        return process_memory()[1]
+    return None
+
+
+def read_proc():
+    """
+    Read the cumulative resource counters of the system and this process
+
+    Output: dict of CPU jiffies (total, idle, process), memory and swap
+        in kB and process disk read/write bytes, None without /proc
+    """
+    proc = Path('/proc')
+    if not (proc / 'stat').exists():
+        return None
+    cpu = [int(v) for v in (proc / 'stat').read_text().split('\n')[0]
+           .split()[1:]]
+    stat = (proc / 'self' / 'stat').read_text()
+    # fields after the process name, which may contain spaces
+    fields = stat[stat.rindex(')') + 2:].split()
+    mem = {}
+    for line in (proc / 'meminfo').read_text().splitlines():
+        key, value = line.split(':', 1)
+        mem[key] = int(value.split()[0])
+    rss = 0
+    for line in (proc / 'self' / 'status').read_text().splitlines():
+        if line.startswith('VmRSS:'):
+            rss = int(line.split()[1])
+    io = {}
+    try:
+        for line in (proc / 'self' / 'io').read_text().splitlines():
+            key, value = line.split(':', 1)
+            io[key] = int(value)
+    except OSError:
+        # not readable in some containers
+        pass
+    return {'total': sum(cpu),
+            'idle': cpu[3] + cpu[4],
+            'proc': int(fields[11]) + int(fields[12]),
+            'rss': rss,
+            'mem_total': mem.get('MemTotal', 0),
+            'mem_avail': mem.get('MemAvailable', 0),
+            'swap_used': mem.get('SwapTotal', 0) - mem.get('SwapFree', 0),
+            'read': io.get('read_bytes', 0),
+            'write': io.get('write_bytes', 0),
+            }
+
+
+def read_usage():
+    """
+    Read the resource counters of read_proc() on any platform
+
+    Output: dict as read_proc(), from /proc or psutil (CPU times in 1/100
+        s like jiffies), None if neither is available
+    """
+    counters = read_proc()
+    if counters is not None or psutil is None:
+        return counters
+    cpu = psutil.cpu_times()
+    process = psutil.Process()
+    times = process.cpu_times()
+    memory = psutil.virtual_memory()
+    try:
+        io = process.io_counters()
+    except (AttributeError, psutil.Error):
+        # not available on macOS
+        io = None
+    return {'total': 100 * sum(cpu),
+            'idle': 100 * cpu.idle,
+            'proc': 100 * (times.user + times.system),
+            'rss': process.memory_info().rss / 1024,
+            'mem_total': memory.total / 1024,
+            'mem_avail': memory.available / 1024,
+            'swap_used': psutil.swap_memory().used / 1024,
+            'read': io.read_bytes if io else 0,
+            'write': io.write_bytes if io else 0,
+            }
+
+
+def is_geographic(crs):
+    """True if the Metashape.CoordinateSystem uses degrees (not projected)"""
+    return bool(crs) and 'GEOGCS' in crs.wkt and 'PROJCS' not in crs.wkt
+
+
+def in_polygon(xy, polygon):
+    """
+    Vectorised even-odd point in polygon test
+
+    Input: xy - (N, 2) array of points
+            polygon - list of (x, y) vertices
+    Output: (N,) boolean array
+    """
+    poly = np.asarray(polygon, dtype=float)
+    x, y = xy[:, 0:1], xy[:, 1:2]
+    x1, y1 = poly[:, 0], poly[:, 1]
+    x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cross = ((y1 > y) != (y2 > y)) & \
+            (x < (x2 - x1) * (y - y1) / (y2 - y1) + x1)
+    return np.count_nonzero(cross, axis=1) % 2 == 1
+
+
+def hull_cells(rows, first, last):
+    """
+    Number of raster cells inside the convex hull of the valid cells
+
+    Input: rows - row numbers that have valid cells
+            first, last - column of the first and last valid cell of each
+                of those rows
+    Output: number of cells whose centre lies inside the hull (the valid
+        data footprint), the hull of the row extents is that of all cells
+    """
+    pts = np.unique(np.r_[np.c_[first, rows], np.c_[last, rows]], axis=0)
+    pts = pts.astype(float)
+
+    def half(points):
+        # monotone chain, keeps counter-clockwise turns
+        chain = []
+        for p in points:
+            while len(chain) > 1:
+                (ax, ay), (bx, by) = chain[-1] - chain[-2], p - chain[-2]
+                if ax * by - ay * bx > 0:
+                    break
+                chain.pop()
+            chain.append(p)
+        return chain[:-1]
+
+    hull = np.array(half(pts) + half(pts[::-1])) if len(pts) > 2 else pts
+    span = np.arange(int(hull[:, 1].min()), int(hull[:, 1].max()) + 1)
+    left = np.full(len(span), np.inf)
+    right = np.full(len(span), -np.inf)
+    for (x1, y1), (x2, y2) in zip(hull, np.roll(hull, -1, axis=0)):
+        inside = (span >= min(y1, y2)) & (span <= max(y1, y2))
+        if y1 == y2:
+            x = np.full((2, np.count_nonzero(inside)), [[x1], [x2]])
+        else:
+            x = x1 + (span[inside] - y1) * (x2 - x1) / (y2 - y1)
+            x = np.vstack([x, x])
+        left[inside] = np.minimum(left[inside], x.min(axis=0))
+        right[inside] = np.maximum(right[inside], x.max(axis=0))
+    cells = np.floor(right + 1e-9) - np.ceil(left - 1e-9) + 1
+    return int(cells[cells > 0].sum())
+
+
+def read_ply(path):
+    """
+    Memory map the vertices of a binary little endian PLY file
+
+    Input: path - the PLY file
+    Output: vertices - numpy structured memmap of the vertex element
+            header - list of the header lines
+    """
+    types = {'char': 'i1', 'uchar': 'u1', 'short': '<i2', 'ushort': '<u2',
+             'int': '<i4', 'uint': '<u4', 'float': '<f4', 'double': '<f8',
+             'int8': 'i1', 'uint8': 'u1', 'int16': '<i2', 'uint16': '<u2',
+             'int32': '<i4', 'uint32': '<u4', 'float32': '<f4',
+             'float64': '<f8'}
+    header = []
+    with open(path, 'rb') as ply:
+        while True:
+            line = ply.readline()
+            if not line:
+                raise ValueError(f'{path} has no PLY header end')
+            header.append(line.decode('ascii').strip())
+            if header[-1] == 'end_header':
+                break
+        offset = ply.tell()
+    if 'format binary_little_endian 1.0' not in header:
+        raise ValueError(f'{path} is not a binary little endian PLY')
+    count, fields, element = 0, [], None
+    for line in header:
+        words = line.split()
+        if not words:
+            continue
+        if words[0] == 'element':
+            element = words[1]
+            if element == 'vertex':
+                count = int(words[2])
+        elif words[0] == 'property' and element == 'vertex':
+            fields.append((words[-1], types[words[1]]))
+    vertices = np.memmap(path, dtype=np.dtype(fields), mode='r',
+                         offset=offset, shape=(count,))
+    return vertices, header
+
+
+def write_ply(path, vertices, header, mask, block=10000000, count=None,
+              edit=None):
+    """
+    Write the masked vertices of read_ply() to a new binary PLY
+
+    Input: path - the output PLY file
+            vertices, header - from read_ply()
+            mask - boolean array of the vertices to keep or a function
+                mask(start, end) returning it for the vertices start:end
+            block - number of vertices copied at a time
+            count - number of vertices kept (required for a mask function)
+            edit - optional function edit(start, end, window) changing a
+                copy of the vertices start:end in place before the mask
+    Output: number of vertices written
+    """
+    if count is None:
+        count = int(np.count_nonzero(mask))
+    lines = [f'element vertex {count}' if line.startswith('element vertex')
+             else line for line in header]
+    with open(path, 'wb') as ply:
+        ply.write(('\n'.join(lines) + '\n').encode('ascii'))
+        for start in range(0, len(vertices), block):
+            end = min(start + block, len(vertices))
+            window = vertices[start:end]
+            if edit:
+                window = np.array(window)
+                edit(start, end, window)
+            keep = mask(start, end) if callable(mask) else mask[start:end]
+            ply.write(np.ascontiguousarray(window[keep]).tobytes())
+    return count
+
+
+def flag_ply(raw, clean, rot, *, voxel=None, min_frac=0.1, outliers=True,
+             min_conf=0, classify=False, block=10000000):
+    """
+    Flag low confidence and outlier points of a binary PLY
+
+    Input: raw - binary PLY exported by Metashape (with confidence and
+                class if min_conf or classify are used)
+            clean - the PLY written if any points are flagged
+            rot - (3, 3) rotation of the PLY coordinates to east, north, up
+            voxel, min_frac - outlier test, see voxel_outliers()
+            outliers - boolean (run the outlier test)
+            min_conf - points with a lower confidence are flagged
+            classify - boolean (keep flagged points as NOISE_CLASS instead
+                of leaving them out of clean)
+            block - number of points processed at a time
+    Output: (low confidence points, outliers, points flagged in total),
+        clean is only written if points are flagged
+
+    The memory map of raw is local, so it is closed when the function
+        returns and the file can be removed (Windows).
+    """
+    vertices, header = read_ply(raw)
+    total = len(vertices)
+
+    def xyz_of(start, end):
+        window = vertices[start:end]
+        xyz = np.column_stack([window['x'], window['y'],
+                               window['z']]).astype(float)
+        return xyz @ rot.T
+
+    def low(start, end):
+        if not min_conf:
+            return np.zeros(end - start, dtype=bool)
+        return vertices[start:end]['confidence'] < min_conf
+
+    is_out, n_out = (voxel_outliers(xyz_of, total, voxel, min_frac, block)
+                     if outliers else (None, 0))
+
+    def flagged(start, end):
+        flags = low(start, end)
+        if is_out is not None:
+            flags |= is_out(start, end)
+        return flags
+
+    def count(flags_of):
+        return sum(int(np.count_nonzero(flags_of(s, min(s + block, total))))
+                   for s in range(0, total, block))
+
+    n_low = count(low) if min_conf else 0
+    if not n_low and not n_out:
+        return 0, 0, 0
+    if not classify:
+        n_flag = count(flagged) if n_low and n_out else n_low + n_out
+        write_ply(clean, vertices, header, lambda s, e: ~flagged(s, e),
+                  block, count=total - n_flag)
+        return n_low, n_out, n_flag
+    n_flag = 0
+
+    def to_noise(start, end, window):
+        nonlocal n_flag
+        flags = flagged(start, end)
+        n_flag += int(np.count_nonzero(flags))
+        window['class'][flags] = NOISE_CLASS
+
+    write_ply(clean, vertices, header, lambda s, e: slice(None), block,
+              count=total, edit=to_noise)
+    return n_low, n_out, n_flag
+
+
+def voxel_outliers(xyz_of, total, voxel, min_frac=0.1, block=10000000):
+    """
+    Statistical outlier test on a voxel grid, streamed in blocks
+
+    Input: xyz_of - function xyz_of(start, end) returning the (n, 3) metric
+                coordinates of the points start:end (z up)
+            total - number of points
+            voxel - voxel size, None to use 4 x the mean point spacing
+            min_frac - points whose 3x3x3 voxel neighbourhood holds fewer
+                points than min_frac x the median neighbourhood are outliers
+            block - number of points processed at a time
+    Output: (function outliers(start, end) returning the boolean outlier
+                mask of the points start:end, number of outliers)
+
+    Only the points of one block and the sparse table of occupied voxels
+        (sorted keys and counts) are held in memory. The passes are: bounds,
+        voxel counts, neighbourhood histogram (median and outlier count);
+        the returned function recomputes the neighbourhoods of a block.
+    """
+    blocks = [(s, min(s + block, total)) for s in range(0, total, block)]
+    low = np.full(3, np.inf)
+    high = np.full(3, -np.inf)
+    for s, e in blocks:
+        xyz = xyz_of(s, e)
+        low = np.minimum(low, xyz.min(axis=0))
+        high = np.maximum(high, xyz.max(axis=0))
+    if not voxel:
+        extent = high - low
+        voxel = 4 * np.sqrt(max(extent[0] * extent[1], 1e-12) / total)
+    dims = ((high - low) / voxel).astype(np.int64) + 3
+
+    def keys_of(s, e):
+        idx = ((xyz_of(s, e) - low) / voxel).astype(np.int64) + 1
+        return (idx[:, 0] * dims[1] + idx[:, 1]) * dims[2] + idx[:, 2]
+
+    # sparse voxel count table, merged every few blocks
+    uniq = np.empty(0, dtype=np.int64)
+    counts = np.empty(0, dtype=np.int64)
+    parts = []
+    for n, (s, e) in enumerate(blocks, 1):
+        parts.append(np.unique(keys_of(s, e), return_counts=True))
+        if len(parts) == 8 or n == len(blocks):
+            keys = np.concatenate([uniq] + [k for k, _c in parts])
+            weights = np.concatenate([counts] + [c for _k, c in parts])
+            uniq, inverse = np.unique(keys, return_inverse=True)
+            counts = np.bincount(inverse.ravel(), weights=weights,
+                                 minlength=len(uniq)).astype(np.int64)
+            parts = []
+
+    def neighbours(s, e):
+        keys = keys_of(s, e)
+        nbrs = np.zeros(len(keys), dtype=np.int64)
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                for dk in (-1, 0, 1):
+                    shifted = keys + (di * dims[1] + dj) * dims[2] + dk
+                    pos = np.clip(np.searchsorted(uniq, shifted), 0,
+                                  len(uniq) - 1)
+                    nbrs += np.where(uniq[pos] == shifted, counts[pos], 0)
+        return nbrs
+
+    hist = np.zeros(1, dtype=np.int64)
+    for s, e in blocks:
+        counted = np.bincount(neighbours(s, e))
+        if len(counted) > len(hist):
+            hist = np.pad(hist, (0, len(counted) - len(hist)))
+        hist[:len(counted)] += counted
+    median = np.searchsorted(np.cumsum(hist), (total + 1) / 2)
+    limit = min_frac * median
+    outliers = int(hist[:int(np.ceil(limit))].sum())
+    return (lambda s, e: neighbours(s, e) < limit), outliers
+
+
+def sim_iterate(values, total, tp_pcnt, sel_value, step, threshold):
+    """
+    Replay of MSProc.iterate_grad on an array of criterion values
+
+    Input: values - sorted criterion values of the current tie points
+            total - tie points after alignment (hard limit base)
+            tp_pcnt, sel_value, step, threshold - as in iterate_grad
+    Output: (limit reached, value used, number of points selected)
+    """
+    current = len(values)
+    hard_limit = total * tp_pcnt
+    max_ties = current * threshold / 100
+    adjust = 0
+    while True:
+        # selectPoints selects the points above the value
+        sel = current - np.searchsorted(values, sel_value - adjust,
+                                        side='right')
+        remain_ties = current - sel
+        if remain_ties > hard_limit and sel < max_ties:
+            return False, sel_value - adjust, sel
+        if sel > max_ties and remain_ties != hard_limit:
+            adjust += step
+            continue
+        return True, sel_value - adjust, 0
+
+
+def sim_grad(snap, total, rec_uncert, proj_acc, tp_pcnt, pre_limit=50,
+             post_limit=10, repro_error=0, max_iter=100):
+    """
+    Replay grad_sel_pregcp and grad_sel_postgcp on snapshot arrays
+
+    Input: snap - dict of tie_values() arrays
+            total - tie points after alignment
+            rec_uncert, proj_acc, tp_pcnt, repro_error - as in MSProc
+            pre_limit, post_limit - % selectable per pass (50 / 10)
+            max_iter - reprojection error passes at most
+    Output: dict of the values used and the remaining points
+
+    The errors are not re-estimated as optimizeCameras would, so the
+        reprojection error passes stop when a pass removes no points.
+    """
+    keep = snap['valid'].copy()
+    for name in ('rec_uncert', 'proj_acc', 'repro_error'):
+        keep &= np.isfinite(snap[name])
+    out = {}
+    for name, start, step, limit in (('rec_uncert', rec_uncert, -1,
+                                      pre_limit),
+                                     ('proj_acc', proj_acc, -0.1,
+                                      pre_limit)):
+        values = np.sort(snap[name][keep])
+        reach, used, _ = sim_iterate(values, total, tp_pcnt, start, step,
+                                     limit)
+        out[name] = used
+        if not reach:
+            keep &= snap[name] <= used
+    used = repro_error
+    passes = 0
+    while passes < max_iter:
+        values = np.sort(snap['repro_error'][keep])
+        reach, used, sel = sim_iterate(values, total, tp_pcnt, used, -0.01,
+                                       post_limit)
+        passes += 1
+        if reach or not sel:
+            break
+        keep &= snap['repro_error'] <= used
+    out['repro_error'] = used
+    out['repro_passes'] = passes
+    out['remaining'] = int(keep.sum())
+    out['removed_pcnt'] = 100 * (1 - out['remaining'] / total)
+    return out
+
+
+def read_las(path):
+    """
+    Memory map the point records of an uncompressed LAS file
+
+    Input: path - the LAS file
+    Output: header - bytes of the header and VLRs up to the point data
+            points - numpy memmap of the point records with X, Y, Z fields
+            scale, offset - (3,) arrays to convert X, Y, Z to coordinates
+    """
+    with open(path, 'rb') as las:
+        head = las.read(375)
+        if head[:4] != b'LASF':
+            raise ValueError(f'{path} is not a LAS file')
+        data_offset = int(np.frombuffer(head, '<u4', 1, 96)[0])
+        las.seek(0)
+        header = las.read(data_offset)
+    rec_len = int(np.frombuffer(head, '<u2', 1, 105)[0])
+    if head[25] >= 4:
+        count = int(np.frombuffer(head, '<u8', 1, 247)[0])
+    else:
+        count = int(np.frombuffer(head, '<u4', 1, 107)[0])
+    scale = np.frombuffer(head, '<f8', 3, 131)
+    offset = np.frombuffer(head, '<f8', 3, 155)
+    dtype = np.dtype({'names': ['X', 'Y', 'Z'],
+                      'formats': ['<i4'] * 3,
+                      'offsets': [0, 4, 8],
+                      'itemsize': rec_len})
+    points = np.memmap(path, dtype=dtype, mode='r', offset=data_offset,
+                       shape=(count,))
+    return header, points, scale, offset
+
+
+def las_tiles(points, scale, offset, voxel, folder, block=5000000):
+    """
+    Spill LAS point records into files of square XY tiles of whole voxels
+
+    Input: points - numpy memmap of the point records from read_las()
+            scale, offset - (3,) arrays from read_las()
+            voxel - voxel size in coordinate units
+            folder - folder for the tile files (created, the caller
+                removes it)
+            block - number of points read at a time
+    Output: generator of the tile file paths, each holding the raw records
+        of all points of its voxels, read one at a time by the caller
+
+    The tile edge is a whole number of voxels chosen so a tile holds about
+        block points if the points are evenly spread, the tile follows from
+        the integer voxel index so no voxel is split between tiles.
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    raw = points.view(np.dtype((np.void, points.dtype.itemsize)))
+    lows = np.array([np.inf, np.inf])
+    highs = -lows
+    for start in range(0, len(points), block):
+        window = points[start:start + block]
+        for i, axis in enumerate('XY'):
+            lows[i] = min(lows[i], window[axis].min())
+            highs[i] = max(highs[i], window[axis].max())
+    n_tiles = max(1, -(-len(points) // block))
+    extent = (highs - lows) * scale[:2]
+    edge = max(np.sqrt(np.prod(extent) / n_tiles), extent.max() / n_tiles)
+    per_tile = max(1, int(np.ceil(edge / voxel)))
+    names = set()
+    for start in range(0, len(points), block):
+        window = points[start:start + block]
+        cells = np.column_stack([np.floor((window[a] * scale[i] + offset[i])
+                                          / voxel).astype(np.int64)
+                                 for i, a in enumerate('XY')])
+        tiles, inverse = np.unique(cells // per_tile, axis=0,
+                                   return_inverse=True)
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[order], np.arange(len(tiles) + 1))
+        records = raw[start:start + block][order]
+        for j, (tx, ty) in enumerate(tiles):
+            name = folder / f'{tx}_{ty}.bin'
+            names.add(name)
+            with open(name, 'ab') as tile:
+                tile.write(records[bounds[j]:bounds[j + 1]].tobytes())
+    for name in sorted(names):
+        yield name
+
+
+def las_header(header, count, low, high):
+    """
+    Update the point count and bounds of a LAS header from read_las()
+
+    Input: header - header bytes
+            count - number of point records
+            low, high - (3,) arrays of the minimum and maximum coordinates
+    Output: new header bytes
+    """
+    head = bytearray(header)
+    legacy = count if head[104] < 6 and count < 2 ** 32 else 0
+    head[107:111] = np.array([legacy], '<u4').tobytes()
+    head[111:131] = np.array([legacy, 0, 0, 0, 0], '<u4').tobytes()
+    bounds = [high[0], low[0], high[1], low[1], high[2], low[2]]
+    head[179:227] = np.array(bounds, '<f8').tobytes()
+    if head[25] >= 4 and len(head) >= 375:
+        # no extended VLRs are copied
+        head[235:247] = bytes(12)
+        head[247:255] = np.array([count], '<u8').tobytes()
+        head[255:375] = np.array([count] + [0] * 14, '<u8').tobytes()
+    return bytes(head)
+
+
+def tiff_layout(path, compressed=False):
+    """
+    Read the layout of an uncompressed TIFF or BigTIFF for memory mapping
+
+    Input: path - the TIFF file
+            compressed - boolean (also read compressed files, e.g. for
+                tiff_decompress(), otherwise they raise a ValueError)
+    Output: dict with width, height, bands, dtype, nodata (or None),
+        tiled, tile (rows, cols), offsets and byte counts of the strips or
+        tiles, compression and predictor
+    """
+    sizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8,
+             11: 4, 12: 8, 16: 8, 17: 8, 18: 8}
+    codes = {1: 'u1', 2: 'S1', 3: 'u2', 4: 'u4', 5: 'u4', 6: 'i1', 7: 'u1',
+             8: 'i2', 9: 'i4', 10: 'i4', 11: 'f4', 12: 'f8', 16: 'u8',
+             17: 'i8', 18: 'u8'}
+    tags = {}
+    with open(path, 'rb') as tif:
+        head = tif.read(16)
+        order = {b'II': '<', b'MM': '>'}[head[:2]]
+        big = np.frombuffer(head, order + 'u2', 1, 2)[0] == 43
+        if big:
+            tif.seek(int(np.frombuffer(head, order + 'u8', 1, 8)[0]))
+            count = int(np.frombuffer(tif.read(8), order + 'u8')[0])
+            entry, inline = 20, 8
+        else:
+            tif.seek(int(np.frombuffer(head, order + 'u4', 1, 4)[0]))
+            count = int(np.frombuffer(tif.read(2), order + 'u2')[0])
+            entry, inline = 12, 4
+        entries = tif.read(count * entry)
+        for i in range(count):
+            raw = entries[i * entry:(i + 1) * entry]
+            tag, kind = np.frombuffer(raw, order + 'u2', 2)
+            num = int(np.frombuffer(raw, order + ('u8' if big else 'u4'),
+                                    1, 4 if big else 4)[0])
+            nbytes = num * sizes.get(int(kind), 1)
+            value = raw[entry - inline:]
+            if nbytes > inline:
+                tif.seek(int(np.frombuffer(value, order
+                                           + ('u8' if big else 'u4'))[0]))
+                value = tif.read(nbytes)
+            if int(kind) == 2:
+                tags[int(tag)] = value[:nbytes].rstrip(b'\x00').decode()
+            else:
+                tags[int(tag)] = np.frombuffer(value[:nbytes], order
+                                               + codes[int(kind)])
+    if tags.get(259, [1])[0] != 1 and not compressed:
+        raise ValueError(f'{path} is compressed, export it uncompressed '
+                         '(self.raw_tiff) to memory map it')
+    bands = int(tags.get(277, [1])[0])
+    if bands > 1 and tags.get(284, [1])[0] != 1:
+        raise ValueError(f'{path} is not pixel interleaved')
+    bits = int(tags[258][0])
+    kind = {1: 'u', 2: 'i', 3: 'f'}[int(tags.get(339, [1])[0])]
+    tiled = 324 in tags
+    height, width = int(tags[257][0]), int(tags[256][0])
+    if tiled:
+        tile = (int(tags[323][0]), int(tags[322][0]))
+    else:
+        tile = (int(tags.get(278, [height])[0]), width)
+    nodata = tags.get(42113)
+    return {'width': width,
+            'height': height,
+            'bands': bands,
+            'dtype': np.dtype(f'{order}{kind}{bits // 8}'),
+            'nodata': float(nodata) if nodata else None,
+            'tiled': tiled,
+            'tile': tile,
+            'offsets': (tags[324] if tiled else tags[273]).astype(np.int64),
+            'counts': (tags[325] if tiled else tags[279]).astype(np.int64),
+            'compression': int(tags.get(259, [1])[0]),
+            'predictor': int(tags.get(317, [1])[0]),
+            }
+
+
+def lzw_decode(data):
+    """
+    Decode a TIFF LZW strip or tile (MSB first codes, early change)
+
+    Input: data - compressed bytes
+    Output: decoded bytes
+    """
+    out = bytearray()
+    table = [bytes([i]) for i in range(256)] + [b'', b'']
+    bits, pos, end, prev = 9, 0, len(data) * 8, None
+    data = bytes(data) + b'\x00\x00\x00'
+    while pos + bits <= end:
+        word = int.from_bytes(data[pos >> 3:(pos >> 3) + 3], 'big')
+        code = (word >> (24 - (pos & 7) - bits)) & ((1 << bits) - 1)
+        pos += bits
+        if code == 257:
+            break
+        if code == 256:
+            del table[258:]
+            bits, prev = 9, None
+            continue
+        if prev is None:
+            entry = table[code]
+        else:
+            entry = table[code] if code < len(table) else prev + prev[:1]
+            table.append(prev + entry[:1])
+        out += entry
+        prev = entry
+        if len(table) + 1 >= 1 << bits and bits < 12:
+            bits += 1
+    return bytes(out)
+
+
+def packbits_decode(data):
+    """
+    Decode a TIFF PackBits strip or tile
+
+    Input: data - compressed bytes
+    Output: decoded bytes
+    """
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        n = data[i] - 256 if data[i] > 127 else data[i]
+        if n >= 0:
+            out += data[i + 1:i + n + 2]
+            i += n + 2
+        elif n != -128:
+            out += data[i + 1:i + 2] * (1 - n)
+            i += 2
+        else:
+            i += 1
+    return bytes(out)
+
+
+def tiff_decompress(path, out):
+    """
+    Write an uncompressed copy of a compressed TIFF one strip or tile at a
+        time, so it can be memory mapped
+
+    Input: path - the compressed TIFF (LZW, Deflate or PackBits, with or
+                without horizontal / floating point predictor)
+            out - the uncompressed BigTIFF written with tiff_create()
+    Output: layout of out from tiff_layout()
+    """
+    layout = tiff_layout(path, compressed=True)
+    decoders = {1: bytes, 5: lzw_decode, 8: zlib.decompress,
+                32946: zlib.decompress, 32773: packbits_decode}
+    if layout['compression'] not in decoders:
+        raise ValueError(f'{path} uses TIFF compression '
+                         f'{layout["compression"]}, which cannot be read')
+    height, width = layout['height'], layout['width']
+    bands, dtype = layout['bands'], layout['dtype']
+    t_rows, t_cols = layout['tile']
+    per_row = -(-width // t_cols)
+    raster = tiff_create(out, width, height, dtype, bands,
+                         nodata=layout['nodata'])
+    if bands == 1:
+        raster = raster[..., None]
+    with open(path, 'rb') as tif:
+        for i, (offset, nbytes) in enumerate(zip(layout['offsets'],
+                                                 layout['counts'])):
+            r0, c0 = divmod(i, per_row)
+            r0, c0 = r0 * t_rows, c0 * t_cols
+            if r0 >= height:
+                break
+            rows = t_rows if layout['tiled'] else min(t_rows, height - r0)
+            tif.seek(int(offset))
+            data = decoders[layout['compression']](tif.read(int(nbytes)))
+            need = rows * t_cols * bands * dtype.itemsize
+            data = data[:need].ljust(need, b'\x00')
+            if layout['predictor'] == 3:
+                # byte planes, most significant first, differenced per row
+                planes = np.cumsum(np.frombuffer(data, np.uint8)
+                                   .reshape(rows, -1), axis=1,
+                                   dtype=np.uint8)
+                tile = planes.reshape(rows, dtype.itemsize, -1) \
+                    .transpose(0, 2, 1).copy() \
+                    .view(dtype.newbyteorder('>')).astype(dtype)
+            else:
+                tile = np.frombuffer(data, dtype)
+                if layout['predictor'] == 2:
+                    tile = np.cumsum(tile.reshape(rows, t_cols, bands),
+                                     axis=1, dtype=dtype)
+            tile = tile.reshape(rows, t_cols, bands)
+            r1, c1 = min(r0 + rows, height), min(c0 + t_cols, width)
+            raster[r0:r1, c0:c1] = tile[:r1 - r0, :c1 - c0]
+    raster.flush()
+    del raster
+    return tiff_layout(out)
+
+
+def tiff_window(path, layout, row0, row1, col0=0, col1=None):
+    """
+    Read a window of a TIFF described by tiff_layout() through a memmap
+
+    Input: path - the TIFF file
+            layout - dict from tiff_layout()
+            row0, row1, col0, col1 - window rows and columns (end excluded)
+    Output: (rows, cols) array, or (rows, cols, bands) for several bands
+    """
+    if col1 is None:
+        col1 = layout['width']
+    bands, dtype = layout['bands'], layout['dtype']
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    t_rows, t_cols = layout['tile']
+    per_row = -(-layout['width'] // t_cols)
+    out = np.empty((row1 - row0, col1 - col0, bands), dtype=dtype)
+    for t_row in range(row0 // t_rows, -(-row1 // t_rows)):
+        for t_col in range(col0 // t_cols, -(-col1 // t_cols)):
+            offset = layout['offsets'][t_row * per_row + t_col]
+            # the last strip can be short
+            rows = min(t_rows, layout['height'] - t_row * t_rows) \
+                if not layout['tiled'] else t_rows
+            nbytes = rows * t_cols * bands * dtype.itemsize
+            tile = data[offset:offset + nbytes].view(dtype) \
+                .reshape(rows, t_cols, bands)
+            r0, c0 = t_row * t_rows, t_col * t_cols
+            rs = slice(max(row0, r0), min(row1, r0 + rows))
+            cs = slice(max(col0, c0), min(col1, c0 + t_cols))
+            out[rs.start - row0:rs.stop - row0,
+                cs.start - col0:cs.stop - col0] = \
+                tile[rs.start - r0:rs.stop - r0, cs.start - c0:cs.stop - c0]
+    del data
+    return out[..., 0] if bands == 1 else out
+
+
+def read_world(path):
+    """
+    Read the world file (.tfw) of a raster
+
+    Input: path - the raster file
+    Output: (x size, y size, x, y) of the pixel size and the centre of the
+        upper left pixel, rotation terms are ignored
+    """
+    world = Path(path).with_suffix('.tfw')
+    a, _, _, e, c, f = [float(v) for v in
+                        world.read_text().split()[:6]]
+    return a, e, c, f
+
+
+def tiff_create(path, width, height, dtype=np.float32, bands=1,
+                nodata=None):
+    """
+    Create an uncompressed BigTIFF and memory map its pixels for writing
+
+    Input: path - the TIFF file
+            width, height - raster size
+            dtype - numpy data type of the pixels
+            bands - number of bands (pixel interleaved)
+            nodata - value written to the GDAL nodata tag
+    Output: numpy memmap of shape (height, width) or (height, width, bands)
+    """
+    dtype = np.dtype(dtype).newbyteorder('<')
+    row_bytes = width * bands * dtype.itemsize
+    codes = {3: '<u2', 16: '<u8'}
+    entries = [(256, 16, [width]),
+               (257, 16, [height]),
+               (258, 3, [dtype.itemsize * 8] * bands),
+               (259, 3, [1]),
+               (262, 3, [2 if bands >= 3 else 1]),
+               (273, 16, [0] * height),
+               (277, 3, [bands]),
+               (278, 16, [1]),
+               (279, 16, [row_bytes] * height),
+               (284, 3, [1]),
+               (339, 3, [{'u': 1, 'i': 2, 'f': 3}[dtype.kind]] * bands),
+               ]
+    if bands in (2, 4):
+        entries.append((338, 3, [2]))
+    if nodata is not None:
+        entries.append((42113, 2, str(nodata)))
+    entries.sort()
+
+    def payload(kind, values):
+        if kind == 2:
+            return values.encode('ascii') + b'\x00'
+        return np.array(values, codes[kind]).tobytes()
+    ifd_end = 16 + 8 + 20 * len(entries) + 8
+    extra = sum(len(payload(k, v)) for _, k, v in entries
+                if len(payload(k, v)) > 8)
+    data_start = -(-(ifd_end + extra) // 16) * 16
+    entries = [(t, k, list(data_start + np.arange(height, dtype=np.int64)
+                           * row_bytes) if t == 273 else v)
+               for t, k, v in entries]
+    ifd = [np.array([len(entries)], '<u8').tobytes()]
+    blobs, blob_at = [], ifd_end
+    for tag, kind, values in entries:
+        data = payload(kind, values)
+        count = len(data) if kind == 2 else len(values)
+        ifd.append(np.array([tag, kind], '<u2').tobytes()
+                   + np.array([count], '<u8').tobytes())
+        if len(data) > 8:
+            ifd.append(np.array([blob_at], '<u8').tobytes())
+            blobs.append(data)
+            blob_at += len(data)
+        else:
+            ifd.append(data.ljust(8, b'\x00'))
+    ifd.append(bytes(8))
+    with open(path, 'wb') as tif:
+        tif.write(b'II' + np.array([43, 8, 0], '<u2').tobytes()
+                  + np.array([16], '<u8').tobytes())
+        tif.write(b''.join(ifd + blobs))
+        tif.truncate(data_start + height * row_bytes)
+    shape = (height, width) if bands == 1 else (height, width, bands)
+    return np.memmap(path, dtype=dtype, mode='r+', offset=data_start,
+                     shape=shape)
+
+
+def write_world(path, x_size, y_size, x, y):
+    """
+    Write the world file (.tfw) of a raster
+
+    Input: path - the raster file
+            x_size, y_size - pixel size (y_size negative for north up)
+            x, y - centre of the upper left pixel
+    """
+    Path(path).with_suffix('.tfw').write_text(
+        f'{x_size}\n0\n0\n{y_size}\n{x}\n{y}\n')
+
+
+# reference transforms for MSProc.transform_references
+# Each takes the (N, 3) reference locations, the (N, 3) yaw/pitch/roll and
+# the chunk CRS and returns the new (N, 3) locations.
+def ref_offset(dx=0, dy=0, dz=0):
+    """Constant offset, e.g. an altitude correction"""
+    def transform(xyz, ypr, crs):
+        return xyz + np.array([dx, dy, dz], dtype=float)
+    transform.label = f'offset ({dx}, {dy}, {dz})'
+    return transform
+
+
+def ref_scale(sx=1, sy=1, sz=1):
+    """Scale each axis, e.g. sz=-1 to reverse the altitude"""
+    def transform(xyz, ypr, crs):
+        return xyz * np.array([sx, sy, sz], dtype=float)
+    transform.label = f'scale ({sx}, {sy}, {sz})'
+    return transform
+
+
+def ref_geoid(separation):
+    """
+    Geoid (orthometric) to ellipsoid height: h = H + N
+
+    Input: separation - geoid undulation N in metres, either one value or
+        an array with one value per camera reference
+    """
+    def transform(xyz, ypr, crs):
+        out = xyz.copy()
+        out[:, 2] += separation
+        return out
+    transform.label = 'geoid to ellipsoid'
+    return transform
+
+
+def ref_lever_arm(offset):
+    """
+    Antenna to camera lever arm
+
+    Input: offset - (x right, y forward, z up) offset in metres from the
+        antenna to the camera in the body frame. It is rotated by the
+        reference yaw, pitch and roll (0 where not set). For geographic
+        CRS the horizontal offset is converted to degrees.
+    """
+    def transform(xyz, ypr, crs):
+        yaw, pitch, roll = np.radians(np.nan_to_num(ypr)).T
+        x, y, z = offset
+        # roll about the forward axis, then pitch about the right axis
+        x, z = (x * np.cos(roll) + z * np.sin(roll),
+                -x * np.sin(roll) + z * np.cos(roll))
+        y, z = (y * np.cos(pitch) - z * np.sin(pitch),
+                y * np.sin(pitch) + z * np.cos(pitch))
+        # yaw clockwise from north
+        east = x * np.cos(yaw) + y * np.sin(yaw)
+        north = -x * np.sin(yaw) + y * np.cos(yaw)
+        out = xyz.copy()
+        if is_geographic(crs):
+            radius = 6378137.0
+            out[:, 0] += np.degrees(east / (radius
+                                            * np.cos(np.radians(xyz[:, 1]))))
+            out[:, 1] += np.degrees(north / radius)
+        else:
+            out[:, 0] += east
+            out[:, 1] += north
+        out[:, 2] += z
+        return out
+    transform.label = f'lever arm {tuple(offset)}'
+    return transform
+
+
+def ref_reproject(source, target):
+    """
+    Reproject the references between two Metashape.CoordinateSystem, e.g.
+    to change the chunk CRS without losing the camera references.
+    Metashape transforms point by point, the other steps are vectorised.
+    """
+    def transform(xyz, ypr, crs):
+        return np.array([list(Metashape.CoordinateSystem.transform(
+            Metashape.Vector(p), source, target)) for p in xyz.tolist()],
+            dtype=float).reshape(-1, 3)
+    transform.label = f'reproject {source} to {target}'
+    return transform
+
+
+class MSProc(object):
+    """
+    Create an object of type Metashape.app.document.
+    Create menu items to process all or part of the Metashape workflow.
+
+    The object methods iterate through the chunks in the document and process
+        each in turn.
+    """
+
+    def __init__(self,
+                 doc,
+                 *,
+                 min_qual=0.5,
+                 filtering=Metashape.ModerateFiltering,
+                 rec_uncert=10,
+                 proj_acc=2,
+                 tp_pcnt=0.2,
+                 match_acc=1,
+                 depth_qual=2,
+                 ):
+        """
+        Initialise the object
+
+        Parameters: The current Metashape document
+                    The minimum acceptable picture quality
+                    The filter method
+                    The reconstruction uncertainty
+                    The projection accuracy starting point
+                    The percentage of points to aim for in gradual selection
+                    The image matching accuracy
+                    The depth map quality
+        User Input: The output path for the export products
+                    The filename prefix for export products
+                    The filename will consist of the prefix, the name of
+                        the chunk and the type, (LAS, JPG, TIFF,
+                                                    DEM, Ortho etc.)
+                        If the input is JPG the ortho output will be PNG,
+                        otherwise the ortho will be TIFF.
+
+        """
+        self.export_path = Path(Metashape
+                                .app
+                                .getExistingDirectory('Specify DSM/Ortho/Model'
+                                                      ' export folder:'
+                                                      )
+                                )
+        # set output file prefix
+        self.prefix = Metashape.app.getString(label='Enter file prefix: ',
+                                              value=''
+                                              )
+        self.doc = doc
+        # convert metashape document type to Path
+        self.doc_path = Path(str(self.doc)
+                             .replace("<Document '", '').replace("'>", '')
+                             )
+        print(self.doc_path)
+        self.min_qual = min_qual
+        self.filtering = filtering
+        self.rec_uncert = rec_uncert
+        self.proj_acc = proj_acc
+        self.tp_pcnt = tp_pcnt
+        self.match_dict = {0: 'Highest',
+                           1: 'High',
+                           2: 'Medium',
+                           4: 'Low',
+                           8: 'Lowest'}
+        self.depth_dict = {1: 'Ultra',
+                           2: 'High',
+                           4: 'Medium',
+                           8: 'Low',
+                           16: 'Lowest'}
+        if match_acc in self.match_dict:
+            self.match_acc = match_acc
+        else:
+            raise ValueError('Unknown Metashape matching accuracy value '
+                             '(Highest=0 High=1 Medium=2 Low=4 Lowest=8).'
+                             )
+        if depth_qual in self.depth_dict:
+            self.depth_qual = depth_qual
+        else:
+            raise ValueError('Unknown Metashape depth map quality value '
+                             '(Ultra=1 High=2 Medium=4 Low=8 Lowest=16).'
+                             )
+        self.total_points = {}
+        self.ref_snapshots = {}
+        self.tile_groups = {}
+        self.target_res = 0
+        self.depth_plan = {}
+        self.keep_depth = False
+        self.min_conf = 0
+        self.tie_snapshots = False
+        # gradual selection: 'steps' (iterative) or 'combined' (one pass)
+        self.grad_mode = 'steps'
+        self.trial_match = False
+        # keypoints grow the project, only kept for incremental alignment
+        self.keep_keypoints = False
+        # run even if the rough size estimate exceeds the free space
+        self.preflight_force = False
+        self.exp_crs = 0
+        self.runtime = timedelta(0)
+        if not self.doc.chunks:
+            raise MSChunckCheck
+        self.chunks = self.doc.chunks
+        self.load_baseline()
+        # set logfile name to follow progress
+        docname = self.doc_path.stem
+        self.log = (self.export_path / f'{docname}'
+                    f'_log_{datetime.now().strftime("%Y-%m-%d %H-%M")}.txt'
+                    )
+        print(f'Log file to check progress: {self.log}')
+        # manifest of the exported files
+        self.manifest = self.export_path / f'{docname}_manifest.json'
+        self.lods = []
+        self.lod_voxels = []
+        # export formats
+        self.pc_dict = {'las': Metashape.PointCloudFormatLAS,
+                        'laz': Metashape.PointCloudFormatLAZ}
+        self.mesh_dict = {'obj': Metashape.ModelFormatOBJ,
+                          'ply': Metashape.ModelFormatPLY,
+                          'glb': Metashape.ModelFormatGLTF}
+        self.tex_dict = {'jpg': Metashape.ImageFormatJPEG,
+                         'png': Metashape.ImageFormatPNG,
+                         'tif': Metashape.ImageFormatTIFF}
+        self.pc_format = 'las'
+        self.mesh_format = 'obj'
+        self.tex_format = ''
+        self.web_tiles = False
+        # uncompressed BigTIFF rasters can be memory mapped for QA
+        self.raw_tiff = False
+        self.dsm_qa = False
+        # reference DSM (path or dict of chunk label: path) differenced
+        #    against the new DSM after export_geo
+        self.ref_dsm = None
+        # run history shared by all projects for ETA predictions
+        self.history = Path.home() / '.msproc' / 'run_history.sqlite'
+        self.eta_plan = []
+        # progress of the current Metashape call for monitoring
+        self.status_file = self.export_path / f'{docname}_status.json'
+        self.stage = ''
+        self.stage_chunk = ''
+        # per-stage peak memory: lifetime peak at the stage start where it
+        #    cannot be reset and the peak RSS sampled by monitor()
+        self.peak_base = reset_peak_memory()
+        self.stage_peak = None
+        # resource monitor (seconds between /proc samples)
+        self.monitor_interval = 5
+        self.monitor_file = self.export_path / f'{docname}_resources.csv'
+        self.monitor_stop = threading.Event()
+        self.monitor_thread = None
+        # writes tie point snapshots without stalling the selection
+        self.snap_pool = ThreadPoolExecutor(max_workers=1)
+        self.snap_futures = []
+
+    def info(self):
+        """
+        Output the current attributes of the object
+        """
+        print('Processing menu items')
+        print(f'The current export path is: {str(self.export_path)}')
+        print(f'The current file name prefix is: {self.prefix}')
+        print('The current minimum acceptable image quality is: '
+              f'{self.min_qual}'
+              )
+        print(f'The current filtering method is: {self.filtering}')
+        print(f'The current projection accuracy is: {self.proj_acc}')
+        print(f'The current reconstruction accuracy is: {self.rec_uncert}')
+        print('The current export CRS (EPSG Number) is [0 = project CRS]: '
+              f'{self.exp_crs}'
+              )
+        print('The current minimum point confidence is [0 = no filtering]: '
+              f'{self.min_conf}'
+              )
+        print('Tie point snapshots in gradual selection: '
+              f'{self.tie_snapshots}'
+              )
+        print(f'The current gradual selection mode is: {self.grad_mode}')
+        print('The current LAS level of detail ratios / voxel sizes are: '
+              f'{self.lods} / {self.lod_voxels}'
+              )
+        print('The current point cloud / mesh / texture export formats are '
+              '[texture blank = JPG for JPG input, otherwise TIF]: '
+              f'{self.pc_format} / {self.mesh_format} / {self.tex_format}'
+              )
+        print(f'Web map tiles exported with export_geo: {self.web_tiles}')
+        print(f'Uncompressed TIFF export: {self.raw_tiff}')
+        print(f'DSM QA statistics with export_geo: {self.dsm_qa}')
+        print(f'Reference DSM differenced after export_geo: {self.ref_dsm}')
+        print(f'The current run history database is: {self.history}')
+        print('The current resource monitor interval (s) is: '
+              f'{self.monitor_interval}'
+              )
+        print('Run despite the preflight space estimate: '
+              f'{self.preflight_force}'
+              )
+        print('Accuracy menu items')
+        print('The current matching accuracy is: '
+              f'{self.match_dict[self.match_acc]}'
+              )
+        print('The current depth map quality is: '
+              f'{self.depth_dict[self.depth_qual]}'
+              )
+        print('The current target DSM/ortho resolution (m) is [0 = use '
+              f'depth map quality]: {self.target_res}'
+              )
+        print('Keypoint limits calibrated with a trial match: '
+              f'{self.trial_match}'
+              )
+        print('Keypoints kept for incremental alignment: '
+              f'{self.keep_keypoints}'
+              )
+
+    def change_pre(self):
+        """Change the export file prefix"""
+        self.prefix = Metashape.app.getString(label='Enter file prefix: ',
+                                              value=''
+                                              )
+
+    def run_custom(self):
+        """
+        Change the object attributes for:
+                    The minimum acceptable picture quality
+                    The filter method
+                    The projection accuracy
+                    The reconstruction uncertainty
+                    The export CRS
+                    The minimum point confidence
+                    The tie point snapshots
+                    The gradual selection mode
+        """
+        min_qual = Metashape.app.getFloat(label='Enter picture quality '
+                                                'threshold',
+                                          value=0.5
+                                          )
+        filtering = Metashape.app.getString(label=('Enter filtering mode '
+                                                   '(None, Mild, Moderate, '
+                                                   'Aggressive)'
+                                                   ),
+                                            value='Mild'
+                                            )
+        if filtering.lower() == 'mild':
+            filtering = Metashape.MildFiltering
+        elif filtering.lower() == 'moderate':
+            filtering = Metashape.ModerateFiltering
+        elif filtering.lower() == 'aggressive':
+            filtering = Metashape.AggressiveFiltering
+        elif filtering.lower() == 'none':
+            filtering = Metashape.NoFiltering
+        rec_uncert = Metashape.app.getFloat(label='Enter Reconstruction '
+                                                  'Uncertainty',
+                                            value=10
+                                            )
+        proj_acc = Metashape.app.getFloat(label='Enter Projection Accuracy',
+                                          value=2)
+        crs = Metashape.app.getInt(label=('Enter export CRS if different '
+                                          'from project CRS (EPSG Number)'),
+                                   value=0
+                                   )
+        min_conf = Metashape.app.getInt(label=('Enter minimum point '
+                                               'confidence (0 = no '
+                                               'filtering)'),
+                                        value=0
+                                        )
+        snapshots = Metashape.app.getBool(
+            label='Save tie point snapshots in gradual selection?')
+        grad_mode = Metashape.app.getString(label=('Enter gradual selection '
+                                                   'mode (steps, combined)'),
+                                            value=self.grad_mode
+                                            ).lower()
+        if grad_mode not in ('steps', 'combined'):
+            raise ValueError('Unknown gradual selection mode '
+                             '(steps, combined).')
+        # initiate object
+        self.min_qual = min_qual
+        self.filtering = filtering
+        self.proj_acc = proj_acc
+        self.rec_uncert = rec_uncert
+        self.exp_crs = crs
+        self.min_conf = min_conf
+        self.tie_snapshots = snapshots
+        self.grad_mode = grad_mode
+
+    def run_qual_adjust(self):
+        """
+        Change the object attributes for:
+                    The matching accuracy
+                    The depth map quality
+                    The target DSM/ortho resolution
+                    The trial match for keypoint limits
+        """
+        match_acc = Metashape.app.getInt(label='Enter image matching accuracy '
+                                               '(Highest=0 High=1 Medium=2 '
+                                               'Low=4 Lowest=8)',
+                                         value=1,
+                                         )
+        if match_acc in self.match_dict:
+            self.match_acc = match_acc
+        else:
+            raise ValueError('Unknown Metashape matching accuracy value '
+                             '(Highest=0 High=1 Medium=2 Low=4 Lowest=8).'
+                             )
+        depth_qual = Metashape.app.getInt(label=('Enter depth map quality '
+                                                 '(Ultra=1 High=2 Medium=4 '
+                                                 'Low=8 Lowest=16)'
+                                                 ),
+                                          value=2,
+                                          )
+        if depth_qual in self.depth_dict:
+            self.depth_qual = depth_qual
+        else:
+            raise ValueError('Unknown Metashape depth map quality value '
+                             '(Ultra=1 High=2 Medium=4 Low=8 Lowest=16).'
+                             )
+        self.target_res = Metashape.app.getFloat(
+            label=('Enter target DSM/ortho resolution in m '
+                   '(0 = use depth map quality)'),
+            value=self.target_res,
+        )
+        self.trial_match = Metashape.app.getBool(
+            label='Calibrate keypoint limits with a trial match?')
+
+    def run_format_adjust(self):
+        """
+        Change the object attributes for:
+                    The point cloud export format
+                    The mesh export format
+                    The texture export format
+        """
+        pc_format = Metashape.app.getString(label=('Enter point cloud export '
+                                                   'format (las, laz)'),
+                                            value=self.pc_format
+                                            ).lower()
+        if pc_format not in self.pc_dict:
+            raise ValueError('Unknown point cloud export format '
+                             '(las, laz).'
+                             )
+        mesh_format = Metashape.app.getString(label=('Enter mesh export '
+                                                     'format (obj, ply, '
+                                                     'glb)'),
+                                              value=self.mesh_format
+                                              ).lower()
+        if mesh_format not in self.mesh_dict:
+            raise ValueError('Unknown mesh export format (obj, ply, glb).')
+        tex_format = Metashape.app.getString(label=('Enter texture export '
+                                                    'format (jpg, png, tif, '
+                                                    'blank = same as input)'),
+                                             value=self.tex_format
+                                             ).lower()
+        if tex_format and tex_format not in self.tex_dict:
+            raise ValueError('Unknown texture export format '
+                             '(jpg, png, tif).'
+                             )
+        self.pc_format = pc_format
+        self.mesh_format = mesh_format
+        self.tex_format = tex_format
+
+    def reverse_altitude(self):
+        """
+        Reverse the sign of the camera altitudes in the Reference pane
+        (DJI "below sea level" issue)
+        """
+        self.transform_references([ref_scale(sz=-1)])
+
+    def ref_offset_menu(self):
+        """Offset the camera reference altitudes by a user-defined value"""
+        dz = Metashape.app.getFloat(label='Enter altitude offset (m)',
+                                    value=0
+                                    )
+        self.transform_references([ref_offset(dz=dz)])
+
+    @staticmethod
+    def read_references(chunk):
+        """
+        Read the camera references of a chunk into arrays
+
+        Input: chunk - the chunk to be read
+        Output: cameras - list of cameras with a reference location
+                xyz - (N, 3) array of reference locations
+                ypr - (N, 3) array of reference rotations (yaw, pitch,
+                    roll), NaN where no rotation is set
+        """
+        cameras = [c for c in chunk.cameras if c.reference.location]
+        xyz = np.array([list(c.reference.location) for c in cameras],
+                       dtype=float).reshape(-1, 3)
+        ypr = np.array([list(c.reference.rotation)
+                        if c.reference.rotation else [np.nan] * 3
+                        for c in cameras],
+                       dtype=float).reshape(-1, 3)
+        return cameras, xyz, ypr
+
+    def transform_references(self, transforms, *, dry_run=False, chunks=None):
+        """
+        Apply a chain of reference transforms to all camera references
+
+        Parameters: transforms=list of transforms (ref_offset, ref_scale,
+                        ref_geoid, ref_lever_arm, ref_reproject) applied in
+                        order
+                    dry_run=boolean (only report the change statistics)
+                    chunks=list of chunks (optional, default all chunks)
+        Dependencies: read_references(), undo_references() to revert
+
+        The references are read into one array, transformed and written
+            back in a single pass. A snapshot of the original values is
+            kept for undo_references().
+        """
+        if not chunks:
+            chunks = self.chunks
+        labels = ', '.join(t.label for t in transforms)
+        for _ in chunks:
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                start_t = datetime.now()
+                logfile.write(f'Transforming references {_} at '
+                              f'{start_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    Transforms: {labels} \n'
+                              f'    Dry run: {dry_run} \n'
+                              )
+            cameras, xyz, ypr = self.read_references(_)
+            if not cameras:
+                print(f'No camera references in {_}')
+                continue
+            new = xyz.copy()
+            for transform in transforms:
+                new = transform(new, ypr, _.crs)
+            delta = new - xyz
+            stats = (f'    Cameras: {len(cameras)} \n'
+                     '    Change min/mean/max (x, y, z): \n'
+                     f'        {np.round(delta.min(axis=0), 4)} \n'
+                     f'        {np.round(delta.mean(axis=0), 4)} \n'
+                     f'        {np.round(delta.max(axis=0), 4)} \n'
+                     )
+            print(f'Reference change in {_}:\n{stats}')
+            if not dry_run:
+                # snapshot for undo
+                self.ref_snapshots.setdefault(str(_), []).append(
+                    ([c.key for c in cameras], xyz)
+                )
+                for camera, coord in zip(cameras, new.tolist()):
+                    camera.reference.location = Metashape.Vector(coord)
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                end_t = datetime.now()
+                self.runtime += end_t - start_t
+                logfile.write(f'Finished transforming references {_} at '
+                              f'{end_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(stats)
+                logfile.write(f'Processing time: {end_t - start_t} / '
+                              f'Total Time: {self.runtime} \n'
+                              )
+
+    def undo_references(self, *, chunks=None):
+        """
+        Restore the camera references from the last snapshot taken by
+        transform_references()
+
+        Parameter: chunks=list of chunks (optional, default all chunks)
+        """
+        if not chunks:
+            chunks = self.chunks
+        for _ in chunks:
+            snapshots = self.ref_snapshots.get(str(_))
+            if not snapshots:
+                print(f'No reference snapshot to restore in {_}')
+                continue
+            keys, xyz = snapshots.pop()
+            lookup = {c.key: c for c in _.cameras}
+            for key, coord in zip(keys, xyz.tolist()):
+                if key in lookup:
+                    lookup[key].reference.location = Metashape.Vector(coord)
+            print(f'Restored {len(keys)} camera references in {_}')
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                logfile.write(f'Restored {len(keys)} camera references in '
+                              f'{_} at {datetime.now().strftime("%H:%M:%S")}'
+                              ' \n'
+                              )
+
+    def get_quality(self):
+        """
+        Estimate the image quality if not already present
+        """
+        for _ in self.chunks:
+            qual = [i.meta['Image/Quality'] for i in _.cameras]
+            if None in qual:
+                _.analyzeImages(_.cameras)
+
+    def disable_bad_pics(self,
+                         *,
+                         min_qual=None
+                         ):
+        """
+        Disable any images below the threshold
+
+        Parameter: min_qual=number (optional)
+        Dependencies: self.get_quality())
+        """
+        if not min_qual:
+            min_qual = self.min_qual
+        for _ in self.chunks:
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                start_t = datetime.now()
+                logfile.write('Disable pictures (Threshold: '
+                              f'{min_qual}) at '
+                              f'{start_t.strftime("%H:%M:%S")} \n'
+                              )
+            # calculate image quality
+            self.get_quality()
+            # find low quality images
+            selected_cameras = [i for i in _.cameras
+                                if float(i.meta['Image/Quality']) < min_qual
+                                ]
+            for camera in selected_cameras:
+                camera.selected = True
+                camera.enabled = False
+            # report results
+            tot_cams = len(_.cameras)
+            disabled = len(selected_cameras)
+            print(f'{disabled} out of {tot_cams} '
+                  'disabled due to quality issues'
+                  )
+            # warn if more than half of images selected
+            if disabled > tot_cams * 0.5:
+                Metashape.app.messageBox('More than half the images are '
+                                         'disabled, check your image '
+                                         'quality settings.'
+                                         )
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                end_t = datetime.now()
+                self.runtime += end_t - start_t
+                logfile.write('Finished disabling pictures at '
+                              f'{end_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    Threshold used: {min_qual} \n ')
+                logfile.write(f'    {disabled} out of {tot_cams} '
+                              'disabled due to quality issues \n'
+                              )
+                logfile.write(f'Processing time: {end_t - start_t} / '
+                              f'Total Time: {self.runtime} \n'
+                              )
+
+    def store_baseline(self, chunk):
+        """
+        Keep the tie points after alignment as gradual selection baseline
+
+        Input: chunk - the aligned chunk
+        Stores the valid tie points and all tracks in self.total_points and
+            the chunk metadata (MSProc/total_points, MSProc/tracks), the
+            document is saved by the caller.
+        """
+        points = len([i for i in chunk.tie_points.points]) \
+            if chunk.tie_points else 0
+        tracks = len(chunk.tie_points.tracks) if chunk.tie_points else 0
+        self.total_points[str(chunk)] = points
+        chunk.meta['MSProc/total_points'] = str(points)
+        chunk.meta['MSProc/tracks'] = str(tracks)
+
+    def load_baseline(self):
+        """
+        Load the gradual selection baselines stored in the chunk metadata
+        """
+        for _ in self.doc.chunks:
+            points = _.meta['MSProc/total_points']
+            if points:
+                self.total_points[str(_)] = int(points)
+                print(f'Tie point baseline {_}: {points} points, '
+                      f'{_.meta["MSProc/tracks"]} tracks')
+
+    def set_baseline(self, *, chunks=None):
+        """
+        Use the current tie points as gradual selection baseline, for
+            chunks aligned outside the script
+
+        Parameters: chunks=list of chunks (default self.chunks)
+        Dependencies: store_baseline()
+        """
+        if chunks is None:
+            chunks = self.chunks
+        for _ in chunks:
+            self.store_baseline(_)
+            print(f'Tie point baseline {_}: {self.total_points[str(_)]}')
+        self.doc.save()
+
+    def iterate_grad(self,
+                     chunk,
+                     ms_filter,
+                     step,
+                     sel_value,
+                     threshold
+                     ):
+        """
+        Helper function to iterate the gradual selection process
+
+        Input: chunk - the chunk to be processed
+                ms_filter - the Metashape.TiePoints.Filter object
+                step - the value to adjust the selection value by each iter
+                sel_value - the value to use in the filter
+                threshold - value used to adjust the sel_value if too many
+                    tie points are selected initially
+        """
+        # variable to control the selection process
+        adjust = 0
+        # report to the calling method that the hard limit is reached
+        limit_reach = False
+        # number of currenty ties at start of grad sel
+        current_ties = len([i for i in chunk.tie_points.points])
+        print(f'Starting ties this run: {current_ties}')
+        # number of overall ties that need to remain
+        hard_limit = self.total_points[str(chunk)] * self.tp_pcnt
+        # max selectable current ties
+        max_ties = current_ties * threshold / 100
+        while True:
+            # apply filter
+            ms_filter.selectPoints(sel_value - adjust)
+            # count selected points
+            sel = len([i for i in chunk.tie_points.points if i.selected])
+            # calculate remaining ties
+            remain_ties = current_ties - sel
+            # work out percentages for output
+            pcent_thisrun = 100 * sel / current_ties
+            print(f'This iter % ties selected: {round(pcent_thisrun, 1)}')
+            print('This iter # ties selected/starting ties: '
+                  f'{sel}/{current_ties}'
+                  )
+            # check filter limits
+            if remain_ties > hard_limit and sel < max_ties:
+                # selected value is ok
+                print(f'Acepted value this iter: {sel_value - adjust}')
+                break
+            elif remain_ties > hard_limit and sel > max_ties:
+                # if more than threshold ties selected change value and
+                # try again
+                adjust += step
+                print(
+                    f'Adjusted by {round(adjust, 2)} to '
+                    f'{round(sel_value - adjust, 2)}'
+                )
+                continue
+            elif remain_ties < hard_limit and sel > max_ties:
+                # if more than threshold ties selected change value and
+                # try again
+                adjust += step
+                print(f'Adjusted by {adjust} to {sel_value - adjust}')
+                continue
+            else:
+                # ensure sufficient ties remain
+                limit_reach = True
+                print('Hard limit reached')
+                break
+        # remove selected ties
+        if not limit_reach:
+            ms_filter.removePoints(sel_value - adjust)
+        return (limit_reach, sel_value - adjust)
+
+    @staticmethod
+    def tie_values(chunk):
+        """
+        Per point gradual selection criteria of the tie points
+
+        Input: chunk - the chunk to be processed
+        Output: dict of float32 arrays, one value per tie point:
+            rec_uncert, proj_acc, repro_error, image_count, valid and
+            coord (N, 3) in internal chunk coordinates
+        """
+        criteria = {'rec_uncert': Metashape.TiePoints.Filter
+                    .ReconstructionUncertainty,
+                    'proj_acc': Metashape.TiePoints.Filter.ProjectionAccuracy,
+                    'repro_error': Metashape.TiePoints.Filter
+                    .ReprojectionError,
+                    'image_count': Metashape.TiePoints.Filter.ImageCount,
+                    }
+        values = {}
+        for name, criterion in criteria.items():
+            f = Metashape.TiePoints.Filter()
+            f.init(chunk, criterion=criterion)
+            values[name] = np.asarray(f.values, dtype=np.float32)
+        points = chunk.tie_points.points
+        values['valid'] = np.array([p.valid for p in points], dtype=bool)
+        values['coord'] = np.array([tuple(p.coord)[:3] for p in points],
+                                   dtype=np.float32).reshape(-1, 3)
+        return values
+
+    def snapshot_ties(self, chunk, step, **info):
+        """
+        Save the tie point criteria of a gradual selection step
+
+        Input: chunk - the chunk to be processed
+                step - label of the step, part of the file name
+                info - values stored with the arrays (e.g. thresholds)
+        Dependencies: tie_values(), file_parts()
+        Output: future of the background write (None if disabled)
+
+        The values are read in the calling thread (Metashape API), the
+            compressed .npz is written by self.snap_pool. The chunk
+            transform is stored to convert coord to geocentric. Failed
+            writes are reported by check_snapshots() at the end of the
+            stage.
+        """
+        if not self.tie_snapshots:
+            return None
+        values = self.tie_values(chunk)
+        values['transform'] = to_array(chunk.transform.matrix) \
+            if chunk.transform.matrix else np.eye(4)
+        for key, value in info.items():
+            values[key] = np.asarray(value)
+        name, num = self.file_parts(chunk)
+        file = self.export_path / f'{self.prefix}{name}_ties_{step}{num}.npz'
+        print(f'Tie point snapshot: {file.name}')
+        future = self.snap_pool.submit(np.savez_compressed, file, **values)
+        self.snap_futures.append((file, future))
+        return future
+
+    def check_snapshots(self):
+        """
+        Wait for the pending tie point snapshots and report failed writes
+
+        Output: list of the snapshot files that could not be written
+        Dependencies: snapshot_ties()
+        """
+        failed = []
+        for file, future in self.snap_futures:
+            error = future.exception()
+            if error is None:
+                continue
+            failed.append(file)
+            print(f'Tie point snapshot {file.name} not written: {error}')
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                logfile.write(f'    Tie point snapshot {file.name} not '
+                              f'written: {error} \n'
+                              )
+        self.snap_futures = []
+        return failed
+
+    def simulate_grad(self,
+                      snapshot,
+                      *,
+                      rec_uncert=(5, 10, 15, 20),
+                      proj_acc=(2, 3, 5, 10),
+                      tp_pcnt=(0.2,),
+                      pre_limit=(50,),
+                      post_limit=(10,),
+                      total=None,
+                      workers=4,
+                      ):
+        """
+        What-if replay of the gradual selection over a parameter grid
+
+        Parameters: snapshot=path of a snapshot_ties() .npz (best the
+                        first, '0_pre', after alignment)
+                    rec_uncert/proj_acc/tp_pcnt=values to combine
+                    pre_limit/post_limit=% selectable per pass (the 50 and
+                        10 of grad_sel_pregcp/grad_sel_postgcp)
+                    total=tie points after alignment (default the valid
+                        points of the snapshot)
+                    workers=threads running the combinations
+        Dependencies: sim_grad(), sim_iterate()
+        Output: list of result dicts, also printed and written to
+            <snapshot>_whatif.csv
+
+        Does not touch the Metashape document. As optimizeCameras is not
+            replayed the reprojection error result is indicative only.
+        """
+        snapshot = Path(snapshot)
+        with np.load(snapshot) as data:
+            snap = {k: data[k] for k in ('valid', 'rec_uncert', 'proj_acc',
+                                         'repro_error')}
+        if total is None:
+            total = int(snap['valid'].sum())
+        grid = [dict(rec_uncert=ru, proj_acc=pa, tp_pcnt=tp, pre_limit=pre,
+                     post_limit=post)
+                for ru in rec_uncert for pa in proj_acc for tp in tp_pcnt
+                for pre in pre_limit for post in post_limit]
+        start_t = time.perf_counter()
+        # threads, Metashape's interpreter can not start worker processes
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            runs = list(pool.map(lambda p: sim_grad(snap, total, **p), grid))
+        rows = [{**p, **r} for p, r in zip(grid, runs)]
+        cols = list(rows[0]) if rows else []
+        lines = [','.join(cols)]
+        lines += [','.join(f'{row[c]:.4g}' if isinstance(row[c], float)
+                           else str(row[c]) for c in cols) for row in rows]
+        file = snapshot.with_name(f'{snapshot.stem}_whatif.csv')
+        file.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+        print('\n'.join(line.replace(',', '\t') for line in lines))
+        print(f'{len(rows)} combinations of {total} tie points in '
+              f'{time.perf_counter() - start_t:.1f} s, file: {file}')
+        return rows
+
+    def grad_sel_pregcp(self,
+                        *,
+                        rec_uncert=None,
+                        proj_acc=None,
+                        adapt=True
+                        ):
+        """
+        Run through a gradual selection process to remove erroneous tie points
+
+        Parameters: rec_uncert=number
+                    proj_acc=number
+                    (all optional)
+        Dependencie: iterate_grad()
+
+        Description: After the align process all tie points have errors
+            attached to them. The values used are a matter of debate. This
+            method will eliminate tie points based on Reconstruction
+            Uncertainty and Projection Accuracy; Reprojection Error is handled
+            separately. Rec Uncert is normally set to 10 and run only once. If
+            the value of 10 selects more than 50% of the tie points the value
+            self-adjusts to less than 50%.
+            Proj acc is set to start at 2 and self adjusts so less
+            than 50% of the tie points left after Rec Uncert are selected.
+        """
+        if not rec_uncert:
+            rec_uncert = self.rec_uncert
+        if not proj_acc:
+            proj_acc = self.proj_acc
+        for _ in self.chunks:
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                start_t = datetime.now()
+                logfile.write(f'Running preGCP gradual selection of {_} at '
+                              f'{start_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    Reconstruction uncertainty: '
+                              f'{rec_uncert} \n'
+                              f'    Adaptive fitting: {adapt} \n'
+                              )
+            # create filter
+            f = Metashape.TiePoints.Filter()
+            try:
+                total_points = self.total_points[str(_)]
+            except KeyError:
+                print(f'A key error occurred in chunk: {_}')
+                print('No tie point baseline: if the chunk was not aligned '
+                      'by the script run ms_doc.set_baseline() in the '
+                      'console first (uses the current tie points)'
+                      )
+                # write log information
+                with open(self.log, 'a+', encoding='utf-8') as logfile:
+                    start_t = datetime.now()
+                    logfile.write(f'***A key error occurred in chunk: {_}***')
+                continue
+            self.snapshot_ties(_, '0_pre')
+            # 1 RecUncert
+            print('Gradual selection - Reconstruction Uncertainty')
+            f.init(_,
+                   criterion=Metashape
+                            .TiePoints
+                            .Filter
+                            .ReconstructionUncertainty
+                   )
+            l_reach, val_rec_uncert = self.iterate_grad(_,
+                                                        f,
+                                                        -1,
+                                                        rec_uncert,
+                                                        50)
+            _.optimizeCameras(adaptive_fitting=adapt)
+            print('Ties remaining after optimisation: '
+                  f'{len([i for i in _.tie_points.points])}'
+                  )
+            self.snapshot_ties(_, '1_rec_uncert', threshold=val_rec_uncert)
+            # 2 ProjAcc
+            print('Gradual selection - Projection Accuracy')
+            f.init(_, criterion=Metashape.TiePoints.Filter.ProjectionAccuracy)
+            l_reach, val_proj_acc = self.iterate_grad(_,
+                                                      f,
+                                                      -0.1,
+                                                      proj_acc,
+                                                      50)
+            _.optimizeCameras(adaptive_fitting=adapt)
+            print('Ties remaining after optimisation: '
+                  f'{len([i for i in _.tie_points.points])}'
+                  )
+            self.snapshot_ties(_, '2_proj_acc', threshold=val_proj_acc)
+            _.meta['MSProc/rec_uncert'] = str(val_rec_uncert)
+            _.meta['MSProc/proj_acc'] = str(val_proj_acc)
+            # write log information
+            removed = total_points - len([i for i in _.tie_points.points])
+            pcent = 100 * removed / total_points
+            self.doc.save()
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                end_t = datetime.now()
+                self.runtime += end_t - start_t
+                logfile.write(f'Finished preGCP gradual selection {_} at '
+                              f'{end_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write('    Reconstruction uncertainty used: '
+                              f'{val_rec_uncert} \n '
+                              '    Projection accuracy value used: '
+                              f'{val_proj_acc} \n'
+                              )
+                logfile.write('    Final points removed (RU, PA & '
+                              f'optimisation): {removed}, '
+                              f'{round(pcent,2)} % \n'
+                              )
+                logfile.write(f'Processing time: {end_t - start_t} / '
+                              f'Total Time: {self.runtime} \n'
+                              )
+            self.check_snapshots()
+            self.record_stage(_, 'grad_sel_pregcp', end_t - start_t,
+                              rec_uncert=val_rec_uncert,
+                              proj_acc=val_proj_acc)
+
+    @staticmethod
+    def solution_state(chunk):
+        """
+        Reprojection RMSE and camera centres of the current alignment
+
+        Input: chunk - the chunk to be processed
+        Output: (RMSE of the tie point reprojection errors in pixels,
+            dict of camera key: centre in metres (chunk units if not
+            referenced))
+        """
+        f = Metashape.TiePoints.Filter()
+        f.init(chunk, criterion=Metashape.TiePoints.Filter.ReprojectionError)
+        values = np.asarray(f.values, dtype=float)
+        values = values[np.isfinite(values)]
+        rmse = float(np.sqrt(np.mean(values ** 2))) if len(values) else 0.0
+        scale = chunk.transform.scale or 1
+        centres = {c.key: np.array(list(c.center)) * scale
+                   for c in chunk.cameras if c.transform}
+        return rmse, centres
+
+    def grad_sel_postgcp(self,
+                         *,
+                         repro_error=0,
+                         adapt=True,
+                         eps=0.01,
+                         shift_eps=0.01,
+                         max_iter=20,
+                         budget=None,
+                         ):
+        """
+        Run through a gradual selection process to remove erroneous tie points
+
+        Parameters: repro_error=number
+                    eps=number (stop when optimising improves the
+                        reprojection RMSE of the remaining points by less
+                        than this fraction...)
+                    shift_eps=number (...and no camera moves more than
+                        this, in metres, None = RMSE only)
+                    max_iter=number (iterations at most)
+                    budget=number (seconds, no new iteration after this)
+        Dependencie: iterate_grad(), solution_state()
+        Description: After the align process all tie points have errors
+            attached to them. The values used are a matter of debate. This
+            method will eliminate tie points based on Reprojection Error.
+            The aim is to select up to a set percentage(default 80)
+            of the initial tie points. The value used is self selecting. The
+            selection process is in steps of ca. 10% and optimisation is run
+            after each step. The steps end early once the optimisation has
+            converged.
+        """
+        for _ in self.chunks:
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                start_t = datetime.now()
+                logfile.write(
+                    f'Running postGCP grad selection of {_} at '
+                    f'{start_t.strftime("%H:%M:%S")} \n'
+                )
+                logfile.write(f'    Aim to reduce to (%): '
+                              f'{self.tp_pcnt * 100} \n'
+                              f'    Adaptive fitting (%): {adapt} \n'
+                              )
+            # filter
+            f = Metashape.TiePoints.Filter()
+            try:
+                total_points = self.total_points[str(_)]
+            except KeyError:
+                print(f'A key error occurred in chunk: {_}')
+                print('No tie point baseline: if the chunk was not aligned '
+                      'by the script run ms_doc.set_baseline() in the '
+                      'console first (uses the current tie points)'
+                      )
+                # write log information
+                with open(self.log, 'a+', encoding='utf-8') as logfile:
+                    start_t = datetime.now()
+                    logfile.write(f'***A key error occurred in chunk: {_}***')
+                continue
+            # ReproError
+            print('Gradual selection - Reprojection Error')
+            f.init(_, criterion=Metashape.TiePoints.Filter.ReprojectionError)
+            l_reach = False
+            val_repro_error = repro_error
+            self.snapshot_ties(_, '3_pre_repro')
+            step = 0
+            rmse, centres = self.solution_state(_)
+            curve = [(0, len(_.tie_points.points), val_repro_error, rmse,
+                      0.0)]
+            reason = 'hard limit reached'
+            while not l_reach:
+                # first run finds the RE that selects ca. 10% that is then
+                #    applied in subsequent iterations
+                l_reach, val_repro_error = self.iterate_grad(_,
+                                                             f,
+                                                             -0.01,
+                                                             val_repro_error,
+                                                             10
+                                                             )
+                # fit of the remaining points before the optimisation
+                rmse = self.solution_state(_)[0]
+                time.sleep(5)
+                _.optimizeCameras(adaptive_fitting=adapt)
+                step += 1
+                self.snapshot_ties(_, f'4_repro_{step:02d}',
+                                   threshold=val_repro_error)
+                # convergence of the camera solution
+                new_rmse, new_centres = self.solution_state(_)
+                shift = max([float(np.linalg.norm(new_centres[k]
+                                                  - centres[k]))
+                             for k in new_centres if k in centres],
+                            default=0.0)
+                gain = (rmse - new_rmse) / rmse if rmse else 0.0
+                rmse, centres = new_rmse, new_centres
+                curve.append((step, len(_.tie_points.points),
+                              val_repro_error, rmse, shift))
+                print(f'Iteration {step}: RMSE {rmse:.4f} px '
+                      f'({100 * gain:.2f} % better by optimisation), max '
+                      f'camera shift {shift:.4f}')
+                if l_reach:
+                    break
+                if gain < eps and (shift_eps is None or shift < shift_eps):
+                    reason = 'converged'
+                    break
+                if step >= max_iter:
+                    reason = 'iteration limit reached'
+                    break
+                if budget and (datetime.now() - start_t).total_seconds() \
+                        > budget:
+                    reason = 'time budget reached'
+                    break
+            _.meta['MSProc/repro_error'] = str(val_repro_error)
+            # write log information
+            removed = total_points - len([i for i in _.tie_points.points])
+            pcent = 100 * removed / total_points
+            self.doc.save()
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                end_t = datetime.now()
+                self.runtime += end_t - start_t
+                logfile.write(f'Finished gradual selection {_} at '
+                              f'{end_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write('    Final Reprojection error used: '
+                              f'{round(val_repro_error,2)} \n'
+                              )
+                logfile.write(f'    Stopped after {step} iterations: '
+                              f'{reason} \n'
+                              '    Convergence (iteration, points, '
+                              'threshold, RMSE px, max camera shift): \n'
+                              )
+                logfile.write(''.join(f'        {i}, {n}, {t:.3f}, '
+                                      f'{r:.4f}, {s:.4f} \n'
+                                      for i, n, t, r, s in curve))
+                logfile.write(f'    Starting points: {total_points} \n'
+                              '    Points remaining: '
+                              f'{len([i for i in _.tie_points.points])}, \n'
+                              '    Points removed total: '
+                              f'{round(pcent, 2)} % \n'
+                              )
+                logfile.write(f'Processing time: {end_t - start_t} / '
+                              f'Total Time: {self.runtime} \n'
+                              )
+            self.check_snapshots()
+            self.record_stage(_, 'grad_sel_postgcp', end_t - start_t,
+                              repro_error=val_repro_error, iterations=step,
+                              stop=reason)
+
+    def grad_sel_combined(self,
+                          *,
+                          rec_uncert=None,
+                          proj_acc=None,
+                          repro_error=0,
+                          twice=False,
+                          adapt=True
+                          ):
+        """
+        Single pass gradual selection on all three criteria
+
+        Parameters: rec_uncert=number (lowest threshold, default
+                        self.rec_uncert)
+                    proj_acc=number (lowest threshold, default
+                        self.proj_acc)
+                    repro_error=number (lowest threshold)
+                    twice=boolean (repeat the reprojection error removal
+                        after the first optimisation and optimise again)
+        Dependencies: tie_values(), snapshot_ties(),
+                check_snapshots()
+        Description: Alternative to grad_sel_pregcp and grad_sel_postgcp
+            with the same limits. The criteria are read once, the
+            thresholds are taken from quantiles: Rec Uncert and Proj Acc
+            select fewer than 50% of the points left (but not below the
+            given values), Reprojection Error at most 10% of the points
+            left, as one pass of grad_sel_postgcp, and never below the
+            self.tp_pcnt share of the aligned tie points. The points above
+            any threshold are selected in one mask and removed at once,
+            then the cameras are optimised once (twice).
+        """
+        if not rec_uncert:
+            rec_uncert = self.rec_uncert
+        if not proj_acc:
+            proj_acc = self.proj_acc
+        for _ in self.chunks:
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                start_t = datetime.now()
+                logfile.write(f'Running combined gradual selection of {_} '
+                              f'at {start_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    Aim to reduce to (%): '
+                              f'{self.tp_pcnt * 100} \n'
+                              f'    Optimise twice: {twice} \n'
+                              )
+            try:
+                total_points = self.total_points[str(_)]
+            except KeyError:
+                print(f'A key error occurred in chunk: {_}')
+                print('No tie point baseline: if the chunk was not aligned '
+                      'by the script run ms_doc.set_baseline() in the '
+                      'console first (uses the current tie points)'
+                      )
+                # write log information
+                with open(self.log, 'a+', encoding='utf-8') as logfile:
+                    logfile.write(f'***A key error occurred in chunk: {_}***')
+                continue
+            hard_limit = total_points * self.tp_pcnt
+            snap = self.tie_values(_)
+            keep = snap['valid'].copy()
+            for name in ('rec_uncert', 'proj_acc', 'repro_error'):
+                keep &= np.isfinite(snap[name])
+            used = {}
+            for name, start in (('rec_uncert', rec_uncert),
+                                ('proj_acc', proj_acc)):
+                # the points above the value are selected, just above the
+                #    median selects fewer than half of the remaining points
+                median = np.float32(np.median(snap[name][keep]))
+                value = max(start, float(np.nextafter(median,
+                                                      np.float32(np.inf))))
+                if (keep & (snap[name] <= value)).sum() > hard_limit:
+                    keep &= snap[name] <= value
+                    used[name] = value
+            remain = int(keep.sum())
+            if remain > hard_limit:
+                # at most 10 % of the remaining points (the step of
+                #    grad_sel_postgcp) and never below the hard limit
+                cut = min(0.1 * remain, remain - hard_limit)
+                value = float(np.quantile(snap['repro_error'][keep],
+                                          1 - cut / remain))
+                used['repro_error'] = max(repro_error, value)
+            print(f'Combined selection thresholds: {used}')
+            # one mask of all criteria, removed at once
+            remove = np.zeros(len(snap['valid']), dtype=bool)
+            for name, value in used.items():
+                remove |= snap[name] > value
+            remove &= snap['valid']
+            for point, flag in zip(_.tie_points.points, remove.tolist()):
+                point.selected = flag
+            _.tie_points.removeSelectedPoints()
+            removed_1 = total_points - len(_.tie_points.points)
+            _.optimizeCameras(adaptive_fitting=adapt)
+            if twice and 'repro_error' in used:
+                f = Metashape.TiePoints.Filter()
+                f.init(_, criterion=Metashape.TiePoints.Filter
+                       .ReprojectionError)
+                values = np.asarray(f.values, dtype=np.float32)
+                # stay above the hard limit after the re-estimation
+                over = np.isfinite(values) & (values > used['repro_error'])
+                if len(_.tie_points.points) - over.sum() > hard_limit:
+                    f.removePoints(used['repro_error'])
+                    _.optimizeCameras(adaptive_fitting=adapt)
+            self.snapshot_ties(_, '5_combined', **used)
+            for name, value in used.items():
+                _.meta[f'MSProc/{name}'] = str(value)
+            # write log information
+            remaining = len(_.tie_points.points)
+            pcent = 100 * (total_points - remaining) / total_points
+            self.doc.save()
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                end_t = datetime.now()
+                self.runtime += end_t - start_t
+                logfile.write(f'Finished combined gradual selection {_} at '
+                              f'{end_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(''.join(f'    {k} used: {round(v, 3)} \n'
+                                      for k, v in used.items()))
+                logfile.write(f'    Starting points: {total_points} \n'
+                              f'    Removed in one pass: {removed_1} \n'
+                              f'    Points remaining: {remaining} \n'
+                              '    Points removed total: '
+                              f'{round(pcent, 2)} % \n'
+                              )
+                logfile.write(f'Processing time: {end_t - start_t} / '
+                              f'Total Time: {self.runtime} \n'
+                              )
+            self.check_snapshots()
+            self.record_stage(_, 'grad_sel_combined', end_t - start_t,
+                              twice=twice, **used)
+
+    def remove_align(self):
+        """
+        Remove the camera alignment
+        """
+        for _ in self.chunks:
+            for c in _.cameras:
+                c.transform = None
+
+    def align(
+        self,
+        *,
+        generic=False,
+        ms_filter=True,
+        mask_ties=False,
+        acc=None,
+        key=None,
+        tie=None,
+        adapt=True,
+        guided=True,
+        incremental=False,
+        neighbours=20,
+        workflow='geo',
+        trial=None,
+        keep_keys=None,
+    ):
+        # star forces named parameters
+        """
+        Align images in the document
+
+        Parameters: generic=boolean (if not generic, reference pre-selection
+                                    is used)
+                    incremental=boolean (only align the new, unaligned
+                        cameras, see align_new())
+                    neighbours=number of nearby aligned cameras matched
+                        with each new camera in incremental mode
+                    key/tie=keypoint/tie point limit (None = tuned per
+                        chunk with tune_limits(), tie 0 = unlimited)
+                    workflow='geo' or 'model' for the tuned limits
+                    trial=calibrate the tuned limits with a trial match
+                        (None = self.trial_match)
+                    keep_keys=keep the keypoints in the project so new
+                        images can be aligned incrementally later (None =
+                        self.keep_keypoints, always on in incremental mode)
+        """
+        if not generic:
+            reference = True
+        else:
+            reference = False
+        if not acc:
+            acc = self.match_acc
+        if acc not in self.match_dict:
+            raise ValueError('Unknown Metashape matching accuracy value '
+                             '(Highest=0 High=1 Medium=2 Low=4 Lowest=8).'
+                             )
+        if trial is None:
+            trial = self.trial_match
+        if keep_keys is None:
+            keep_keys = self.keep_keypoints or incremental
+        for _ in self.chunks:
+            c_key, c_tie = key, tie
+            if key is None or tie is None:
+                auto_key, auto_tie = self.tune_limits(_,
+                                                      workflow=workflow,
+                                                      trial=trial,
+                                                      generic=generic,
+                                                      )
+                c_key = auto_key if key is None else key
+                c_tie = auto_tie if tie is None else tie
+            match_args = dict(downscale=acc,
+                              generic_preselection=generic,
+                              reference_preselection=reference,
+                              filter_mask=ms_filter,
+                              mask_tiepoints=mask_ties,
+                              guided_matching=guided,
+                              keypoint_limit=c_key,
+                              tiepoint_limit=c_tie,
+                              keep_keypoints=keep_keys,
+                              )
+            if incremental and any(c.transform for c in _.cameras):
+                self.align_new(_, match_args, adapt, neighbours)
+                continue
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                start_t = datetime.now()
+                logfile.write(f'Aligning {_} at '
+                              f'{start_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    Reference pre-selection: {reference} \n')
+                logfile.write(f'    Accuracy: {acc} \n'
+                              f'    Keypoint limit: {c_key} \n'
+                              f'    Tiepoint limit: {c_tie} \n'
+                              f'    Adaptive fitting: {adapt} \n'
+                              )
+            # start matching and aligning
+            match_t = time.perf_counter()
+            _.matchPhotos(progress=self.progress('matchPhotos', _),
+                          **match_args)
+            match_s = time.perf_counter() - match_t
+            _.alignCameras(progress=self.progress('alignCameras', _),
+                           adaptive_fitting=adapt)
+            _.optimizeCameras(adaptive_fitting=adapt)
+            _.resetRegion()
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                end_t = datetime.now()
+                self.runtime += end_t - start_t
+                logfile.write(f'Finished aligning {_} at '
+                              f'{end_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    Matching time: {round(match_s)} s \n')
+                logfile.write(
+                    f'Processing time: {end_t - start_t} '
+                    f'/ Total Time: {self.runtime} \n'
+                )
+            self.store_baseline(_)
+            self.record_stage(_, 'align', end_t - start_t,
+                              acc=acc, key=c_key, tie=c_tie)
+            self.doc.save()
+
+    def tune_limits(self, chunk, *, workflow='geo', trial=False,
+                    generic=False, sample=40):
+        """
+        Keypoint and tie point limits for a chunk
+
+        Input: chunk - the chunk to be processed
+                workflow - 'geo' (aerial) or 'model' (close range)
+                trial - calibrate with a low accuracy trial match
+                generic - generic pre-selection for the trial match
+                sample - number of cameras in the trial match
+        Output: (keypoint limit, tie point limit)
+
+        The keypoint limit scales with the median image size (about 1500
+            keypoints per megapixel, 20000-120000). The tie point limit
+            is 4000 for geo (3000 for >1000 and 2000 for >5000 cameras) and
+            2.5 times that for model workflows, so large blocks do not
+            bloat the tie points the gradual selection scans.
+        The trial match aligns a run of cameras of a temporary copy of the
+            chunk at Low accuracy: if less than 90% of them align the
+            keypoint limit is raised by half, if the median camera has more
+            than twice the tie point limit in projections it is lowered by
+            a quarter.
+        """
+        cams = [c for c in chunk.cameras if c.enabled and c.sensor]
+        if not cams:
+            return 40000, 4000
+        mpix = float(np.median([c.sensor.width * c.sensor.height
+                                for c in cams])) / 1e6
+        key = int(np.clip(round(mpix * 1500, -3), 20000, 120000))
+        if len(cams) > 5000:
+            tie = 2000
+        elif len(cams) > 1000:
+            tie = 3000
+        else:
+            tie = 4000
+        if workflow == 'model':
+            tie = int(tie * 2.5)
+        if trial and len(cams) > 2:
+            trial_t = time.perf_counter()
+            tmp = chunk.copy(items=[], keypoints=False)
+            # the trial chunk must not stay in the document on errors
+            try:
+                tmp.label = f'{chunk.label}_trial'
+                # consecutive cameras overlap in most acquisitions
+                keep = sorted(c.label for c in tmp.cameras
+                              if c.enabled and c.sensor)
+                mid = max(0, len(keep) // 2 - sample // 2)
+                keep = set(keep[mid:mid + sample])
+                tmp.remove([c for c in tmp.cameras if c.label not in keep])
+                tmp.matchPhotos(downscale=4,
+                                generic_preselection=generic,
+                                reference_preselection=not generic,
+                                keypoint_limit=key,
+                                tiepoint_limit=0,
+                                )
+                tmp.alignCameras()
+                aligned = [c for c in tmp.cameras if c.transform]
+                if tmp.tie_points and aligned:
+                    proj = float(np.median(
+                        [len(tmp.tie_points.projections[c])
+                         for c in aligned]))
+                else:
+                    proj = 0
+                ratio = len(aligned) / len(tmp.cameras)
+            finally:
+                self.doc.remove([tmp])
+            if ratio < 0.9:
+                key = min(int(key * 1.5), 120000)
+            elif proj > 2 * tie:
+                key = max(int(key * 0.75), 20000)
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                logfile.write(f'Trial match {chunk}: {len(aligned)} / '
+                              f'{len(keep)} cameras aligned, median '
+                              f'{round(proj)} projections, '
+                              f'{round(time.perf_counter() - trial_t)} s '
+                              '\n'
+                              )
+        print(f'{chunk}: {mpix:.1f} MP, {len(cams)} cameras, {workflow}: '
+              f'keypoint limit {key}, tie point limit {tie}')
+        return key, tie
+
+    def align_new(self, chunk, match_args, adapt, neighbours):
+        """
+        Helper function to align only the new cameras of an aligned chunk
+
+        Input: chunk - the chunk to be processed
+                match_args - dict of matchPhotos parameters
+                adapt - adaptive fitting
+                neighbours - number of nearby aligned cameras per new camera
+        Dependencies: local_positions(), store_baseline()
+
+        The new (enabled, unaligned) cameras are matched with the aligned
+            cameras nearest to them by reference location, keeping the
+            existing keypoints and matches, and then aligned without
+            resetting the existing alignment.
+        """
+        new = [c for c in chunk.cameras if c.enabled and not c.transform]
+        old = [c for c in chunk.cameras if c.transform]
+        # write log information
+        with open(self.log, 'a+', encoding='utf-8') as logfile:
+            start_t = datetime.now()
+            logfile.write(f'Aligning new cameras {chunk} at '
+                          f'{start_t.strftime("%H:%M:%S")} \n'
+                          )
+            logfile.write(f'    New cameras: {len(new)} \n'
+                          f'    Aligned cameras: {len(old)} \n'
+                          )
+        if not new:
+            print(f'No new cameras to align in {chunk}')
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                end_t = datetime.now()
+                self.runtime += end_t - start_t
+                logfile.write(f'Finished aligning new cameras {chunk} at '
+                              f'{end_t.strftime("%H:%M:%S")}: no new '
+                              'cameras \n'
+                              )
+            return
+        if chunk.crs and all(c.reference.location for c in new + old):
+            pos = self.local_positions(chunk, new + old)
+            new_pos, old_pos = pos[:len(new)], pos[len(new):]
+            near = set()
+            k = min(neighbours, len(old))
+            # nearest aligned cameras in blocks of new cameras, about 4M
+            #    distances (32 MB) at a time
+            step = max(1, 4000000 // len(old))
+            for start in range(0, len(new), step):
+                block = new_pos[start:start + step]
+                dist = (block[:, None, 0] - old_pos[None, :, 0]) ** 2
+                dist += (block[:, None, 1] - old_pos[None, :, 1]) ** 2
+                near.update(np.argpartition(dist, k - 1, axis=1)[:, :k]
+                            .ravel().tolist())
+            nearby = [old[i] for i in sorted(near)]
+        else:
+            nearby = old
+        match_t = time.perf_counter()
+        chunk.matchPhotos(progress=self.progress('matchPhotos', chunk),
+                          cameras=new + nearby,
+                          reset_matches=False,
+                          **match_args,
+                          )
+        match_s = time.perf_counter() - match_t
+        chunk.alignCameras(progress=self.progress('alignCameras', chunk),
+                           cameras=new,
+                           reset_alignment=False,
+                           adaptive_fitting=adapt,
+                           )
+        chunk.optimizeCameras(adaptive_fitting=adapt)
+        chunk.resetRegion()
+        aligned = len([c for c in new if c.transform])
+        # matching time scales about linearly with the cameras matched
+        saved = match_s * (len(new) + len(old)) / len(new + nearby) - match_s
+        # keep the baseline of the first alignment, the tie points are
+        #    already reduced by the gradual selection
+        if str(chunk) not in self.total_points \
+                and not chunk.meta['MSProc/total_points']:
+            self.store_baseline(chunk)
+        # write log information
+        with open(self.log, 'a+', encoding='utf-8') as logfile:
+            end_t = datetime.now()
+            self.runtime += end_t - start_t
+            logfile.write(f'Finished aligning new cameras {chunk} at '
+                          f'{end_t.strftime("%H:%M:%S")} \n'
+                          )
+            logfile.write(f'    Cameras matched: {len(new + nearby)} \n'
+                          f'    New cameras aligned: {aligned} / '
+                          f'{len(new)} \n'
+                          f'    Matching time: {round(match_s)} s, '
+                          f'estimated saving: {round(saved)} s \n'
+                          f'    Tie points: '
+                          f'{len(chunk.tie_points.points)} \n'
+                          )
+            logfile.write(f'Processing time: {end_t - start_t} '
+                          f'/ Total Time: {self.runtime} \n'
+                          )
+        self.record_stage(chunk, 'align_new', end_t - start_t,
+                          new=len(new), matched=len(new + nearby))
+        self.doc.save()
+
+    @staticmethod
+    def tie_coords(chunk):
+        """
+        Coordinates of the valid tie points of a chunk
+
+        Input: chunk - the chunk to be read
+        Output: (N, 3) array in chunk coordinates
+        """
+        coords = [list(p.coord) for p in chunk.tie_points.points if p.valid]
+        coords = np.array(coords, dtype=float).reshape(-1, 4)
+        return coords[:, :3] / coords[:, 3:]
+
+    def fit_region(self, *, lower=1, upper=99, margin=0.05, aoi=None):
+        """
+        Fit the reconstruction region to the robust tie point bounds
+
+        Parameters: lower=percentile to trim below on each box axis
+                    upper=percentile to trim above on each box axis
+                    margin=fraction added to each box side
+                    aoi=list of (x, y) polygon vertices in the chunk CRS
+                        (optional, only tie points inside are used)
+        Dependencies: tie_coords()
+
+        resetRegion() includes outlier tie points (sky, horizon, far field),
+            so the box used by the depth maps and point cloud is often much
+            larger than the area of interest. The box axes follow the
+            principal axes of the tie points.
+        """
+        for _ in self.chunks:
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                start_t = datetime.now()
+                logfile.write(f'Fitting region {_} at '
+                              f'{start_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    Percentiles: {lower} - {upper} \n'
+                              f'    Margin: {margin} \n'
+                              f'    AOI: {bool(aoi)} \n'
+                              )
+            if not _.tie_points:
+                print(f'No tie points in {_}, region not changed')
+                with open(self.log, 'a+', encoding='utf-8') as logfile:
+                    logfile.write('    No tie points, region not changed \n')
+                continue
+            pts = self.tie_coords(_)
+            if aoi:
+                # chunk to geocentric in numpy, CRS projection per point
+                geo = pts @ to_array(_.transform.matrix)[:3, :3].T \
+                    + to_array(_.transform.matrix)[:3, 3]
+                xy = np.array([list(_.crs.project(Metashape.Vector(p)))[:2]
+                               for p in geo.tolist()]).reshape(-1, 2)
+                pts = pts[in_polygon(xy, aoi)]
+            if len(pts) < 4:
+                print(f'Too few tie points in {_}, region not changed')
+                with open(self.log, 'a+', encoding='utf-8') as logfile:
+                    logfile.write('    Too few tie points, region not '
+                                  'changed \n')
+                continue
+            # reset only now, a skipped chunk keeps its own region
+            _.resetRegion()
+            reset_vol = float(np.prod(list(_.region.size)))
+            centre = np.median(pts, axis=0)
+            # principal axes from a sample of the points
+            step = max(1, len(pts) // 200000)
+            axes = np.linalg.eigh(np.cov((pts[::step] - centre).T))[1]
+            axes = axes[:, ::-1]
+            if np.linalg.det(axes) < 0:
+                axes[:, 2] *= -1
+            local = (pts - centre) @ axes
+            low = np.percentile(local, lower, axis=0)
+            high = np.percentile(local, upper, axis=0)
+            size = (high - low) * (1 + 2 * margin)
+            region = _.region
+            region.center = Metashape.Vector(
+                (centre + axes @ ((high + low) / 2)).tolist()
+            )
+            region.size = Metashape.Vector(size.tolist())
+            region.rot = Metashape.Matrix(axes.tolist())
+            _.region = region
+            fit_vol = float(np.prod(size))
+            reduction = 100 * (1 - fit_vol / reset_vol) if reset_vol else 0
+            print(f'Region volume in {_} reduced by {round(reduction, 1)} %')
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                end_t = datetime.now()
+                self.runtime += end_t - start_t
+                logfile.write(f'Finished fitting region {_} at '
+                              f'{end_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    Tie points used: {len(pts)} \n'
+                              f'    Volume reduction vs reset region: '
+                              f'{round(reduction, 1)} % \n'
+                              )
+                logfile.write(f'Processing time: {end_t - start_t} / '
+                              f'Total Time: {self.runtime} \n'
+                              )
+        self.doc.save()
+
+    def plan_depth_qual(self, *, target_res=None):
+        """
+        Pick the depth map quality per chunk from the ground sample distance
+
+        Parameter: target_res=number (target DSM/ortho resolution in m,
+                                      optional, default self.target_res)
+
+        The GSD is the median over the aligned cameras of the height above
+            the median tie point height divided by the focal length in
+            pixels. The coarsest downscale whose depth map GSD
+            (GSD * downscale) still meets the target is used by dense_c.
+        """
+        if not target_res:
+            target_res = self.target_res
+        if not target_res:
+            print('No target resolution set, depth map quality unchanged')
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                logfile.write('No target resolution set, depth map quality '
+                              'not planned \n'
+                              )
+            return
+        for _ in self.chunks:
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                start_t = datetime.now()
+                logfile.write(f'Planning depth map quality {_} at '
+                              f'{start_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    Target resolution: {target_res} \n')
+            cameras = [c for c in _.cameras if c.transform and c.enabled]
+            if not cameras or not _.crs or not _.tie_points:
+                print(f'{_} is not aligned or has no CRS, skipping')
+                with open(self.log, 'a+', encoding='utf-8') as logfile:
+                    end_t = datetime.now()
+                    self.runtime += end_t - start_t
+                    logfile.write(f'Skipped planning depth map quality {_} '
+                                  f'at {end_t.strftime("%H:%M:%S")}: not '
+                                  'aligned or no CRS \n'
+                                  )
+                continue
+            matrix = to_array(_.transform.matrix)
+            # ground height from a sample of tie points
+            ties = self.tie_coords(_)
+            ties = ties[::max(1, len(ties) // 10000)]
+            ground = np.median([_.crs.project(Metashape.Vector(p)).z
+                                for p in (ties @ matrix[:3, :3].T
+                                          + matrix[:3, 3]).tolist()])
+            height = np.array([_.crs.project(
+                _.transform.matrix.mulp(c.center)).z for c in cameras])
+            focal = np.array([c.sensor.calibration.f
+                              if c.sensor.calibration
+                              else c.sensor.focal_length
+                              / c.sensor.pixel_width
+                              for c in cameras])
+            gsd = float(np.median((height - ground) / focal))
+            if gsd <= 0:
+                print(f'Could not estimate the GSD of {_}, skipping')
+                with open(self.log, 'a+', encoding='utf-8') as logfile:
+                    end_t = datetime.now()
+                    self.runtime += end_t - start_t
+                    logfile.write(f'Skipped planning depth map quality {_} '
+                                  f'at {end_t.strftime("%H:%M:%S")}: GSD '
+                                  f'not estimated ({round(gsd, 4)} m) \n'
+                                  )
+                continue
+            fits = [d for d in sorted(self.depth_dict)
+                    if gsd * d <= target_res]
+            qual = fits[-1] if fits else min(self.depth_dict)
+            self.depth_plan[str(_)] = qual
+            # depth map time scales with the number of pixels
+            saved = 100 * (1 - (self.depth_qual / qual) ** 2)
+            print(f'{_}: GSD {round(gsd, 4)} m, depth map quality '
+                  f'{self.depth_dict[qual]}, estimated time saved '
+                  f'{round(saved)} %'
+                  )
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                end_t = datetime.now()
+                self.runtime += end_t - start_t
+                logfile.write(f'Finished planning depth map quality {_} at '
+                              f'{end_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    GSD: {round(gsd, 4)} m \n'
+                              f'    Depth map quality: {qual} '
+                              f'({self.depth_dict[qual]}) \n'
+                              f'    Depth map GSD: {round(gsd * qual, 4)} m '
+                              '\n'
+                              '    Estimated depth map time saved vs '
+                              f'{self.depth_dict[self.depth_qual]}: '
+                              f'{round(saved)} % \n'
+                              )
+                if not fits:
+                    logfile.write('    WARNING: target finer than Ultra '
+                                  'quality GSD \n'
+                                  )
+                logfile.write(f'Processing time: {end_t - start_t} / '
+                              f'Total Time: {self.runtime} \n'
+                              )
+
+    @staticmethod
+    def find_depth_maps(chunk, qual, mode):
+        """
+        Find the depth map set of a chunk built with the given parameters
+
+        Input: chunk - the chunk to search
+                qual - Metashape depth map quality (downscale)
+                mode - Metashape filtering method
+        Output: Metashape.DepthMaps or None
+
+        Matches Metashape's own BuildDepthMaps metadata, so sets built in
+            the GUI, by earlier versions or interrupted are found, and falls
+            back to the MSProc tags written by dense_c.
+        """
+        modes = {str(mode), str(mode).split('.')[-1]}
+        try:
+            modes.add(str(int(mode)))
+        except (TypeError, ValueError):
+            pass
+        for depth_maps in chunk.depth_maps_sets:
+            for prefix in ('BuildDepthMaps', 'MSProc'):
+                if depth_maps.meta[f'{prefix}/downscale'] == str(qual) and \
+                        depth_maps.meta[f'{prefix}/filter_mode'] in modes:
+                    return depth_maps
+        return None
+
+    @staticmethod
+    def local_positions(chunk, cameras):
+        """
+        Camera reference locations in a local metric (east, north, up) frame
+
+        Input: chunk - the chunk of the cameras
+                cameras - list of cameras with reference locations
+        Output: (N, 3) array in metres around the centre of the cameras
+        """
+        geo = np.array([list(chunk.crs.unproject(c.reference.location))
+                        for c in cameras]).reshape(-1, 3)
+        frame = to_array(chunk.crs.localframe(
+            Metashape.Vector(geo.mean(axis=0).tolist())))
+        return geo @ frame[:3, :3].T + frame[:3, 3]
+
+    def split_chunks(self, *, max_cams=2000, overlap=0.1):
+        """
+        Split each chunk into a grid of overlapping tile chunks
+
+        Parameters: max_cams=number (approximate maximum number of cameras
+                                     per tile)
+                    overlap=fraction of the tile size added on each side
+
+        Cameras are binned on their aligned centres in the region frame
+            (the tile region boxes are then set to match) or, before
+            alignment, on their reference locations in a local metric
+            frame. Each tile is a copy of the chunk without assets (but
+            with the tie points if aligned) keeping only its cameras. The
+            tiles replace the chunks processed by the following stages;
+            self.tile_groups keeps them per source chunk for merge_tiles().
+        """
+        tiles_all = []
+        for _ in self.chunks:
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                start_t = datetime.now()
+                logfile.write(f'Splitting {_} at '
+                              f'{start_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    Max cameras per tile: {max_cams} \n'
+                              f'    Overlap: {overlap} \n'
+                              )
+            aligned = [c.transform is not None for c in _.cameras]
+            if all(aligned) and _.transform.matrix:
+                # region frame of the aligned chunk
+                region = _.region
+                rot = to_array(region.rot)
+                pos = (np.array([list(c.center) for c in _.cameras])
+                       - list(region.center)) @ rot
+            elif all(c.reference.location for c in _.cameras) and _.crs:
+                pos = self.local_positions(_, _.cameras)
+            else:
+                print(f'{_} needs aligned cameras or reference locations '
+                      'for all cameras, not split')
+                tiles_all.append(_)
+                continue
+            n_cams = len(pos)
+            if n_cams <= max_cams:
+                print(f'{_} has {n_cams} cameras, not split')
+                tiles_all.append(_)
+                continue
+            low, high = pos[:, :2].min(axis=0), pos[:, :2].max(axis=0)
+            extent = np.maximum(high - low, 1e-9)
+            n_tiles = int(np.ceil(n_cams / max_cams))
+            # corridors (or collinear cameras) get at most n_tiles columns
+            n_x = min(n_tiles, max(1, int(round(np.sqrt(n_tiles * extent[0]
+                                                        / extent[1])))))
+            n_y = int(np.ceil(n_tiles / n_x))
+            size = extent / [n_x, n_y]
+            # tile bounds with overlap, cameras binned for all tiles at once
+            i, j = np.meshgrid(np.arange(n_x), np.arange(n_y),
+                               indexing='ij')
+            t_low = low + np.c_[i.ravel(), j.ravel()] * size - overlap * size
+            t_high = t_low + size * (1 + 2 * overlap)
+            inside = np.all((pos[None, :, :2] >= t_low[:, None])
+                            & (pos[None, :, :2] <= t_high[:, None]), axis=2)
+            tiles = []
+            for t, mask in enumerate(inside):
+                if not mask.any():
+                    continue
+                # aligned tiles keep the tie points for depth maps,
+                #    gradual selection and fit_region
+                items = [Metashape.DataSource.TiePointsData] \
+                    if all(aligned) else []
+                tile = _.copy(items=items, keypoints=True)
+                tile.label = f'{_.label}_T{t // n_y}_{t % n_y}'
+                # merge_tiles finds the site again after a reload
+                tile.meta['MSProc/tile_of'] = _.label
+                tile.remove([c for c, keep in zip(tile.cameras, mask)
+                             if not keep])
+                if all(aligned):
+                    region = tile.region
+                    centre = np.r_[(t_low[t] + t_high[t]) / 2, 0]
+                    region.center = Metashape.Vector(
+                        (np.array(list(_.region.center))
+                         + rot @ centre).tolist())
+                    region.size = Metashape.Vector(
+                        [*(t_high[t] - t_low[t]).tolist(),
+                         _.region.size.z])
+                    tile.region = region
+                tiles.append(tile)
+            self.tile_groups[_.label] = tiles
+            tiles_all.extend(tiles)
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                end_t = datetime.now()
+                self.runtime += end_t - start_t
+                logfile.write(f'Finished splitting {_} at '
+                              f'{end_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    Grid: {n_x} x {n_y} \n'
+                              f'    Tiles: {len(tiles)} \n'
+                              f'    Cameras per tile: '
+                              f'{inside.sum(axis=1).tolist()} \n'
+                              )
+                logfile.write(f'Processing time: {end_t - start_t} / '
+                              f'Total Time: {self.runtime} \n'
+                              )
+        self.chunks = tiles_all
+        self.doc.save()
+
+    def dense_c(self, *, mode=None, qual=None, reuse=True, keep_depth=None):
+        """
+        Create  dense point cloud
+
+        Parameter: mode=[Metashape filtering method]
+                    qual=[Metashape depth map quality] (default is the
+                        plan_depth_qual value of the chunk if planned,
+                        otherwise self.depth_qual)
+                    reuse=boolean (reuse depth maps built with the same
+                        quality and filtering, default True)
+                    keep_depth=boolean (keep the current depth map set when
+                        building one with other parameters, default
+                        self.keep_depth)
+        Dependencies: find_depth_maps()
+
+        Depth maps are the most expensive product, so if a set with the same
+            quality and filtering exists only the point cloud is rebuilt.
+            Interrupted sets are completed with reuse_depth. With keep_depth
+            every parameter combination keeps its own set for A/B
+            comparisons of the filtering.
+        """
+        if not mode:
+            mode = self.filtering
+        if qual and qual not in self.depth_dict:
+            raise ValueError('Unknown Metashape depth map quality value '
+                             '(Ultra=1 High=2 Medium=4 Low=8 Lowest=16).'
+                             )
+        if keep_depth is None:
+            keep_depth = self.keep_depth
+        req_qual = qual
+        for _ in self.chunks:
+            qual = req_qual or self.depth_plan.get(str(_), self.depth_qual)
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                start_t = datetime.now()
+                logfile.write(f'Building point cloud {_} at '
+                              f'{start_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    Quality: {qual} \n'
+                              f'    Filtering mode: {mode} \n'
+                              )
+            # look for depth maps with matching parameters
+            depth_maps = self.find_depth_maps(_, qual, mode) if reuse \
+                else None
+            cameras = [c for c in _.cameras if c.transform and c.enabled]
+            if depth_maps is not None:
+                _.depth_maps = depth_maps
+                done = {c.key for c in depth_maps.keys()}
+                missing = len([c for c in cameras if c.key not in done])
+            elif keep_depth and _.depth_maps:
+                # leave a copy of the current set, build into the other
+                _.depth_maps.copy()
+            if depth_maps is not None and missing <= 0:
+                t = (f'    Reusing depth maps {depth_maps.label} '
+                     f'({len(depth_maps.keys())} cameras) \n')
+                print(t)
+            else:
+                # build depthmaps, completing an interrupted set
+                _.buildDepthMaps(progress=self.progress('buildDepthMaps', _),
+                                 downscale=qual,
+                                 filter_mode=mode,
+                                 reuse_depth=depth_maps is not None,
+                                 )
+                _.depth_maps.meta['MSProc/downscale'] = str(qual)
+                _.depth_maps.meta['MSProc/filter_mode'] = str(mode)
+                _.depth_maps.label = f'{self.depth_dict[qual]} {mode}'
+                t = ''
+                if depth_maps is not None:
+                    t = f'    Completed {missing} missing depth maps \n'
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                end_t = datetime.now()
+                logfile.write(t)
+                logfile.write(f'Finished generating depth map {_} at '
+                              f'{end_t.strftime("%H:%M:%S")} \n'
+                              'proceeding to point cloud generation \n')
+            _.buildPointCloud(progress=self.progress('buildPointCloud', _),
+                              point_colors=True, point_confidence=True)
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                end_t = datetime.now()
+                self.runtime += end_t - start_t
+                logfile.write(f'Finished generating point cloud {_} at '
+                              f'{end_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'Processing time: {end_t - start_t} / '
+                              f'Total Time: {self.runtime} \n'
+                              )
+            self.record_stage(_, 'dense_c', end_t - start_t,
+                              qual=qual, mode=mode,
+                              reused=depth_maps is not None)
+            self.doc.save()
+
+    def filter_conf(self,
+                    *,
+                    min_conf=None,
+                    classify=False,
+                    outliers=False,
+                    voxel=None,
+                    min_frac=0.1,
+                    ):
+        """
+        Remove or classify low confidence points of the point cloud
+
+        Parameters: min_conf=number (points with a confidence below this
+                        are filtered, default self.min_conf)
+                    classify=boolean (assign the points to class 7 Low
+                        Point (noise) instead of removing them)
+                    outliers=boolean (also run a statistical outlier pass)
+                    voxel=number (voxel size in CRS units for the outlier
+                        pass, default 4 x mean point spacing)
+                    min_frac=number (outlier limit as fraction of the
+                        median voxel neighbourhood count)
+        Dependencies: dense_c() with point_confidence, filter_outliers()
+
+        The outlier pass exports the cloud as binary PLY, flags points with
+            sparse voxel neighbourhoods using numpy on the memory mapped
+            file and imports the remaining points as the chunk point cloud.
+            When classifying, the low confidence points and outliers are
+            flagged in the same PLY pass (so they are counted) and imported
+            as class 7, which dem() and export_geo() leave out.
+        """
+        if min_conf is None:
+            min_conf = self.min_conf
+        for _ in self.chunks:
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                start_t = datetime.now()
+                logfile.write(f'Filtering point cloud {_} at '
+                              f'{start_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    Minimum confidence: {min_conf} \n'
+                              f'    Classify: {classify} \n'
+                              f'    Outlier pass: {outliers} \n'
+                              )
+            if not _.point_cloud:
+                print(f'There is no point cloud to filter in chunk: {_}')
+                continue
+            before = _.point_cloud.point_count
+            n_low, n_out, n_flag = 0, 0, 0
+            if classify and (min_conf > 0 or outliers):
+                n_low, n_out, n_flag = self.filter_outliers(
+                    _, voxel, min_frac, min_conf=min_conf,
+                    outliers=outliers, classify=True)
+            else:
+                if min_conf > 0:
+                    _.point_cloud.setConfidenceFilter(0, min_conf - 1)
+                    _.point_cloud.removePoints(list(range(128)))
+                    _.point_cloud.resetFilters()
+                    n_low = before - _.point_cloud.point_count
+                if outliers:
+                    n_out = self.filter_outliers(_, voxel, min_frac)[1]
+                n_flag = n_low + n_out
+            after = _.point_cloud.point_count
+            pcent = 100 * n_flag / before if before else 0
+            action = 'classified as noise' if classify else 'removed'
+            print(f'{_}: {before} points, {n_flag} {action}')
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                end_t = datetime.now()
+                self.runtime += end_t - start_t
+                logfile.write(f'Finished filtering point cloud {_} at '
+                              f'{end_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    Points before: {before} \n'
+                              f'    Points after: {after} \n'
+                              f'    Low confidence {action}: {n_low} \n'
+                              f'    Outliers {action}: {n_out} \n'
+                              f'    Points {action}: {n_flag}, '
+                              f'{round(pcent, 2)} % \n'
+                              )
+                logfile.write(f'Processing time: {end_t - start_t} / '
+                              f'Total Time: {self.runtime} \n'
+                              )
+            self.record_stage(_, 'filter_conf', end_t - start_t,
+                              min_conf=min_conf, outliers=outliers,
+                              classify=classify, flagged=n_flag)
+            self.doc.save()
+
+    def filter_outliers(self,
+                        chunk,
+                        voxel,
+                        min_frac,
+                        *,
+                        min_conf=0,
+                        outliers=True,
+                        classify=False,
+                        ):
+        """
+        Helper function for the PLY pass of filter_conf
+
+        Input: chunk - the chunk to be processed
+                voxel - voxel size (None for automatic)
+                min_frac - outlier limit, see voxel_outliers()
+                min_conf - also flag points below this confidence
+                outliers - boolean (run the voxel outlier test)
+                classify - boolean (import the flagged points as
+                    NOISE_CLASS instead of removing them)
+        Output: (low confidence points, outliers, points flagged in total)
+        Dependencies: flag_ply()
+        """
+        # metric coordinates for the voxel grid
+        crs = chunk.crs
+        geographic = not crs or is_geographic(crs)
+        if geographic:
+            crs = Metashape.CoordinateSystem('EPSG::4978')
+        centre = chunk.transform.matrix.mulp(chunk.region.center)
+        shift = crs.project(centre)
+        # east, north, up axes so the grid is level and the automatic voxel
+        #    size comes from the horizontal extent
+        rot = to_array(chunk.crs.localframe(centre))[:3, :3] \
+            if geographic and chunk.crs else np.eye(3)
+        raw = self.export_path / f'{chunk.key}_filter_tmp.ply'
+        clean = self.export_path / f'{chunk.key}_filter_tmp_clean.ply'
+        try:
+            chunk.exportPointCloud(path=str(raw),
+                                   format=Metashape.PointCloudFormatPLY,
+                                   binary=True,
+                                   crs=crs,
+                                   shift=shift,
+                                   save_point_color=True,
+                                   save_point_normal=True,
+                                   save_point_confidence=True,
+                                   save_point_classification=True,
+                                   progress=self.progress('exportPointCloud',
+                                                          chunk),
+                                   )
+            counts = flag_ply(raw, clean, rot, voxel=voxel,
+                              min_frac=min_frac, outliers=outliers,
+                              min_conf=min_conf, classify=classify)
+            if counts[2]:
+                chunk.importPointCloud(path=str(clean),
+                                       format=Metashape.PointCloudFormatPLY,
+                                       crs=crs,
+                                       shift=shift,
+                                       replace_asset=True,
+                                       progress=self.progress(
+                                           'importPointCloud', chunk),
+                                       )
+        finally:
+            for tmp in (raw, clean):
+                if tmp.exists():
+                    tmp.unlink()
+        return counts
+
+    def build_model(self,
+                    *,
+                    surf=Metashape.Arbitrary,
+                    inter=Metashape.EnabledInterpolation,
+                    face=Metashape.MediumFaceCount,
+                    ms_map=Metashape.GenericMapping,
+                    blend=Metashape.MosaicBlending,
+                    m_size=4096
+                    ):
+        """
+        Build a model from the dense point cloud
+        """
+        for _ in self.chunks:
+            # if a MemoryError occurs in chunk other chunks are still processed
+            try:
+                # write log information
+                with open(self.log, 'a+', encoding='utf-8') as logfile:
+                    start_t = datetime.now()
+                    logfile.write(f'Building  Model {_} at '
+                                  f'{start_t.strftime("%H:%M:%S")} \n'
+                                  )
+                    logfile.write(f'    Surface type: {surf} \n'
+                                  f'    Interpolation: {inter} \n'
+                                  f'    Face count: {face} \n'
+                                  f'    Mapping: {ms_map} \n'
+                                  f'    Blending: {blend} \n'
+                                  f'    Mosaic size: {m_size} \n'
+                                  )
+                # Build model and texture
+                _.buildModel(progress=self.progress('buildModel', _),
+                             surface_type=surf,
+                             interpolation=inter,
+                             face_count=face,
+                             source_data=Metashape.DepthMapsData,
+                             vertex_colors=True,
+                             )
+                _.buildUV(progress=self.progress('buildUV', _),
+                          mapping_mode=ms_map)
+                _.buildTexture(progress=self.progress('buildTexture', _),
+                               blending_mode=blend, texture_size=m_size)
+                # write log information
+                with open(self.log, 'a+', encoding='utf-8') as logfile:
+                    end_t = datetime.now()
+                    self.runtime += end_t - start_t
+                    logfile.write(f'Finished building model {_} at '
+                                  f'{end_t.strftime("%H:%M:%S")} \n'
+                                  )
+                    logfile.write(f'Processing time: {end_t - start_t} / '
+                                  f'Total Time: {self.runtime} \n'
+                                  )
+                self.record_stage(_, 'build_model', end_t - start_t,
+                                  face=face, m_size=m_size)
+                self.doc.save()
+            except MemoryError:
+                print(f'A memory error occurred in chunk: {_}')
+                # write log information
+                with open(self.log, 'a+', encoding='utf-8') as logfile:
+                    start_t = datetime.now()
+                    logfile.write('***A memory error occurred in '
+                                  f'chunk: {_}***')
+                continue
+
+    def dem(self):
+        """
+        Build a DEM from the dense point cloud
+        """
+        for _ in self.chunks:
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                start_t = datetime.now()
+                logfile.write(f'Building DEM {_} at '
+                              f'{start_t.strftime("%H:%M:%S")} \n'
+                              )
+            # build DEM
+            # without the noise class of filter_conf
+            _.buildDem(progress=self.progress('buildDem', _),
+                       source_data=Metashape.PointCloudData,
+                       interpolation=Metashape.EnabledInterpolation,
+                       classes=CLEAN_CLASSES,
+                       )
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                end_t = datetime.now()
+                self.runtime += end_t - start_t
+                logfile.write('Finished building DEM {_} at '
+                              f'{end_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'Processing time: {end_t - start_t} / '
+                              f'Total Time: {self.runtime} \n'
+                              )
+            self.record_stage(_, 'dem', end_t - start_t)
+        self.doc.save()
+
+    def ortho(
+            self, 
+            *, 
+            holes=True,
+            seamlines=True,
+            ghosting=True,
+        ):
+        """
+        Build an ortho from the DEM
+        """
+        for _ in self.chunks:
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                start_t = datetime.now()
+                logfile.write(f'Generating Ortho {_} at '
+                              f'{start_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    Fill holes = {holes}')
+            _.buildOrthomosaic(progress=self.progress('buildOrthomosaic', _),
+                               surface_data=Metashape.ElevationData,
+                               blending_mode=Metashape.MosaicBlending,
+                               fill_holes=holes,
+                               refine_seamlines=seamlines,
+                               ghosting_filter=ghosting,
+                               )
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                end_t = datetime.now()
+                self.runtime += end_t - start_t
+                logfile.write(f'\n Finished generating Ortho{_} at '
+                              f'{end_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'Processing time: {end_t - start_t} / '
+                              f'Total Time: {self.runtime} \n'
+                              )
+            self.record_stage(_, 'ortho', end_t - start_t,
+                              holes=holes, seamlines=seamlines)
+        self.doc.save()
+
+    @staticmethod
+    def file_parts(chunk):
+        """
+        Name and number used in the export file names of a chunk
+
+        Input: chunk - the chunk being exported
+        Output: (name, num) - chunk label and '' or '' and the chunk number
+            for chunks with the default name
+        """
+        if str(chunk)[8:-4] == 'Chunk':
+            return '', str(chunk)[-3]
+        return str(chunk)[8:-2], ''
+
+    def add_manifest(self, chunk, kind, file, **info):
+        """
+        Record an exported file in the export manifest
+
+        Input: chunk - the exported chunk
+                kind - type of export (DSM, Ortho, LAS etc.)
+                file - file name in the export folder
+                info - further values to record, e.g. points=number
+        """
+        entries = []
+        if self.manifest.exists():
+            entries = json.loads(self.manifest.read_text(encoding='utf-8'))
+        path = self.export_path / file
+        entry = {'chunk': chunk.label,
+                 'kind': kind,
+                 'file': file,
+                 'prefix': self.prefix,
+                 'bytes': path.stat().st_size if path.is_file() else None,
+                 'time': datetime.now().isoformat(timespec='seconds'),
+                 }
+        entry.update(info)
+        # a re-export replaces the earlier entry
+        entries = [e for e in entries if e['file'] != file] + [entry]
+        self.manifest.write_text(json.dumps(entries, indent=1),
+                                 encoding='utf-8')
+
+    def record_export(self, logfile, chunk, kind, file, write_t, **info):
+        """
+        Report an exported file with its size and write time
+
+        Input: logfile - the open log file
+                chunk - the exported chunk
+                kind - type of export for the manifest
+                file - file name in the export folder
+                write_t - time.perf_counter() value at the start of the
+                    export
+                info - further values for the manifest
+        """
+        secs = round(time.perf_counter() - write_t, 1)
+        path = self.export_path / file
+        size = path.stat().st_size / 2 ** 20 if path.is_file() else 0
+        t = f'File: {file} ({round(size, 1)} MB, {secs} s)\n'
+        print(t)
+        logfile.write(t)
+        self.add_manifest(chunk, kind, file, seconds=secs, **info)
+
+    def export_lods(self, chunk, file, *, lods=None, voxels=None,
+                    block=5000000):
+        """
+        Write a level of detail pyramid of an exported LAS file
+
+        Input: chunk - the exported chunk
+                file - LAS file name in the export folder
+                lods=list of point ratios, e.g. [4, 16] for 1/4 and 1/16
+                    (default self.lods)
+                voxels=list of voxel sizes in CRS units, one point is kept
+                    per voxel (default self.lod_voxels)
+                block=number of points read at a time
+        Output: list of (file, points) written
+        Dependencies: read_las(), las_header(), las_tiles(), add_manifest()
+
+        The full density LAS (written as deliverable anyway) is memory
+            mapped, so memory is bounded by the block size. Point ratios
+            are taken in one pass over the records. For voxel levels the
+            records are first spilled into square XY tiles of whole voxels
+            (las_tiles) and each tile is thinned on its own, so every voxel
+            is decided in one place whatever the order of the LAS.
+        """
+        lods = self.lods if lods is None else lods
+        voxels = self.lod_voxels if voxels is None else voxels
+        if not lods and not voxels:
+            return []
+        header, points, scale, offset = read_las(self.export_path / file)
+        raw = points.view(np.dtype((np.void, points.dtype.itemsize)))
+        stem = Path(file).stem
+        levels = [(f'{stem}_lod{r}.las', r, None) for r in lods] + \
+                 [(f'{stem}_vox{v}.las', None, v) for v in voxels]
+        counts = []
+        for lod_file, ratio, voxel in levels:
+            count = 0
+            low = np.full(3, np.inf)
+            high = np.full(3, -np.inf)
+            if ratio:
+                parts = ((raw[start:start + block], start)
+                         for start in range(0, len(points), block))
+            else:
+                tmp = self.export_path / f'{stem}_vox_tmp'
+                parts = ((np.fromfile(t, dtype=raw.dtype), None)
+                         for t in las_tiles(points, scale, offset, voxel,
+                                            tmp, block))
+            try:
+                with open(self.export_path / lod_file, 'wb') as out:
+                    out.write(header)
+                    for part, start in parts:
+                        window = part.view(points.dtype)
+                        xyz = np.column_stack([window['X'], window['Y'],
+                                               window['Z']]) * scale + offset
+                        if ratio:
+                            keep = (np.arange(start, start + len(part))
+                                    % ratio) == 0
+                        else:
+                            # the tile holds every point of its voxels
+                            cells = np.floor(xyz / voxel).astype(np.int64)
+                            keep = np.zeros(len(part), dtype=bool)
+                            keep[np.unique(cells, axis=0,
+                                           return_index=True)[1]] = True
+                        if not keep.any():
+                            continue
+                        out.write(part[keep].tobytes())
+                        count += int(np.count_nonzero(keep))
+                        low = np.minimum(low, xyz[keep].min(axis=0))
+                        high = np.maximum(high, xyz[keep].max(axis=0))
+                    out.seek(0)
+                    out.write(las_header(header, count, low, high))
+            finally:
+                if not ratio:
+                    shutil.rmtree(tmp, ignore_errors=True)
+            counts.append(count)
+        written = []
+        for (lod_file, ratio, voxel), count in zip(levels, counts):
+            self.add_manifest(chunk, 'LAS LOD', lod_file, points=count,
+                              ratio=ratio, voxel=voxel, source=file)
+            written.append((lod_file, count))
+        return written
+
+    def export_geo(self):
+        """
+        Export LAS, DEM and Ortho to path using the file name prefix
+        Ortho file format is PNG for JPG input images and TIF for all others.
+        """
+        for _ in self.chunks:
+            ext = Path(_.cameras[0].photo.path).suffix
+            if self.exp_crs == 0:
+                crs = _.crs
+            else:
+                crs = Metashape.CoordinateSystem(f'EPSG::{self.exp_crs}')
+            ortho_proj = Metashape.OrthoProjection()
+            ortho_proj.crs = crs
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                start_t = datetime.now()
+                logfile.write(f'Exporting geo {_} at '
+                              f'{start_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    Export CRS: {crs}\n')
+                # check if input is JPG and below the limit
+                if ext.upper() == '.JPG':
+                    ext = '.png'
+                else:
+                    ext = '.tif'
+                name, num = self.file_parts(_)
+                try:
+                    # Export DSM
+                    file = f'{self.prefix}{name}_DSM{num}.tif'
+                    compression = Metashape.ImageCompression()
+                    if self.raw_tiff or self.dsm_qa:
+                        # uncompressed so it can be memory mapped
+                        compression.tiff_compression = \
+                            Metashape.ImageCompression.TiffCompressionNone
+                        compression.tiff_big = True
+                        compression.tiff_tiled = False
+                        compression.tiff_overviews = False
+                    write_t = time.perf_counter()
+                    _.exportRaster(progress=self.progress('exportRaster', _),
+                                   path=str(self.export_path / file),
+                                   source_data=Metashape.ElevationData,
+                                   save_world=True,
+                                   projection=ortho_proj,
+                                   image_compression=compression,
+                                   )
+                    self.record_export(logfile, _, 'DSM', file, write_t)
+                except RuntimeError as e:
+                    if str(e) == 'Null elevation':
+                        t = ('ERROR: There is no elevation to export in '
+                             f'chunk: {_}\n'
+                             )
+                        print(t)
+                        logfile.write(t)
+                    else:
+                        raise
+                try:
+                    # Export Ortho
+                    file = f'{self.prefix}{name}_Ortho{num}{ext}'
+                    compression = Metashape.ImageCompression()
+                    if self.raw_tiff and ext == '.tif':
+                        # uncompressed so it can be memory mapped
+                        compression.tiff_compression = \
+                            Metashape.ImageCompression.TiffCompressionNone
+                        compression.tiff_big = True
+                        compression.tiff_tiled = False
+                        compression.tiff_overviews = False
+                    write_t = time.perf_counter()
+                    _.exportRaster(progress=self.progress('exportRaster', _),
+                                   path=str(self.export_path / file),
+                                   source_data=Metashape.OrthomosaicData,
+                                   save_world=True,
+                                   projection=ortho_proj,
+                                   image_compression=compression,
+                                   )
+                    self.record_export(logfile, _, 'Ortho', file, write_t)
+                except RuntimeError as e:
+                    if str(e) == 'Null orthomosaic':
+                        t = ('ERROR: There is no orthomosaic to '
+                             f'export in chunk: {_}\n'
+                             )
+                        print(t)
+                        logfile.write(t)
+                    elif str(e).startswith('TIFFWriteTile:'):
+                        try:
+                            print('Attempting BigTIFF\n')
+                            compression = Metashape.ImageCompression()
+                            compression.tiff_big = True
+                            write_t = time.perf_counter()
+                            _.exportRaster(path=str(self.export_path / file),
+                                           source_data=Metashape.
+                                               OrthomosaicData,
+                                           save_world=True,
+                                           projection=ortho_proj,
+                                           image_compression=compression,
+                                           progress=self.progress(
+                                               'exportRaster', _),
+                                           )
+                            self.record_export(logfile, _, 'Ortho', file,
+                                               write_t
+                                               )
+                            t = ('WARNING: TIFF is too large, '
+                                 'exported as BigTIFF\n'
+                                 )
+                            print(t)
+                            logfile.write(t)
+                        except Exception as e2:
+                            exception_name = type(e2).__name__
+                            t = ('ERROR: TIFF is too large to '
+                                 'export as a single chunk, export manually\n'
+                                 f'Error code: {exception_name}'
+                                 )
+                            print(t)
+                            logfile.write(t)
+                    else:
+                        print(f'e:{str(e)}')
+                        raise
+            self.record_stage(_, 'export_geo', datetime.now() - start_t,
+                              raw_tiff=self.raw_tiff)
+        # export LAS (and any other mesh/texture) and report
+        self.export_model()
+        if self.web_tiles:
+            self.export_tiles()
+        if self.dsm_qa:
+            self.dsm_stats()
+        if self.ref_dsm:
+            self.dsm_diff(ref_dsm=self.ref_dsm)
+
+    def export_tiles(self,
+                     *,
+                     tms=False,
+                     min_zoom=None,
+                     max_zoom=None,
+                     tile_format=Metashape.ImageFormatPNG,
+                     ):
+        """
+        Export the orthomosaic as a web map tile pyramid (Web Mercator)
+
+        Parameters: tms=boolean (TMS tile numbering instead of XYZ)
+                    min_zoom=number (default: ortho fits in about one tile)
+                    max_zoom=number (default: tile resolution just finer
+                                     than the ortho resolution)
+                    tile_format=Metashape image format of the tiles
+
+        Each zoom level is exported separately and recorded in tiles.json
+            in the tile folder when done, so an interrupted export resumes
+            at the first unfinished level. Metashape spreads each level over
+            its own worker threads.
+        """
+        web = Metashape.CoordinateSystem('EPSG::3857')
+        wgs = Metashape.CoordinateSystem('EPSG::4326')
+        for _ in self.chunks:
+            if not _.orthomosaic:
+                print(f'There is no orthomosaic to tile in chunk: {_}')
+                continue
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                start_t = datetime.now()
+                logfile.write(f'Exporting web tiles {_} at '
+                              f'{start_t.strftime("%H:%M:%S")} \n'
+                              )
+            # ground resolution of the ortho in m at its latitude
+            lat = wgs.project(_.transform.matrix.mulp(_.region.center)).y
+            res = _.orthomosaic.resolution
+            if is_geographic(_.crs):
+                res *= 111320
+            equator = 156543.03392 * np.cos(np.radians(lat))
+            if max_zoom is None:
+                z_max = int(np.ceil(np.log2(equator / res)))
+            else:
+                z_max = max_zoom
+            if min_zoom is None:
+                width = max(_.orthomosaic.width, _.orthomosaic.height) * res
+                z_min = int(np.clip(np.floor(np.log2(equator * 256 / width)),
+                                    0, z_max))
+            else:
+                z_min = min_zoom
+            name, num = self.file_parts(_)
+            folder = f'{self.prefix}{name}_Tiles{num}'
+            tile_dir = self.export_path / folder
+            tile_dir.mkdir(exist_ok=True)
+            state_file = tile_dir / 'tiles.json'
+            state = {'format': 'TMS' if tms else 'XYZ', 'done': {}}
+            if state_file.exists():
+                state = json.loads(state_file.read_text(encoding='utf-8'))
+            proj = Metashape.OrthoProjection()
+            proj.crs = web
+            for zoom in range(z_min, z_max + 1):
+                if str(zoom) in state['done']:
+                    print(f'Zoom level {zoom} already exported, skipped')
+                    continue
+                write_t = time.perf_counter()
+                _.exportRaster(progress=self.progress('exportRaster', _),
+                               path=str(tile_dir),
+                               format=(Metashape.RasterFormatTMS if tms
+                                       else Metashape.RasterFormatXYZ),
+                               image_format=tile_format,
+                               source_data=Metashape.OrthomosaicData,
+                               projection=proj,
+                               min_zoom_level=zoom,
+                               max_zoom_level=zoom,
+                               )
+                level_dir = tile_dir / str(zoom)
+                state['done'][str(zoom)] = {
+                    'tiles': sum(1 for f in level_dir.rglob('*')
+                                 if f.is_file()),
+                    'seconds': round(time.perf_counter() - write_t, 1),
+                }
+                state_file.write_text(json.dumps(state, indent=1),
+                                      encoding='utf-8')
+                print(f'Zoom level {zoom}: '
+                      f'{state["done"][str(zoom)]["tiles"]} tiles')
+            tiles = sum(v['tiles'] for v in state['done'].values())
+            self.add_manifest(_, 'Tiles', folder, zoom=[z_min, z_max],
+                              tiles=tiles, format=state['format'])
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                end_t = datetime.now()
+                self.runtime += end_t - start_t
+                logfile.write(f'Finished exporting web tiles {_} at '
+                              f'{end_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    Folder: {folder} \n'
+                              f'    Zoom levels: {z_min} - {z_max} \n'
+                              f'    Tiles: {tiles} \n'
+                              )
+                logfile.write(f'Processing time: {end_t - start_t} / '
+                              f'Total Time: {self.runtime} \n'
+                              )
+
+    def dsm_stats(self,
+                  *,
+                  bins=100,
+                  max_slope=60,
+                  block=16000000,
+                  ):
+        """
+        QA statistics of the exported DSM computed over memory mapped windows
+
+        Parameters: bins=number of histogram bins
+                    max_slope=slope in degrees above which a pixel is
+                        counted as a slope outlier
+                    block=number of pixels read at a time
+        Dependencies: export_geo() with self.raw_tiff or self.dsm_qa
+                        (uncompressed DSM), tiff_layout(), tiff_window(),
+                        hull_cells()
+
+        Two passes over row windows keep memory bounded by the block size:
+            the first gets min/max/mean/std and the valid extent of each
+            row, the second the histogram and slopes. Voids are counted
+            inside the convex hull of the valid cells, not the nodata
+            padding of the bounding box around the survey. The summary is
+            written to <DSM>_QA.json and the histogram to <DSM>_QA_hist.csv
+            next to the DSM.
+        """
+        for _ in self.chunks:
+            name, num = self.file_parts(_)
+            dsm = self.export_path / f'{self.prefix}{name}_DSM{num}.tif'
+            if not dsm.exists():
+                print(f'There is no exported DSM for chunk: {_}')
+                continue
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                start_t = datetime.now()
+                logfile.write(f'DSM QA {_} at '
+                              f'{start_t.strftime("%H:%M:%S")} \n'
+                              )
+            try:
+                layout = tiff_layout(dsm)
+            except ValueError as e:
+                print(e)
+                with open(self.log, 'a+', encoding='utf-8') as logfile:
+                    logfile.write(f'ERROR: {e} \n')
+                continue
+            x_size, y_size, _x, y_top = read_world(dsm)
+            if self.exp_crs == 0:
+                crs = _.crs
+            else:
+                crs = Metashape.CoordinateSystem(f'EPSG::{self.exp_crs}')
+            if is_geographic(crs):
+                # degrees to metres for the slope
+                x_size *= 111320 * np.cos(np.radians(y_top))
+                y_size *= 111320
+            height, width = layout['height'], layout['width']
+            rows = max(1, block // width)
+            nodata = layout['nodata']
+            if nodata is None:
+                nodata = np.nan
+            # pass 1: range, mean and valid extent of the rows
+            valid_n, total, total_sq = 0, 0.0, 0.0
+            low, high = np.inf, -np.inf
+            extents = []
+            for row in range(0, height, rows):
+                win = tiff_window(dsm, layout, row, min(row + rows, height))
+                valid = np.isfinite(win) & (win != nodata)
+                hit = np.nonzero(valid.any(axis=1))[0]
+                extents.append((row + hit,
+                                valid[hit].argmax(axis=1),
+                                width - 1 - valid[hit, ::-1].argmax(axis=1)))
+                vals = win[valid].astype(np.float64)
+                if vals.size:
+                    valid_n += vals.size
+                    total += vals.sum()
+                    total_sq += np.square(vals).sum()
+                    low = min(low, vals.min())
+                    high = max(high, vals.max())
+            if not valid_n:
+                print(f'The DSM of chunk {_} has no valid cells')
+                continue
+            mean = total / valid_n
+            std = np.sqrt(max(total_sq / valid_n - mean ** 2, 0))
+            footprint = hull_cells(*(np.concatenate(e)
+                                     for e in zip(*extents)))
+            # pass 2: histogram and slope with one row of overlap
+            edges = np.linspace(low, high, bins + 1)
+            hist = np.zeros(bins, dtype=np.int64)
+            slope_n, slope_sum, steep = 0, 0.0, 0
+            for row in range(0, height, rows):
+                top, end = max(row - 1, 0), min(row + rows + 1, height)
+                win = tiff_window(dsm, layout, top, end).astype(np.float64)
+                win[~np.isfinite(win) | (win == nodata)] = np.nan
+                core = win[row - top:row - top + min(rows, height - row)]
+                hist += np.histogram(core[np.isfinite(core)], edges)[0]
+                if win.shape[0] < 2 or width < 2:
+                    continue
+                d_row, d_col = np.gradient(win, abs(y_size), abs(x_size))
+                slope = np.degrees(np.arctan(np.hypot(d_row, d_col)))
+                slope = slope[row - top:row - top + core.shape[0]]
+                slope = slope[np.isfinite(slope)]
+                slope_n += slope.size
+                slope_sum += slope.sum()
+                steep += int(np.count_nonzero(slope > max_slope))
+            stats = {'dsm': dsm.name,
+                     'width': width,
+                     'height': height,
+                     'pixel_size': [x_size, abs(y_size)],
+                     'min': float(low),
+                     'max': float(high),
+                     'mean': float(mean),
+                     'std': float(std),
+                     'footprint_cells': footprint,
+                     'void_pcent': 100 * (1 - valid_n / footprint),
+                     'mean_slope': slope_sum / slope_n if slope_n else None,
+                     'max_slope': max_slope,
+                     'slope_outliers': steep,
+                     'slope_outlier_pcent': (100 * steep / slope_n
+                                             if slope_n else None),
+                     }
+            qa_json = dsm.with_name(f'{dsm.stem}_QA.json')
+            qa_json.write_text(json.dumps(stats, indent=1), encoding='utf-8')
+            with open(dsm.with_name(f'{dsm.stem}_QA_hist.csv'), 'w',
+                      encoding='utf-8') as csv:
+                csv.write('from,to,count\n')
+                for i, count in enumerate(hist):
+                    csv.write(f'{edges[i]},{edges[i + 1]},{count}\n')
+            self.add_manifest(_, 'DSM QA', qa_json.name)
+            print(f'DSM QA {_}: {stats}')
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                end_t = datetime.now()
+                self.runtime += end_t - start_t
+                logfile.write(f'Finished DSM QA {_} at '
+                              f'{end_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    Min/Max/Mean/Std: {round(low, 3)} / '
+                              f'{round(high, 3)} / {round(mean, 3)} / '
+                              f'{round(std, 3)} \n'
+                              f'    Voids in the data footprint: '
+                              f'{round(stats["void_pcent"], 2)} % \n'
+                              f'    Slope outliers (>{max_slope} deg): '
+                              f'{steep} \n'
+                              f'    Summary: {qa_json.name} \n'
+                              )
+                logfile.write(f'Processing time: {end_t - start_t} / '
+                              f'Total Time: {self.runtime} \n'
+                              )
+
+    def dsm_diff(self, *, ref_dsm=None, lod=0.0, block=16000000):
+        """
+        DSM of difference (DoD) between the exported DSM and a reference DSM
+
+        Parameters: ref_dsm=path of the reference (earlier epoch) DSM or a
+                        dict of chunk label: path (default: ask per chunk)
+                    lod=level of detection in m, smaller changes are not
+                        counted in the volumes
+                    block=number of pixels processed at a time
+        Dependencies: export_geo() (run from it if self.ref_dsm is set), a
+                        reference DSM with world file in the same CRS,
+                        tiff_layout(), tiff_decompress(), tiff_window(),
+                        tiff_create()
+
+        The DoD (new - reference) is written on the grid of the new DSM.
+            Compressed DSMs (the default LZW export) are first decompressed
+            strip by strip to a temporary BigTIFF. The reference is read one
+            row window at a time from memory maps, clamped to the overlap
+            and sized so it stays within the block, and resampled to the new
+            grid: nearest neighbour if it is coarser, the mean of the
+            reference cells in each new cell if it is finer. Volume change
+            statistics go to <DoD>.json and the log.
+        """
+        for _ in self.chunks:
+            name, num = self.file_parts(_)
+            dsm = self.export_path / f'{self.prefix}{name}_DSM{num}.tif'
+            if isinstance(ref_dsm, dict):
+                ref = ref_dsm.get(_.label)
+            elif ref_dsm:
+                ref = ref_dsm
+            else:
+                ref = Metashape.app.getOpenFileName(
+                    f'Select reference DSM for {_.label}', filter='*.tif')
+            if not dsm.exists() or not ref:
+                print(f'No DSM or reference DSM for chunk: {_}')
+                continue
+            ref = Path(ref)
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                start_t = datetime.now()
+                logfile.write(f'DSM differencing {_} at '
+                              f'{start_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    Reference DSM: {ref} \n'
+                              f'    Level of detection: {lod} \n'
+                              )
+            file = f'{self.prefix}{name}_DoD{num}.tif'
+            raws = []
+            try:
+                new_l, ref_l = [tiff_layout(p, compressed=True)
+                                for p in (dsm, ref)]
+                if new_l['compression'] != 1:
+                    raws.append(self.export_path / f'{dsm.stem}_raw_tmp.tif')
+                    new_l = tiff_decompress(dsm, raws[-1])
+                    new_raw = raws[-1]
+                else:
+                    new_raw = dsm
+                if ref_l['compression'] != 1:
+                    raws.append(self.export_path / f'{ref.stem}_ref_tmp.tif')
+                    ref_l = tiff_decompress(ref, raws[-1])
+                    ref_raw = raws[-1]
+                else:
+                    ref_raw = ref
+                change = self.diff_rasters(_, new_raw, new_l, ref_raw,
+                                           ref_l, read_world(dsm),
+                                           read_world(ref), file, lod,
+                                           block)
+            except ValueError as e:
+                print(e)
+                with open(self.log, 'a+', encoding='utf-8') as logfile:
+                    logfile.write(f'ERROR: {e} \n')
+                continue
+            finally:
+                for tmp in raws:
+                    if tmp.exists():
+                        tmp.unlink()
+            stats = {'dsm': dsm.name,
+                     'reference': str(ref),
+                     'dod': file,
+                     'lod': lod,
+                     **change,
+                     }
+            qa_json = (self.export_path / file).with_suffix('.json')
+            qa_json.write_text(json.dumps(stats, indent=1), encoding='utf-8')
+            self.add_manifest(_, 'DoD', file, reference=str(ref))
+            print(f'DSM difference {_}: {stats}')
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                end_t = datetime.now()
+                self.runtime += end_t - start_t
+                logfile.write(f'Finished DSM differencing {_} at '
+                              f'{end_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    File: {file} \n'
+                              '    Cells compared: '
+                              f'{stats["cells_compared"]} \n'
+                              '    Volume gain/loss/net: '
+                              f'{round(stats["volume_gain"], 2)} / '
+                              f'{round(stats["volume_loss"], 2)} / '
+                              f'{round(stats["volume_net"], 2)} \n'
+                              )
+                logfile.write(f'Processing time: {end_t - start_t} / '
+                              f'Total Time: {self.runtime} \n'
+                              )
+
+    def diff_rasters(self, chunk, new, new_l, ref, ref_l, new_world,
+                     ref_world, file, lod, block):
+        """
+        Helper function of dsm_diff writing the DoD and its statistics
+
+        Input: chunk - the chunk of the new DSM (for the CRS)
+                new, ref - uncompressed new and reference DSM files
+                new_l, ref_l - their tiff_layout()
+                new_world, ref_world - their read_world()
+                file - DoD file name in the export folder
+                lod - level of detection in m
+                block - number of pixels processed at a time
+        Output: dict of the change statistics
+        Dependencies: tiff_window(), tiff_create(), write_world()
+        """
+        xs, ys, x0, y0 = new_world
+        rxs, rys, rx0, ry0 = ref_world
+        height, width = new_l['height'], new_l['width']
+        ref_h, ref_w = ref_l['height'], ref_l['width']
+        # reference cells per new cell, > 1 where the reference is finer
+        fine_r, fine_c = abs(ys / rys), abs(xs / rxs)
+        mean_cells = fine_r > 1 and fine_c > 1
+
+        def span(to_new, start, stop, size):
+            """Reference cells mapping into new cells start to stop"""
+            ends = [(v - to_new(0)) / (to_new(1) - to_new(0))
+                    for v in (start, stop)]
+            return (int(np.clip(np.floor(min(ends)) - 1, 0, size)),
+                    int(np.clip(np.ceil(max(ends)) + 2, 0, size)))
+
+        def new_rows(r):
+            return (ry0 + np.asarray(r) * rys - y0) / ys
+
+        def new_cols(c):
+            return (rx0 + np.asarray(c) * rxs - x0) / xs
+
+        # reference columns overlapping the new grid
+        c_lo, c_hi = span(new_cols, -0.5, width - 0.5, ref_w)
+        ref_cols = np.arange(c_lo, c_hi)
+        rows = max(1, int(block / (max(width, c_hi - c_lo)
+                                   * max(1.0, fine_r))))
+        nodata = -32767.0
+        dod = tiff_create(self.export_path / file, width, height,
+                          np.float32, nodata=nodata)
+        write_world(self.export_path / file, xs, ys, x0, y0)
+        if mean_cells:
+            nc = np.rint(new_cols(ref_cols)).astype(np.int64)
+            ck = (nc >= 0) & (nc < width)
+        else:
+            # reference column of every new column
+            ref_col = np.rint((x0 + np.arange(width) * xs - rx0) / rxs) \
+                .astype(np.int64)
+            col_ok = (ref_col >= 0) & (ref_col < ref_w)
+        area = abs(xs * ys)
+        if is_geographic(chunk.crs if self.exp_crs == 0 else
+                         Metashape.CoordinateSystem(
+                             f'EPSG::{self.exp_crs}')):
+            area *= 111320 ** 2 * np.cos(np.radians(y0))
+        count, total, total_sq = 0, 0.0, 0.0
+        gain, loss, gain_n, loss_n = 0.0, 0.0, 0, 0
+        for row in range(0, height, rows):
+            end = min(row + rows, height)
+            new_win = tiff_window(new, new_l, row, end).astype(np.float64)
+            new_win[~np.isfinite(new_win)
+                    | (new_win == new_l['nodata'])] = np.nan
+            out = np.full(new_win.shape, np.nan)
+            if mean_cells:
+                r_lo, r_hi = span(new_rows, row - 0.5, end - 0.5, ref_h)
+                nr = np.rint(new_rows(np.arange(r_lo, r_hi))) \
+                    .astype(np.int64) - row
+                rk = (nr >= 0) & (nr < end - row)
+                if rk.any() and ck.any():
+                    old = tiff_window(ref, ref_l, r_lo, r_hi, c_lo, c_hi)
+                    old = old[np.ix_(rk, ck)].astype(np.float64)
+                    idx = nr[rk][:, None] * width + nc[ck][None, :]
+                    ok = np.isfinite(old) & (old != ref_l['nodata'])
+                    cells = (end - row) * width
+                    sums = np.bincount(idx[ok], old[ok], cells)
+                    hits = np.bincount(idx[ok], minlength=cells)
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        out = new_win - (sums / hits).reshape(out.shape)
+            else:
+                ref_row = np.rint((y0 + np.arange(row, end) * ys - ry0)
+                                  / rys).astype(np.int64)
+                row_ok = (ref_row >= 0) & (ref_row < ref_h)
+                if row_ok.any() and col_ok.any():
+                    r_min = int(ref_row[row_ok].min())
+                    r_max = int(ref_row[row_ok].max()) + 1
+                    c_min = int(ref_col[col_ok].min())
+                    c_max = int(ref_col[col_ok].max()) + 1
+                    old = tiff_window(ref, ref_l, r_min, r_max, c_min,
+                                      c_max).astype(np.float64)
+                    old[~np.isfinite(old)
+                        | (old == ref_l['nodata'])] = np.nan
+                    sub = old[np.ix_(ref_row[row_ok] - r_min,
+                                     ref_col[col_ok] - c_min)]
+                    out[np.ix_(row_ok, col_ok)] = \
+                        new_win[np.ix_(row_ok, col_ok)] - sub
+            valid = np.isfinite(out)
+            vals = out[valid]
+            count += vals.size
+            total += vals.sum()
+            total_sq += np.square(vals).sum()
+            gain += vals[vals > lod].sum() * area
+            loss += vals[vals < -lod].sum() * area
+            gain_n += int(np.count_nonzero(vals > lod))
+            loss_n += int(np.count_nonzero(vals < -lod))
+            dod[row:end] = np.where(valid, out, nodata)
+        dod.flush()
+        del dod
+        mean = total / count if count else None
+        return {'cells_compared': count,
+                'mean_change': mean,
+                'std_change': (np.sqrt(max(total_sq / count - mean ** 2, 0))
+                               if count else None),
+                'reference_resampling': 'mean' if mean_cells else 'nearest',
+                'volume_gain': gain,
+                'volume_loss': loss,
+                'volume_net': gain + loss,
+                'area_gain': gain_n * area,
+                'area_loss': loss_n * area,
+                }
+
+    def merge_rasters(self, files, out_file, *, feather=50,
+                      block=16000000):
+        """
+        Helper function to mosaic rasters window by window
+
+        Input: files - list of uncompressed rasters with world files
+                out_file - the merged raster in the export folder
+                feather=blend distance in pixels from each raster edge
+                block=number of output pixels processed at a time
+        Output: (width, height) of the merged raster
+        Dependencies: tiff_layout(), tiff_window(), tiff_create()
+
+        Overlapping pixels are blended with weights ramping up over the
+            feather distance from each raster edge. Nodata (or alpha 0 /
+            black for orthos) is ignored. Sources are sampled by nearest
+            neighbour on the grid of the first raster.
+        """
+        srcs = [(f, tiff_layout(f), read_world(f)) for f in files]
+        first = srcs[0][1]
+        xs, ys = srcs[0][2][:2]
+        bands, dtype = first['bands'], first['dtype']
+        left = min(w[2] - w[0] / 2 for _, _, w in srcs)
+        right = max(w[2] + (lay['width'] - 0.5) * w[0]
+                    for _, lay, w in srcs)
+        top = max(w[3] - w[1] / 2 for _, _, w in srcs)
+        bottom = min(w[3] + (lay['height'] - 0.5) * w[1]
+                     for _, lay, w in srcs)
+        width = int(np.ceil((right - left) / xs))
+        height = int(np.ceil((bottom - top) / ys))
+        x0, y0 = left + xs / 2, top + ys / 2
+        nodata = first['nodata']
+        out = tiff_create(self.export_path / out_file, width, height,
+                          dtype, bands, nodata=nodata)
+        write_world(self.export_path / out_file, xs, ys, x0, y0)
+        # source columns of every output column
+        cols = []
+        for _, lay, (sxs, sys_, sx0, sy0) in srcs:
+            col = np.rint((x0 + np.arange(width) * xs - sx0) / sxs) \
+                .astype(np.int64)
+            cols.append((col, (col >= 0) & (col < lay['width'])))
+        rows = max(1, block // width)
+        for row in range(0, height, rows):
+            end = min(row + rows, height)
+            total = np.zeros((end - row, width, bands))
+            weight = np.zeros((end - row, width))
+            for (f, lay, (sxs, sys_, sx0, sy0)), (col, col_ok) in \
+                    zip(srcs, cols):
+                src_row = np.rint((y0 + np.arange(row, end) * ys - sy0)
+                                  / sys_).astype(np.int64)
+                row_ok = (src_row >= 0) & (src_row < lay['height'])
+                if not row_ok.any() or not col_ok.any():
+                    continue
+                r_sel, c_sel = src_row[row_ok], col[col_ok]
+                win = tiff_window(f, lay, int(r_sel.min()),
+                                  int(r_sel.max()) + 1, int(c_sel.min()),
+                                  int(c_sel.max()) + 1)
+                win = win.reshape(win.shape[0], win.shape[1], -1)
+                vals = win[np.ix_(r_sel - r_sel.min(),
+                                  c_sel - c_sel.min())].astype(np.float64)
+                # feathered weights from the source edges
+                d_row = np.minimum(r_sel, lay['height'] - 1 - r_sel)
+                d_col = np.minimum(c_sel, lay['width'] - 1 - c_sel)
+                wts = np.clip((np.minimum(d_row[:, None], d_col[None, :])
+                               + 1) / feather, 0, 1)
+                if lay['nodata'] is not None:
+                    wts[np.any(vals == lay['nodata'], axis=2)] = 0
+                elif bands in (2, 4):
+                    wts[vals[..., -1] == 0] = 0
+                elif dtype.kind == 'u':
+                    wts[np.all(vals == 0, axis=2)] = 0
+                wts[~np.all(np.isfinite(vals), axis=2)] = 0
+                total[np.ix_(row_ok, col_ok)] += \
+                    np.nan_to_num(vals) * wts[..., None]
+                weight[np.ix_(row_ok, col_ok)] += wts
+            valid = weight > 0
+            merged = total / np.where(valid, weight, 1)[..., None]
+            if nodata is not None:
+                merged[~valid] = nodata
+            elif bands in (2, 4):
+                merged[..., -1] = np.where(valid, np.iinfo(dtype).max
+                                           if dtype.kind == 'u'
+                                           else 1, 0)
+            if dtype.kind in 'ui':
+                merged = np.rint(merged)
+            out[row:end] = merged.astype(dtype).reshape(out[row:end].shape)
+        out.flush()
+        del out
+        return width, height
+
+    def merge_las(self, files, out_file, *, block=5000000):
+        """
+        Helper function to merge LAS files streaming
+
+        Input: files - list of LAS files with the same point format
+                out_file - the merged LAS in the export folder
+                block=number of points read at a time
+        Output: number of points written
+        Dependencies: read_las(), las_header()
+
+        Tiles overlap, so a point is kept only from the file whose bounds
+            centre is nearest to it, found one centre at a time so memory
+            stays at a few arrays of the block size. Points are rescaled to
+            the scale and offset of the first file.
+        """
+        lases = [read_las(f) for f in files]
+        header, _, scale, offset = lases[0]
+        rec_len = lases[0][1].dtype.itemsize
+        if any(p.dtype.itemsize != rec_len for _, p, _, _ in lases):
+            raise ValueError('LAS files have different point formats')
+        centres = np.array([
+            (np.frombuffer(h, '<f8', 6, 179)[[0, 2]]
+             + np.frombuffer(h, '<f8', 6, 179)[[1, 3]]) / 2
+            for h, _, _, _ in lases])
+        count, low, high = 0, np.full(3, np.inf), np.full(3, -np.inf)
+        with open(self.export_path / out_file, 'wb') as out:
+            out.write(header)
+            for t, (_, points, t_scale, t_offset) in enumerate(lases):
+                raw = points.view(np.dtype((np.void, rec_len)))
+                for start in range(0, len(points), block):
+                    window = points[start:start + block]
+                    xyz = np.column_stack([window['X'], window['Y'],
+                                           window['Z']]) * t_scale + t_offset
+                    # nearest centre, ties go to the first file
+                    best = np.full(len(xyz), np.inf)
+                    owner = np.zeros(len(xyz), dtype=np.int64)
+                    for k, (cx, cy) in enumerate(centres):
+                        dist = (xyz[:, 0] - cx) ** 2 + (xyz[:, 1] - cy) ** 2
+                        closer = dist < best
+                        best[closer] = dist[closer]
+                        owner[closer] = k
+                    keep = owner == t
+                    if not keep.any():
+                        continue
+                    recs = np.array(raw[start:start + block][keep])
+                    if np.any(t_scale != scale) or np.any(t_offset != offset):
+                        ints = recs.view(points.dtype)
+                        new = np.rint((xyz[keep] - offset) / scale) \
+                            .astype('<i4')
+                        ints['X'], ints['Y'], ints['Z'] = new.T
+                    out.write(recs.tobytes())
+                    count += int(np.count_nonzero(keep))
+                    low = np.minimum(low, xyz[keep].min(axis=0))
+                    high = np.maximum(high, xyz[keep].max(axis=0))
+            out.seek(0)
+            out.write(las_header(header, count, low, high))
+        return count
+
+    def merge_tiles(self, *, groups=None, feather=50):
+        """
+        Merge the exported DSM, ortho and LAS of tiled chunks per site
+
+        Parameters: groups=dict of site name: list of chunks (default
+                        self.tile_groups from split_chunks, or after a
+                        reload the tiles tagged by split_chunks)
+                    feather=raster blend distance in pixels
+        Dependencies: export_geo() with self.raw_tiff (uncompressed TIFF),
+                        merge_rasters(), merge_las(), the export manifest
+        Raises: ValueError if no groups are given or found
+
+        Output files are <prefix><site>_<DSM/Ortho/LAS>_merged, the
+            merge time of each asset is logged. Memory is bounded by the
+            window and block sizes. PNG/JPG orthos (JPG input) cannot be
+            memory mapped and are skipped with a note in the log.
+        """
+        if not groups:
+            groups = self.tile_groups
+        if not groups:
+            groups = {}
+            for chunk in self.doc.chunks:
+                site = chunk.meta['MSProc/tile_of']
+                if site:
+                    groups.setdefault(site, []).append(chunk)
+        if not groups:
+            raise ValueError('No tile groups: run split_chunks first or '
+                             'pass groups={site: [chunks]}.')
+        entries = []
+        if self.manifest.exists():
+            entries = json.loads(self.manifest.read_text(encoding='utf-8'))
+        for site, chunks in groups.items():
+            labels = {c.label for c in chunks}
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                start_t = datetime.now()
+                logfile.write(f'Merging {site} at '
+                              f'{start_t.strftime("%H:%M:%S")} \n'
+                              f'    Chunks: {sorted(labels)} \n'
+                              )
+            for kind, ext in (('DSM', '.tif'), ('Ortho', '.tif'),
+                              ('LAS', '.las')):
+                files = [self.export_path / e['file'] for e in entries
+                         if e['kind'] == kind and e['chunk'] in labels
+                         and e['prefix'] == self.prefix]
+                skipped = [f.name for f in files if f.suffix != ext]
+                files = [f for f in files if f.suffix == ext]
+                if skipped:
+                    t = (f'{kind} of {site}: {len(skipped)} files skipped, '
+                         f'only {ext} can be merged: {skipped}\n')
+                    print(t)
+                    with open(self.log, 'a+', encoding='utf-8') as logfile:
+                        logfile.write(t)
+                if len(files) < 2:
+                    continue
+                out_file = f'{self.prefix}{site}_{kind}_merged{ext}'
+                write_t = time.perf_counter()
+                try:
+                    if kind == 'LAS':
+                        info = {'points': self.merge_las(files, out_file)}
+                    else:
+                        size = self.merge_rasters(files, out_file,
+                                                  feather=feather)
+                        info = {'size': size}
+                except ValueError as e:
+                    t = f'ERROR: {kind} of {site} not merged: {e}\n'
+                    print(t)
+                    with open(self.log, 'a+', encoding='utf-8') as logfile:
+                        logfile.write(t)
+                    continue
+                with open(self.log, 'a+', encoding='utf-8') as logfile:
+                    self.record_export(logfile, chunks[0], f'{kind} merged',
+                                       out_file, write_t,
+                                       sources=[f.name for f in files],
+                                       **info)
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                end_t = datetime.now()
+                self.runtime += end_t - start_t
+                logfile.write(f'Finished merging {site} at '
+                              f'{end_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'Processing time: {end_t - start_t} / '
+                              f'Total Time: {self.runtime} \n'
+                              )
+
+    def export_model(self):
+        """
+        Export the point cloud and model to path using the file name prefix
+
+        Point cloud format is self.pc_format (las, laz), model format is
+            self.mesh_format (obj, binary ply, glb).
+        Texture file format is self.tex_format, if blank JPG for JPG input
+            images and TIF for all others.
+        """
+        if self.pc_format not in self.pc_dict:
+            raise ValueError('Unknown point cloud export format (las, laz).')
+        if self.mesh_format not in self.mesh_dict:
+            raise ValueError('Unknown mesh export format (obj, ply, glb).')
+        for _ in self.chunks:
+            if self.tex_format:
+                ext = self.tex_dict[self.tex_format]
+            elif _.cameras[0].label[-3:].upper() == 'JPG':
+                # Texture JPG as Cloudcompare doesn't like the TIFF format
+                ext = Metashape.ImageFormatJPEG
+            else:
+                ext = Metashape.ImageFormatTIFF
+            if self.exp_crs == 0:
+                crs = _.crs
+            else:
+                crs = Metashape.CoordinateSystem(f'EPSG::{self.exp_crs}')
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                start_t = datetime.now()
+                logfile.write(f'Exporting LAS & model {_} at '
+                              f'{start_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    Export CRS: {crs}\n'
+                              f'    Formats: {self.pc_format}, '
+                              f'{self.mesh_format}, {ext}\n'
+                              )
+                # create export file name
+                name, num = self.file_parts(_)
+                try:
+                    file = (f'{self.prefix}{name}_{self.pc_format.upper()}'
+                            f'{num}.{self.pc_format}'
+                            )
+                    write_t = time.perf_counter()
+                    _.exportPointCloud(path=str(self.export_path / file),
+                                       format=self.pc_dict[self.pc_format],
+                                       crs=crs,
+                                       classes=CLEAN_CLASSES,
+                                       progress=self.progress(
+                                           'exportPointCloud', _),
+                                       )
+                    self.record_export(logfile, _, self.pc_format.upper(),
+                                       file, write_t,
+                                       points=_.point_cloud.point_count
+                                       )
+                    # level of detail pyramid (streamed from the LAS)
+                    if self.pc_format == 'las':
+                        lods = self.export_lods(_, file)
+                    else:
+                        lods = []
+                        if self.lods or self.lod_voxels:
+                            t = 'Levels of detail need LAS export, skipped\n'
+                            print(t)
+                            logfile.write(t)
+                    for lod_file, count in lods:
+                        t = f'File: {lod_file} ({count} points)\n'
+                        print(t)
+                        logfile.write(t)
+                except RuntimeError as e:
+                    if str(e) == 'Null point cloud':
+                        t = ('There is no point cloud '
+                             f'to export in chunk: {_}\n')
+                        print(t)
+                        logfile.write(t)
+                    else:
+                        raise
+                try:
+                    file = (f'{self.prefix}{name}_{self.mesh_format.upper()}'
+                            f'{num}.{self.mesh_format}'
+                            )
+                    write_t = time.perf_counter()
+                    _.exportModel(progress=self.progress('exportModel', _),
+                                  path=str(self.export_path / file),
+                                  format=self.mesh_dict[self.mesh_format],
+                                  binary=self.mesh_format != 'obj',
+                                  texture_format=ext,
+                                  crs=crs,
+                                  )
+                    self.record_export(logfile, _, self.mesh_format.upper(),
+                                       file, write_t
+                                       )
+                except Exception as e:
+                    if str(e) == 'Null model':
+                        t = f'There is no model to export in chunk: {_}\n'
+                        print(t)
+                        logfile.write(t)
+                    else:
+                        raise
+                # export report
+                try:
+                    file = f'{self.prefix}{name}_Report{num}.pdf'
+                    write_t = time.perf_counter()
+                    _.exportReport(progress=self.progress('exportReport', _),
+                                   path=str(self.export_path / file),
+                                   title=Path(file).stem,
+                                   include_system_info=False,
+                                   )
+                    self.record_export(logfile, _, 'Report', file, write_t)
+                except Exception as e:
+                    print(f'Error exporting report: {e}\n')
+            self.record_stage(_, 'export_model', datetime.now() - start_t,
+                              pc_format=self.pc_format,
+                              mesh_format=self.mesh_format)
+
+    def progress(self, stage, chunk, *, interval=0.25, alpha=0.3):
+        """
+        Rate limited progress callback for a Metashape call
+
+        Input: stage - name of the call
+                chunk - the chunk processed
+                interval - minimum seconds between updates
+                alpha - smoothing factor of the throughput
+        Output: callback(percent) for the progress parameter
+
+        Updates are published at most every interval seconds: the console
+            on every whole percent, the log every 10 % and self.status_file
+            (JSON, replaced atomically) on every update. Throughput is an
+            exponentially weighted moving average in % per second.
+        """
+        self.stage = stage
+        self.stage_chunk = str(chunk)
+        start = time.monotonic()
+        state = {'t': start, 'p': 0.0, 'rate': 0.0, 'shown': -1, 'logged': 0}
+
+        def callback(percent):
+            now = time.monotonic()
+            if now - state['t'] < interval and percent < 100:
+                return
+            rate = (percent - state['p']) / max(now - state['t'], 1e-6)
+            if state['rate']:
+                rate = alpha * rate + (1 - alpha) * state['rate']
+            state.update(t=now, p=percent, rate=rate)
+            eta = (100 - percent) / rate if rate > 0 else None
+            eta_t = timedelta(seconds=round(eta)) if eta is not None \
+                else 'unknown'
+            t = (f'{stage} {chunk}: {percent:.1f} %, '
+                 f'{rate:.3f} %/s, ETA {eta_t}')
+            if int(percent) != state['shown']:
+                state['shown'] = int(percent)
+                print(t)
+            if percent >= state['logged'] + 10:
+                state['logged'] = 10 * int(percent // 10)
+                with open(self.log, 'a+', encoding='utf-8') as logfile:
+                    logfile.write(f'    {t} \n')
+            status = {'project': str(self.doc_path),
+                      'chunk': str(chunk),
+                      'stage': stage,
+                      'percent': round(percent, 2),
+                      'rate': round(rate, 4),
+                      'eta_s': round(eta) if eta is not None else None,
+                      'elapsed_s': round(now - start),
+                      'updated': datetime.now().isoformat(timespec='seconds'),
+                      }
+            tmp = self.status_file.with_suffix('.tmp')
+            try:
+                tmp.write_text(json.dumps(status), encoding='utf-8')
+                tmp.replace(self.status_file)
+            except OSError:
+                # monitoring must not stop the processing
+                pass
+        return callback
+
+    def start_monitor(self, interval=None):
+        """
+        Start the resource monitor thread
+
+        Parameters: interval=seconds between samples (default
+                        self.monitor_interval)
+        Dependencies: read_usage(), monitor()
+
+        Samples /proc on Linux and needs psutil on Windows and macOS,
+            otherwise it is not started (noted in the log). Started by
+            run_geo(), run_model() and sweep() and stopped with
+            stop_monitor() when they finish. Does nothing if the monitor is
+            already running.
+        """
+        if interval:
+            self.monitor_interval = interval
+        if self.monitor_thread and self.monitor_thread.is_alive():
+            return
+        if read_usage() is None:
+            t = ('Resource monitor not started: no /proc and psutil is not '
+                 'installed \n')
+            print(t)
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                logfile.write(t)
+            return
+        self.monitor_stop.clear()
+        self.monitor_thread = threading.Thread(target=self.monitor,
+                                               daemon=True,
+                                               name='MSProc monitor')
+        self.monitor_thread.start()
+        print(f'Resource timeline: {self.monitor_file}')
+
+    def stop_monitor(self):
+        """
+        Stop the resource monitor thread after its last sample and summary
+
+        Dependencies: start_monitor()
+        """
+        if self.monitor_thread is None:
+            return
+        self.monitor_stop.set()
+        self.monitor_thread.join()
+        self.monitor_thread = None
+
+    def monitor(self):
+        """
+        Resource monitor loop, run in a thread by start_monitor()
+
+        Each sample row of self.monitor_file has the time, chunk, call,
+            system CPU %, process CPU % (of one core), process RSS (MB),
+            system memory used %, swap used (MB) and process disk read/write
+            (MB/s). When the chunk or call changes the peak and average of
+            the previous one are written to the log.
+        Dependencies: read_usage(), log_resources()
+        """
+        cols = ['time', 'chunk', 'stage', 'cpu', 'proc_cpu', 'rss_mb',
+                'mem_pct', 'swap_mb', 'read_mb_s', 'write_mb_s']
+        if not self.monitor_file.exists():
+            self.monitor_file.write_text(','.join(cols) + '\n',
+                                         encoding='utf-8')
+        last = read_usage()
+        last_t = time.monotonic()
+        key = None
+        samples = []
+        while not self.monitor_stop.wait(self.monitor_interval):
+            now = read_usage()
+            now_t = time.monotonic()
+            span = max(now_t - last_t, 1e-6)
+            jiffies = max(now['total'] - last['total'], 1)
+            # process jiffies per second at 100 Hz
+            row = [100 * (1 - (now['idle'] - last['idle']) / jiffies),
+                   (now['proc'] - last['proc']) / span,
+                   now['rss'] / 1024,
+                   100 * (1 - now['mem_avail'] / max(now['mem_total'], 1)),
+                   now['swap_used'] / 1024,
+                   (now['read'] - last['read']) / span / 2 ** 20,
+                   (now['write'] - last['write']) / span / 2 ** 20,
+                   ]
+            last, last_t = now, now_t
+            if (self.stage_chunk, self.stage) != key:
+                self.log_resources(key, samples)
+                key = (self.stage_chunk, self.stage)
+                samples = []
+                self.stage_peak = None
+            samples.append(row)
+            self.stage_peak = max(self.stage_peak or 0, row[2])
+            line = ','.join([datetime.now().isoformat(timespec='seconds'),
+                             f'"{key[0]}"', key[1]]
+                            + [f'{v:.1f}' for v in row])
+            try:
+                with open(self.monitor_file, 'a', encoding='utf-8') as f:
+                    f.write(line + '\n')
+            except OSError:
+                pass
+        self.log_resources(key, samples)
+
+    def log_resources(self, key, samples):
+        """
+        Write the peak and average resource use of a call to the log
+
+        Input: key - (chunk, call) of the samples
+                samples - list of sample rows of monitor()
+        """
+        if not samples or not key or not key[1]:
+            return
+        data = np.array(samples)
+        peak = data.max(axis=0)
+        mean = data.mean(axis=0)
+        with open(self.log, 'a+', encoding='utf-8') as logfile:
+            logfile.write(f'    Resources {key[1]} {key[0]} '
+                          f'({len(samples)} samples, peak/average): '
+                          f'CPU {peak[0]:.0f}/{mean[0]:.0f} %, '
+                          f'process CPU {peak[1]:.0f}/{mean[1]:.0f} %, '
+                          f'RSS {peak[2]:.0f}/{mean[2]:.0f} MB, '
+                          f'memory {peak[3]:.0f}/{mean[3]:.0f} %, '
+                          f'swap {peak[4]:.0f}/{mean[4]:.0f} MB, '
+                          f'read {peak[5]:.1f}/{mean[5]:.1f} MB/s, '
+                          f'write {peak[6]:.1f}/{mean[6]:.1f} MB/s \n'
+                          )
+
+    def preflight(self,
+                  *,
+                  workflow='geo',
+                  overlap=6,
+                  warn=0.8,
+                  force=None,
+                  ):
+        """
+        Estimate the product sizes and check the run can finish
+
+        Parameters: workflow='geo' (DEM, ortho, point cloud) or 'model'
+                        (point cloud, mesh)
+                    overlap=mean number of images seeing a ground point
+                    warn=fraction of the free space above which to warn
+                    force=boolean (only warn if the estimate exceeds the
+                        free space, default self.preflight_force)
+        Output: dict of estimated bytes per product and chunk
+        Raises: MSPreflightCheck if the export folder is not writable, the
+            export CRS is not a valid EPSG code or (unless forced) the
+            estimate exceeds the free space of the project or export volume
+
+        The estimates are rough upper bounds from the enabled cameras,
+            image size, depth map quality and export formats: the ground
+            covered is cameras * pixels / overlap at image resolution, one
+            point per depth map pixel of it, the DEM at half and the
+            ortho at full image resolution.
+        """
+        if force is None:
+            force = self.preflight_force
+        problems = []
+        # export folder and CRS
+        test = self.export_path / '.msproc_write_test'
+        try:
+            test.touch()
+            test.unlink()
+        except OSError as e:
+            problems.append(f'export folder {self.export_path} not '
+                            f'writable ({e})')
+        if self.exp_crs:
+            try:
+                Metashape.CoordinateSystem(f'EPSG::{self.exp_crs}')
+            except (RuntimeError, ValueError):
+                problems.append(f'export CRS EPSG::{self.exp_crs} not valid')
+        estimates = {}
+        project = 0
+        export = 0
+        for _ in self.chunks:
+            cams = [c for c in _.cameras if c.enabled and c.sensor]
+            if not cams:
+                continue
+            pixels = float(np.median([c.sensor.width * c.sensor.height
+                                      for c in cams]))
+            qual = self.depth_plan.get(str(_), self.depth_qual)
+            ground = len(cams) * pixels / overlap
+            points = ground / qual ** 2
+            est = {'depth maps': len(cams) * pixels / qual ** 2 * 4,
+                   'point cloud': points * 30,
+                   self.pc_format.upper(): points * (34 if self.pc_format
+                                                     == 'las' else 6),
+                   }
+            if workflow == 'geo':
+                raw = 1 if self.raw_tiff or self.dsm_qa else 0.5
+                est['DEM'] = ground / (2 * qual) ** 2 * 4 * raw
+                est['Ortho'] = ground * 4 * (1 if self.raw_tiff else 0.3)
+            else:
+                # Medium face count, vertices, uv and faces and texture
+                est[self.mesh_format.upper()] = points / 15 * 100 \
+                    + 4096 ** 2 * 3
+            estimates[str(_)] = est
+            project += est['depth maps'] + est['point cloud']
+            export += sum(v for k, v in est.items()
+                          if k not in ('depth maps', 'point cloud'))
+        # compare with the free space, once if on the same volume
+        need = {self.doc_path.parent: project, self.export_path: export}
+        if self.doc_path.parent.stat().st_dev == \
+                self.export_path.stat().st_dev:
+            need = {self.export_path: project + export}
+        lines = [f'    {label}: ' + ', '.join(f'{k} {v / 2 ** 30:.1f} GB'
+                                              for k, v in est.items())
+                 + ' \n' for label, est in estimates.items()]
+        for path, size in need.items():
+            free = shutil.disk_usage(path).free
+            t = (f'    {path}: {size / 2 ** 30:.1f} GB needed, '
+                 f'{free / 2 ** 30:.1f} GB free \n')
+            lines.append(t)
+            if size > free and force:
+                print('WARNING: estimate exceeds the free space (forced): '
+                      f'{t.strip()}')
+                lines.append('    WARNING: estimate exceeds the free space, '
+                             'run forced \n')
+            elif size > free:
+                problems.append(t.strip())
+            elif size > warn * free:
+                print(f'WARNING: little space left: {t.strip()}')
+        print(''.join(lines))
+        # write log information
+        with open(self.log, 'a+', encoding='utf-8') as logfile:
+            logfile.write(f'Preflight check ({workflow}) at '
+                          f'{datetime.now().strftime("%H:%M:%S")} \n')
+            logfile.write(''.join(lines))
+            if problems:
+                logfile.write('    ' + '\n    '.join(problems) + ' \n')
+        if problems:
+            raise MSPreflightCheck(problems)
+        return estimates
+
+    def history_db(self):
+        """
+        Open the run history database, creating it if needed
+
+        Output: sqlite3 connection with the table stages, one row per
+            project, chunk and stage run
+        """
+        self.history.parent.mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(self.history)
+        db.execute('CREATE TABLE IF NOT EXISTS stages ('
+                   'id INTEGER PRIMARY KEY, finished TEXT, project TEXT, '
+                   'chunk TEXT, stage TEXT, params TEXT, cameras INTEGER, '
+                   'tie_points INTEGER, points INTEGER, size REAL, '
+                   'wall REAL, peak_mb REAL)'
+                   )
+        return db
+
+    def stage_size(self, chunk, stage):
+        """
+        Size measure a stage's time is modelled against
+
+        Input: chunk - the chunk to be processed
+                stage - name of the stage (method)
+        Output: enabled cameras for alignment and gradual selection,
+            otherwise enabled cameras / depth map downscale squared (depth
+            map pixels)
+        """
+        cams = len([c for c in chunk.cameras if c.enabled])
+        if stage in ('align', 'align_new', 'grad_sel_pregcp',
+                     'grad_sel_postgcp', 'grad_sel_combined'):
+            return float(cams)
+        qual = self.depth_plan.get(str(chunk), self.depth_qual)
+        return cams / qual ** 2
+
+    def record_stage(self, chunk, stage, wall, **params):
+        """
+        Add a finished stage to the run history
+
+        Input: chunk - the processed chunk
+                stage - name of the stage (method)
+                wall - timedelta of the stage
+                params - parameters of the stage to keep with it
+        Dependencies: history_db(), stage_size(), print_eta(),
+                peak_memory(), reset_peak_memory()
+
+        The peak memory is exact on Linux and where the stage set a new
+            lifetime peak, otherwise the peak RSS sampled by the resource
+            monitor (None if it is not running).
+        """
+        tie_points = len(chunk.tie_points.points) if chunk.tie_points else 0
+        points = chunk.point_cloud.point_count if chunk.point_cloud else 0
+        peak = peak_memory(self.peak_base)
+        if peak is None:
+            peak = self.stage_peak
+        try:
+            with closing(self.history_db()) as db, db:
+                db.execute('INSERT INTO stages (finished, project, chunk, '
+                           'stage, params, cameras, tie_points, points, '
+                           'size, wall, peak_mb) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           (datetime.now().isoformat(timespec='seconds'),
+                            str(self.doc_path), chunk.label, stage,
+                            json.dumps(params, default=str),
+                            len([c for c in chunk.cameras if c.enabled]),
+                            tie_points, points,
+                            self.stage_size(chunk, stage),
+                            wall.total_seconds(), peak)
+                           )
+        except sqlite3.Error as e:
+            print(f'Run history not recorded: {e}')
+        # update the ETA of a planned run
+        for i, (label, planned, _) in enumerate(self.eta_plan):
+            if label == str(chunk) and planned == stage:
+                del self.eta_plan[i]
+                self.print_eta()
+                break
+        self.stage = ''
+        # the next stage gets its own peak
+        self.peak_base = reset_peak_memory()
+        self.stage_peak = None
+
+    @staticmethod
+    def stage_cost(db, stage, size):
+        """
+        Predicted seconds of a stage from the run history
+
+        Input: db - run history connection
+                stage - name of the stage (method)
+                size - size measure of the chunk (stage_size())
+        Output: seconds or None without history
+
+        Fits wall time = a * size + b by least squares to the last 200 runs
+            of the stage, with one run (or one size) scales its time.
+        """
+        rows = db.execute('SELECT size, wall FROM stages '
+                          'WHERE stage = ? AND size > 0 '
+                          'ORDER BY id DESC LIMIT 200', (stage,)
+                          ).fetchall()
+        if not rows:
+            return None
+        x, y = np.array(rows, dtype=float).T
+        if len(rows) > 1 and np.ptp(x) > 0:
+            a, b = np.linalg.lstsq(np.c_[x, np.ones_like(x)], y,
+                                   rcond=None)[0]
+            return max(a * size + b, 0.0)
+        return y.mean() / x.mean() * size
+
+    def predict_eta(self, stages, *, chunks=None):
+        """
+        Plan the stages of a workflow and print their ETA
+
+        Input: stages - list of stage (method) names to be run
+                chunks - list of chunks (default self.chunks)
+        Dependencies: stage_size(), print_eta()
+        """
+        if chunks is None:
+            chunks = self.chunks
+        self.eta_plan = [(str(c), s, self.stage_size(c, s))
+                         for c in chunks for s in stages]
+        self.print_eta()
+        self.peak_base = reset_peak_memory()
+        self.stage_peak = None
+
+    def print_eta(self):
+        """
+        Print and log the ETA of the remaining planned stages per chunk
+            and in total
+        Dependencies: stage_cost(), predict_eta()
+        """
+        totals = {}
+        unknown = 0
+        try:
+            with closing(self.history_db()) as db:
+                for label, stage, size in self.eta_plan:
+                    cost = self.stage_cost(db, stage, size)
+                    if cost is None:
+                        unknown += 1
+                        cost = 0.0
+                    totals[label] = totals.get(label, 0.0) + cost
+        except sqlite3.Error as e:
+            print(f'No ETA, run history not readable: {e}')
+            return
+        total = sum(totals.values())
+        lines = [f'    ETA {label}: {timedelta(seconds=round(sec))} \n'
+                 for label, sec in totals.items()]
+        finish = datetime.now() + timedelta(seconds=total)
+        lines.append(f'    ETA total: {timedelta(seconds=round(total))}, '
+                     f'finished about {finish.strftime("%d/%m %H:%M")} '
+                     f'({unknown} stages without history) \n')
+        print(''.join(lines))
+        with open(self.log, 'a+', encoding='utf-8') as logfile:
+            logfile.write(''.join(lines))
+
+    def run_geo(self, *, align=True, grad=False, exp=True, fit_reg=False):
+        """
+        Processes georeferenced images, e.g. UAV images
+
+        Input:
+            align (default True): if True runs the whole process from aligning
+                images to exporting the LAS, Ortho and DSM/Ortho.
+                Use align=False if the images are already aligned.
+            grad (default False): if True automatically runs a gradual
+                selection and optimisation process (in one pass with
+                grad_sel_combined if self.grad_mode is 'combined')
+            pp_req: if further processing is required set this to True and
+                the process will stop before the ortho is generated, e.g.
+                for multi-spectral data
+            fit_reg (default False): if True fits the region to the robust
+                tie point bounds before the point cloud is built
+        """
+        combined = grad and align and self.grad_mode == 'combined'
+        stages = ['align'] if align else []
+        if combined:
+            stages += ['grad_sel_combined']
+        elif grad:
+            stages += ['grad_sel_pregcp'] if align else []
+            stages += ['grad_sel_postgcp']
+        stages += ['dense_c'] + (['filter_conf'] if self.min_conf else [])
+        stages += ['dem', 'ortho']
+        stages += ['export_geo', 'export_model'] if exp else []
+        self.start_monitor()
+        try:
+            self.preflight(workflow='geo')
+            self.predict_eta(stages)
+            if align:
+                self.disable_bad_pics()
+                self.align()
+                if combined:
+                    self.grad_sel_combined()
+                elif grad:
+                    self.grad_sel_pregcp()
+                    self.grad_sel_postgcp()
+            else:
+                if grad:
+                    self.grad_sel_postgcp()
+            if fit_reg:
+                self.fit_region()
+            if self.target_res:
+                self.plan_depth_qual()
+            self.dense_c()
+            if self.min_conf:
+                self.filter_conf()
+            self.dem()
+            self.ortho()
+            if exp:
+                self.export_geo()
+        finally:
+            self.stop_monitor()
+
+    def sweep(self,
+              variants,
+              *,
+              align=True,
+              grad=False,
+              workflow='geo',
+              keep_chunks=1,
+              ):
+        """
+        Run several processing variants on one alignment
+
+        Parameters: variants=list of dicts with the keys label (default
+                        v1, v2...), filtering and depth_qual (default
+                        self.filtering / self.depth_qual), e.g.
+                        [{'label': 'mild', 'filtering':
+                          Metashape.MildFiltering}, {'depth_qual': 4}]
+                    align=boolean (align (and select) first, otherwise the
+                        chunks are already aligned)
+                    grad=boolean (gradual selection after aligning)
+                    workflow='geo' (DEM, ortho, export_geo) or 'model'
+                        (build_model, export_model)
+                    keep_chunks=number of processed variant chunks kept in
+                        the document, older ones are removed (the exports
+                        stay), the variants always run one after the other
+        Output: list of result dicts, also printed and written to
+            <doc>_sweep.csv in the export folder
+
+        Each variant works on a copy of the aligned chunk with only the
+            tie points (no depth maps, point cloud, DEM etc.), labelled
+            <chunk>_<label>_<filtering>_q<depth_qual>, so the run history,
+            log and export names tell the variants apart.
+        """
+        bases = list(self.chunks)
+        settings = (self.filtering, self.depth_qual)
+        rows = []
+        live = []
+        self.start_monitor()
+        try:
+            if align:
+                self.disable_bad_pics()
+                self.align(workflow=workflow)
+                if grad and self.grad_mode == 'combined':
+                    self.grad_sel_combined()
+                elif grad:
+                    self.grad_sel_pregcp()
+                    if workflow == 'geo':
+                        self.grad_sel_postgcp()
+            for base in bases:
+                for i, variant in enumerate(variants, 1):
+                    label = variant.get('label', f'v{i}')
+                    mode = variant.get('filtering', settings[0])
+                    qual = variant.get('depth_qual', settings[1])
+                    if qual not in self.depth_dict:
+                        raise ValueError('Unknown Metashape depth map quality '
+                                         'value (Ultra=1 High=2 Medium=4 '
+                                         'Low=8 Lowest=16).'
+                                         )
+                    start_t = datetime.now()
+                    copy = base.copy(
+                        items=[Metashape.DataSource.TiePointsData],
+                        keypoints=False)
+                    copy.label = (f'{base.label}_{label}_'
+                                  f'{str(mode).split(".")[-1]}_q{qual}')
+                    self.chunks = [copy]
+                    self.filtering = mode
+                    self.depth_qual = qual
+                    with open(self.log, 'a+', encoding='utf-8') as logfile:
+                        logfile.write(f'Sweep variant {copy} of {base} at '
+                                      f'{start_t.strftime("%H:%M:%S")} \n'
+                                      )
+                    self.dense_c(mode=mode, qual=qual)
+                    if self.min_conf:
+                        self.filter_conf()
+                    if workflow == 'geo':
+                        self.dem()
+                        self.ortho()
+                        self.export_geo()
+                    else:
+                        self.build_model()
+                        self.export_model()
+                    entries = json.loads(self.manifest.read_text(
+                        encoding='utf-8')) if self.manifest.exists() else []
+                    size = sum(e['bytes'] or 0 for e in entries
+                               if e['prefix'] == self.prefix
+                               and e['chunk'] == copy.label)
+                    points = copy.point_cloud.point_count \
+                        if copy.point_cloud else 0
+                    rows.append({'chunk': base.label,
+                                 'variant': label,
+                                 'filtering': str(mode).split('.')[-1],
+                                 'depth_qual': self.depth_dict[qual],
+                                 'minutes': round((datetime.now() - start_t)
+                                                  .total_seconds() / 60, 1),
+                                 'points': points,
+                                 'export_mb': round(size / 2 ** 20, 1),
+                                 })
+                    # limit the variant chunks held in the document
+                    live.append(copy)
+                    while len(live) > keep_chunks:
+                        self.doc.remove([live.pop(0)])
+                    self.doc.save()
+        finally:
+            self.chunks = bases
+            self.filtering, self.depth_qual = settings
+            self.stop_monitor()
+        cols = list(rows[0]) if rows else []
+        lines = [','.join(cols)]
+        lines += [','.join(str(row[c]) for c in cols) for row in rows]
+        file = self.export_path / f'{self.doc_path.stem}_sweep.csv'
+        file.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+        print('\n'.join(line.replace(',', '\t') for line in lines))
+        with open(self.log, 'a+', encoding='utf-8') as logfile:
+            logfile.write('Sweep results: \n')
+            logfile.write(''.join(f'    {line} \n' for line in lines))
+        return rows
+
+    def ortho_and_exp(self):
+        """Export ortho and DSM"""
+        self.export_geo()
+
+    def run_fjalls_1(self, *, align=True, grad=True, fit_reg=False):
+        """
+        Customised for student workflow on a particular practical. Runs
+            process up to DEM.
+
+        Input:
+            align (default True): if True runs the whole process from aligning
+                images to exporting the LAS, Ortho and DSM/Ortho.
+                Use align=False if the images are already aligned.
+            grad (default False): if True automatically runs a gradual
+                selection and optimisation process
+            fit_reg (default False): if True fits the region to the robust
+                tie point bounds before the point cloud is built
+        """
+        if align:
+            self.disable_bad_pics()
+            self.align()
+            if grad:
+                self.grad_sel_pregcp()
+                self.grad_sel_postgcp()
+        else:
+            if grad:
+                self.grad_sel_postgcp()
+        if fit_reg:
+            self.fit_region()
+        if self.target_res:
+            self.plan_depth_qual()
+        self.dense_c()
+        if self.min_conf:
+            self.filter_conf()
+        self.dem()
+
+    def run_fjalls_2(self):
+        """
+        Customised for student workflow on a particular practical. Runs
+            process from Ortho to export.
+        """
+        self.ortho()
+        self.export_geo()
+
+    def run_model(self,
+                  *,
+                  align=True,
+                  grad=False,
+                  mask_ties=False,
+                  hi_acc=False,
+                  exp=True
+                  ):
+        """
+        Processes non-referenced images, e.g. close range object pictures
+
+        Input:
+            align (default True): if True runs the whole process from aligning
+                images to exporting the LAS and OBJ.
+                Use False if the images are already aligned.
+            grad (default False): if True automatically runs a gradual
+                selection and optimisation process
+        """
+        stages = ['align'] if align else []
+        if grad:
+            stages += ['grad_sel_pregcp'] if align else ['grad_sel_postgcp']
+        stages += ['dense_c'] + (['filter_conf'] if self.min_conf else [])
+        stages += ['build_model'] + (['export_model'] if exp else [])
+        self.start_monitor()
+        try:
+            self.preflight(workflow='model')
+            self.predict_eta(stages)
+            if align:
+                self.disable_bad_pics()
+                if mask_ties and not hi_acc:
+                    self.align(mask_ties=True, workflow='model')
+                elif mask_ties and hi_acc:
+                    self.align(mask_ties=True, acc=0, workflow='model')
+                elif not mask_ties and hi_acc:
+                    self.align(acc=0, workflow='model')
+                else:
+                    self.align(generic=True, guided=False, workflow='model')
+                if grad:
+                    self.grad_sel_pregcp()
+            else:
+                if grad:
+                    self.grad_sel_postgcp()
+            if hi_acc:
+                self.dense_c(qual=1)
+            else:
+                self.dense_c()
+            if self.min_conf:
+                self.filter_conf()
+            self.build_model()
+            if exp:
+                self.export_model()
+        finally:
+            self.stop_monitor()
+
+    @staticmethod
+    def project_points(cameras, points):
+        """
+        Project points into many cameras in one vectorised pass
+
+        Input: cameras - list of aligned Metashape.Camera objects
+                points - (M, 3) array of points in chunk coordinates
+        Output: uv - (M, N, 2) array of pixel coordinates
+                inside - (M, N) boolean array, True where the point is in
+                    front of the camera and inside the image
+
+        Frame sensors use the Metashape frame camera model (f, cx, cy, b1,
+            b2, k1-k4, p1-p4) in numpy. Other sensor types (fisheye,
+            spherical etc.) fall back to camera.project().
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        uv = np.full((len(points), len(cameras), 2), np.nan)
+        # chunk to camera transforms, inverted in one batch
+        inv = np.linalg.inv(np.array([to_array(c.transform)
+                                      for c in cameras]))
+        hom = np.c_[points, np.ones(len(points))]
+        xyz = np.einsum('nij,mj->mni', inv[:, :3, :], hom)
+        # group cameras by sensor to share the calibration
+        groups = {}
+        for j, camera in enumerate(cameras):
+            groups.setdefault(camera.sensor.key, []).append(j)
+        for idx in groups.values():
+            sensor = cameras[idx[0]].sensor
+            calib = sensor.calibration
+            if sensor.type != Metashape.Sensor.Type.Frame or not calib:
+                for j in idx:
+                    for i, point in enumerate(points):
+                        proj = cameras[j].project(Metashape.Vector(point))
+                        if proj is not None:
+                            uv[i, j] = [proj.x, proj.y]
+                continue
+            z = xyz[:, idx, 2]
+            z = np.where(z > 0, z, np.nan)
+            x = xyz[:, idx, 0] / z
+            y = xyz[:, idx, 1] / z
+            r2 = x * x + y * y
+            radial = 1 + r2 * (calib.k1
+                               + r2 * (calib.k2
+                                       + r2 * (calib.k3 + r2 * calib.k4)))
+            tangential = 1 + r2 * (calib.p3 + r2 * calib.p4)
+            x_d = (x * radial
+                   + (calib.p1 * (r2 + 2 * x * x) + 2 * calib.p2 * x * y)
+                   * tangential)
+            y_d = (y * radial
+                   + (calib.p2 * (r2 + 2 * y * y) + 2 * calib.p1 * x * y)
+                   * tangential)
+            uv[:, idx, 0] = (sensor.width * 0.5 + calib.cx
+                             + x_d * (calib.f + calib.b1) + y_d * calib.b2)
+            uv[:, idx, 1] = sensor.height * 0.5 + calib.cy + y_d * calib.f
+        width = np.array([c.sensor.width for c in cameras])
+        height = np.array([c.sensor.height for c in cameras])
+        with np.errstate(invalid='ignore'):
+            inside = ((uv[..., 0] >= 0) & (uv[..., 0] < width)
+                      & (uv[..., 1] >= 0) & (uv[..., 1] < height))
+        return uv, inside
+
+    def blue_flag(self, *, chunks=None):
+        """
+        Based on code from Alexey:
+            https://www.agisoft.com/forum/index.php?topic=14568.0
+
+        Run this method after setting up enough control points for white
+        flags to be mostly correct. This will turn them blue to participate
+        in the calculations.
+
+        Parameter: chunks=list of chunks (optional, default all chunks)
+        Dependencies: project_points()
+
+        The aligned regular cameras are collected once per chunk and every
+            placed marker is projected into all of them in one pass.
+        """
+        if not chunks:
+            chunks = self.chunks
+        total = 0
+        for _ in chunks:
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                start_t = datetime.now()
+                logfile.write(f'Blue flag projection {_} at '
+                              f'{start_t.strftime("%H:%M:%S")} \n'
+                              )
+            cameras = [c for c in _.cameras
+                       if c.transform
+                       and c.type == Metashape.Camera.Type.Regular
+                       ]
+            markers = [m for m in _.markers if m.position]
+            added = 0
+            if cameras and markers:
+                uv, inside = self.project_points(
+                    cameras, [list(m.position) for m in markers]
+                )
+                for i, marker in enumerate(markers):
+                    # skip existing projections
+                    existing = {c.key for c in marker.projections.keys()}
+                    for j in np.flatnonzero(inside[i]):
+                        camera = cameras[j]
+                        if camera.key in existing:
+                            continue
+                        marker.projections[camera] = Metashape \
+                            .Marker \
+                            .Projection(Metashape.Vector(uv[i, j].tolist()),
+                                        False
+                                        )
+                        added += 1
+            total += added
+            print(f'{added} marker projections added in {_}')
+            # write log information
+            with open(self.log, 'a+', encoding='utf-8') as logfile:
+                end_t = datetime.now()
+                self.runtime += end_t - start_t
+                logfile.write(f'Finished blue flag projection {_} at '
+                              f'{end_t.strftime("%H:%M:%S")} \n'
+                              )
+                logfile.write(f'    Markers: {len(markers)} \n'
+                              f'    Aligned cameras: {len(cameras)} \n'
+                              f'    Projections added: {added} \n'
+                              )
+                logfile.write(f'Processing time: {end_t - start_t} / '
+                              f'Total Time: {self.runtime} \n'
+                              )
+        print(f'Script finished, {total} projections added')
+        return total
+
+    # different running options for menu
+    def menu_geo_grad(self):
+        """MS Menu item"""
+        # write log information
+        with open(self.log, 'a+', encoding='utf-8') as logfile:
+            start_t = datetime.now()
+            logfile.write('Menu item: Geo (gradual selection) \n'
+                          f'Started:{start_t} \n')
+        self.run_geo(grad=True)
+
+    def menu_geo_grad_noexp(self):
+        """MS Menu item"""
+        # write log information
+        with open(self.log, 'a+', encoding='utf-8') as logfile:
+            start_t = datetime.now()
+            logfile.write('Menu item: Geo (gradual selection) No export \n'
+                          f'Started:{start_t} \n'
+                          )
+        self.run_geo(grad=True, exp=False)
+
+    def menu_geo_exp(self):
+        """MS Menu item"""
+        # write log information
+        with open(self.log, 'a+', encoding='utf-8') as logfile:
+            start_t = datetime.now()
+            logfile.write('Menu item: Orthophoto and Export \n'
+                          f'Started:{start_t} \n'
+                          )
+        self.ortho_and_exp()
+
+    def menu_fjalls_1(self):
+        """MS Menu item"""
+        # write log information
+        with open(self.log, 'a+', encoding='utf-8') as logfile:
+            start_t = datetime.now()
+            logfile.write('Menu item: Fjalls_1 \nStarted:{start_t} \n')
+        self.run_fjalls_1(grad=True)
+
+    def menu_fjalls_2(self):
+        """MS Menu item"""
+        # write log information
+        with open(self.log, 'a+', encoding='utf-8') as logfile:
+            start_t = datetime.now()
+            logfile.write('Menu item: Fjalls_2 \nStarted:{start_t} \n')
+        self.run_fjalls_2()
+
+    def menu_align_only(self):
+        """MS Menu item"""
+        # write log information
+        with open(self.log, 'a+', encoding='utf-8') as logfile:
+            start_t = datetime.now()
+            logfile.write('Menu item: Align only \nStarted:{start_t} \n')
+        self.disable_bad_pics()
+        self.align()
+
+    def menu_align_new(self):
+        """MS Menu item"""
+        # write log information
+        with open(self.log, 'a+', encoding='utf-8') as logfile:
+            start_t = datetime.now()
+            logfile.write('Menu item: Align new images only \n'
+                          f'Started:{start_t} \n'
+                          )
+        self.align(incremental=True)
+
+    def menu_align_only_grad(self):
+        """MS Menu item"""
+        # write log information
+        with open(self.log, 'a+', encoding='utf-8') as logfile:
+            start_t = datetime.now()
+            logfile.write('Menu item: Align only (gradual selection) \n'
+                          f'Started:{start_t} \n'
+                          )
+        self.disable_bad_pics()
+        self.align()
+        self.grad_sel_pregcp()
+
+    def menu_geo_post_align(self):
+        """MS Menu item"""
+        # write log information
+        with open(self.log, 'a+', encoding='utf-8') as logfile:
+            start_t = datetime.now()
+            logfile.write('Menu item: Run all after alignment - Geo \n'
+                          f'Started:{start_t} \n'
+                          )
+        self.run_geo(align=False)
+
+    def menu_geo_post_align_grad(self):
+        """MS Menu item"""
+        # write log information
+        with open(self.log, 'a+', encoding='utf-8') as logfile:
+            start_t = datetime.now()
+            logfile.write('Menu item: Run all after alignment - Geo '
+                          '(gradual selection) \n'
+                          f'Started:{start_t} \n'
+                          )
+        self.run_geo(align=False, grad=True)
+
+    def menu_model_grad(self):
+        """MS Menu item"""
+        # write log information
+        with open(self.log, 'a+', encoding='utf-8') as logfile:
+            start_t = datetime.now()
+            logfile.write('Menu item: 3D Model (gradual selection) \n'
+                          f'Started:{start_t} \n'
+                          )
+        self.run_model(grad=True)
+
+    def menu_model_grad_mask(self):
+        """MS Menu item"""
+        # write log information
+        with open(self.log, 'a+', encoding='utf-8') as logfile:
+            start_t = datetime.now()
+            logfile.write('Menu item: 3D Model '
+                          '(gradual selection, mask ties) \n'
+                          f'Started:{start_t} \n'
+                          )
+        self.run_model(grad=True, mask_ties=True)
+
+    def menu_model_grad_mask_hi(self):
+        """MS Menu item"""
+        # write log information
+        with open(self.log, 'a+', encoding='utf-8') as logfile:
+            start_t = datetime.now()
+            logfile.write('Menu item: 3D Model (gradual selection, mask ties, '
+                          'high accuracy) \n'
+                          f'Started:{start_t} \n'
+                          )
+        self.run_model(grad=True, mask_ties=True, hi_acc=True)
+
+    def menu_model_post_align(self):
+        """MS Menu item"""
+        # write log information
+        with open(self.log, 'a+', encoding='utf-8') as logfile:
+            start_t = datetime.now()
+            logfile.write('Menu item: Run all after alignment - 3D Model \n'
+                          f'Started:{start_t} \n'
+                          )
+        self.run_model(align=False)
+
+    def menu_model_post_align_grad(self):
+        """MS Menu item"""
+        # write log information
+        with open(self.log, 'a+', encoding='utf-8') as logfile:
+            start_t = datetime.now()
+            logfile.write('Menu item: Run all after alignment -'
+                          ' 3D Model (gradual selection) \n'
+                          f'Started:{start_t} \n'
+                          )
+        self.run_model(align=False, grad=True)
+
+
+def menu(label, method):
+    """
+    Creates a menu item in PS
+
+    Input:  A label for the menu item (string)
+            The method in the MSProc class to call
+    """
+    Metashape.app.addMenuItem(label, method)
+
+
+# initiate object
+ms_doc = MSProc(Metashape.app.document)
+
+# create menu options
+menu('Custom/Remove alignment(optional)', ms_doc.remove_align)
+menu('Custom/Calculate Image Quality', ms_doc.get_quality)
+menu('Custom/Run - Geo', ms_doc.run_geo)
+menu('Custom/Run - Geo (gradual selection)', ms_doc.menu_geo_grad)
+menu('Custom/Run - Geo (gradual selection) No Export',
+     ms_doc.menu_geo_grad_noexp)
+menu('Custom/Run - Geo Export after processing', ms_doc.menu_geo_exp)
+menu('Custom/Run - 3D Model', ms_doc.run_model)
+menu('Custom/Run - 3D Model (gradual selection)', ms_doc.menu_model_grad)
+menu('Custom/Run - 3D Model (grad, mask ties)', ms_doc.menu_model_grad_mask)
+menu('Custom/Run - 3D Model (grad, mask ties, high accuracy)',
+     ms_doc.menu_model_grad_mask_hi,
+     )
+menu('Custom/Align only', ms_doc.menu_align_only)
+menu('Custom/Align new images only', ms_doc.menu_align_new)
+menu('Custom/Set tie point baseline (aligned outside script)',
+     ms_doc.set_baseline)
+menu('Custom/Run all after alignment - Geo', ms_doc.menu_geo_post_align)
+menu('Custom/Run all after alignment - 3D Model', ms_doc.menu_model_post_align)
+menu('Custom/Align only (gradual selection)', ms_doc.menu_align_only_grad)
+menu('Custom/Run all after alignment - Geo (gradual selection)',
+     ms_doc.menu_geo_post_align_grad,
+     )
+menu('Custom/Run all after alignment - 3D Model (gradual selection)',
+     ms_doc.menu_model_post_align_grad,
+     )
+menu('Custom/Run - Fjalls_1', ms_doc.menu_fjalls_1)
+menu('Custom/Run - Fjalls_2', ms_doc.menu_fjalls_2)
+menu('Custom/Run Blue Flag Function', ms_doc.blue_flag)
+menu('Custom/Fit region to tie points', ms_doc.fit_region)
+menu('Custom/Split chunks into tiles', ms_doc.split_chunks)
+menu('Custom/Merge tile exports', ms_doc.merge_tiles)
+menu('Custom/Filter point cloud by confidence', ms_doc.filter_conf)
+menu('Custom/Export web map tiles', ms_doc.export_tiles)
+menu('Custom/DSM QA statistics', ms_doc.dsm_stats)
+menu('Custom/DSM difference to reference DSM', ms_doc.dsm_diff)
+menu('Change Values/Get current parameter info', ms_doc.info)
+menu('Change Values/Change file prefix', ms_doc.change_pre)
+menu('Change Values/Enter custom processing values', ms_doc.run_custom)
+menu('Change Values/Enter custom accuracy values', ms_doc.run_qual_adjust)
+menu('Change Values/Enter export formats', ms_doc.run_format_adjust)
+menu('Change Values/Reverse reference altitude', ms_doc.reverse_altitude)
+menu('Change Values/Offset reference altitude', ms_doc.ref_offset_menu)
+menu('Change Values/Undo reference change', ms_doc.undo_references)